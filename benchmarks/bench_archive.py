@@ -0,0 +1,159 @@
+"""Benchmark the archiving of a run folder with the available codecs.
+
+shutil.make_archive, which the service used before, is compared with
+the zip codec of the archiver on one and on all cores, and with the
+tar.zst codec if the zstandard package is installed. Without --dir a
+folder of half compressible text and half random data is generated.
+
+With --serving the archive is downloaded from a gevent server instead,
+the way run_zip streams it, while another request is sent every 0.1 s.
+The longest wait for that request is reported with the archive produced
+on the hub and in its threadpool (downloads.iter_in_threadpool); the
+script exits with 1 if the other request waits more than a second with
+the threadpool.
+
+Usage: python benchmarks/bench_archive.py [--dir path/to/run] [--size-mb 2048] [--serving]
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from gep_host.utils import archiver
+
+
+def fill_folder(folder: str, size_mb: int) -> None:
+    """Write size_mb of files, half of them text, half random bytes."""
+    line = b"2024-01-01,portfolio_42,EUR,1234.5678,0.000123,simulated\n"
+    text = line * (1024 * 1024 // len(line))
+    for i in range(size_mb):
+        sub = os.path.join(folder, f"part{i % 8}")
+        os.makedirs(sub, exist_ok=True)
+        with open(os.path.join(sub, f"file{i}.dat"), "wb") as ofile:
+            ofile.write(text if i % 2 else os.urandom(1024 * 1024))
+
+
+def serve(folder: str, port: int, handoff: bool) -> None:
+    from flask import Flask, Response
+    from gevent.pywsgi import WSGIServer
+
+    from gep_host.utils.downloads import iter_in_threadpool
+
+    app = Flask(__name__)
+
+    @app.route("/zip")
+    def get_zip():
+        parts = archiver.stream_zip(archiver.walk_files(folder))
+        return Response(iter_in_threadpool(parts) if handoff else parts,
+                        mimetype="application/zip")
+
+    @app.route("/ping")
+    def ping():
+        return "pong"
+
+    WSGIServer(("127.0.0.1", port), app, log=None).serve_forever()
+
+
+def max_wait(folder: str, handoff: bool) -> float:
+    """Return the longest response time of /ping during a zip download."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    proc = multiprocessing.Process(target=serve, args=(folder, port, handoff),
+                                   daemon=True)
+    proc.start()
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+        def download():
+            conn = http.client.HTTPConnection("127.0.0.1", port)
+            conn.request("GET", "/zip")
+            resp = conn.getresponse()
+            while resp.read(1024 * 1024):
+                pass
+
+        thread = threading.Thread(target=download)
+        thread.start()
+        waits = []
+        while thread.is_alive():
+            start = time.perf_counter()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+            conn.request("GET", "/ping")
+            conn.getresponse().read()
+            waits.append(time.perf_counter() - start)
+            time.sleep(0.1)
+        thread.join()
+        return max(waits)
+    finally:
+        proc.terminate()
+        proc.join()
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    path = func(*args, **kwargs)
+    return time.perf_counter() - start, os.path.getsize(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="The folder to archive")
+    parser.add_argument("--size-mb", type=int, default=2048,
+                        help="The size of the generated folder")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of compressing threads")
+    parser.add_argument("--serving", action="store_true",
+                        help="Check that other requests are served during "
+                        "a download")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = args.dir
+        if folder is None:
+            folder = os.path.join(tmp, "run")
+            fill_folder(folder, args.size_mb)
+        base = os.path.join(tmp, "archive")
+
+        if args.serving:
+            print(f"{'zip download':<32} "
+                  f"{'longest wait of another request [s]':>36}")
+            waits = {}
+            for name, handoff in [("on the hub", False),
+                                  ("in the threadpool", True)]:
+                waits[handoff] = max_wait(folder, handoff)
+                print(f"{name:<32} {waits[handoff]:>36.2f}")
+            sys.exit(1 if waits[True] > 1 else 0)
+
+        cases = [("shutil.make_archive zip",
+                  lambda: shutil.make_archive(base, "zip", root_dir=folder)),
+                 ("archiver zip, 1 thread",
+                  lambda: archiver.make_archive(base, folder, "zip", 1)),
+                 (f"archiver zip, {args.workers} threads",
+                  lambda: archiver.make_archive(base, folder, "zip",
+                                                args.workers))]
+        if archiver.zstandard is not None:
+            cases.append((f"archiver tar.zst, {args.workers} threads",
+                          lambda: archiver.make_archive(base, folder,
+                                                        "tar.zst",
+                                                        args.workers)))
+        else:
+            print("zstandard is not installed, tar.zst is skipped.")
+
+        print(f"{'method':<32} {'time [s]':>9} {'size [MB]':>10}")
+        for name, func in cases:
+            elapsed, size = timed(func)
+            print(f"{name:<32} {elapsed:>9.2f} {size / 2**20:>10.1f}")
+            for ext in archiver.CODECS.values():
+                if os.path.isfile(base + ext):
+                    os.remove(base + ext)
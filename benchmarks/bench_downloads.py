@@ -0,0 +1,141 @@
+"""Benchmark concurrent downloads of a large file from the gevent server.
+
+flask's send_file on the default gevent handler, which the service used
+before, is compared with send_download on the default handler (the file
+is read and written in blocks by python) and with send_download on
+SendfileHandler (os.sendfile). Each server runs in its own process, the
+clients download the file at the same time, the wall time and the CPU
+time of the server are reported. A download continued with a Range
+request is checked against the md5 of the file.
+
+Usage: python benchmarks/bench_downloads.py [--size-mb 512] [--clients 8]
+"""
+import argparse
+import hashlib
+import http.client
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import psutil
+from flask import Flask, send_file
+from gevent.pywsgi import WSGIHandler, WSGIServer
+
+from gep_host.utils.downloads import SendfileHandler, send_download
+
+BUFFER = 1024 * 1024
+
+
+def serve(path: str, port: int, legacy: bool, handler_class) -> None:
+    app = Flask(__name__)
+
+    @app.route("/file")
+    def get_file():
+        if legacy:
+            return send_file(path, as_attachment=True)
+        return send_download(path, as_attachment=True)
+
+    WSGIServer(("127.0.0.1", port), app, log=None,
+               handler_class=handler_class).serve_forever()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def download(port: int, headers: dict = None, md5=None) -> int:
+    """Download /file, return the number of bytes received."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    conn.request("GET", "/file", headers=headers or {})
+    resp = conn.getresponse()
+    buffer = bytearray(BUFFER)
+    received = 0
+    while True:
+        read = resp.readinto(buffer)
+        if not read:
+            break
+        if md5 is not None:
+            md5.update(memoryview(buffer)[:read])
+        received += read
+    conn.close()
+    return received
+
+
+def wait_for(port: int) -> None:
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("The server did not start.")
+
+
+def measure(path: str, legacy: bool, handler_class, clients: int):
+    port = free_port()
+    proc = multiprocessing.Process(target=serve, daemon=True,
+                                   args=(path, port, legacy, handler_class))
+    proc.start()
+    try:
+        wait_for(port)
+        server = psutil.Process(proc.pid)
+        cpu_start = sum(server.cpu_times()[:2])
+        received = []
+        threads = [threading.Thread(target=lambda: received.append(
+            download(port))) for _ in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        cpu = sum(server.cpu_times()[:2]) - cpu_start
+
+        # a download broken in the middle and continued
+        md5 = hashlib.md5()
+        half = os.path.getsize(path) // 2
+        download(port, {"Range": f"bytes=0-{half - 1}"}, md5)
+        download(port, {"Range": f"bytes={half}-"}, md5)
+        return elapsed, cpu, sum(received), md5.hexdigest()
+    finally:
+        proc.terminate()
+        proc.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=512,
+                        help="The size of the downloaded file")
+    parser.add_argument("--clients", type=int, default=8,
+                        help="Number of concurrent downloads")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "large.bin")
+        file_md5 = hashlib.md5()
+        with open(path, "wb") as ofile:
+            for _ in range(args.size_mb):
+                block = os.urandom(BUFFER)
+                file_md5.update(block)
+                ofile.write(block)
+        file_md5 = file_md5.hexdigest()
+
+        cases = [("send_file, gevent handler", True, WSGIHandler),
+                 ("send_download, gevent handler", False, WSGIHandler),
+                 ("send_download, sendfile", False, SendfileHandler)]
+        print(f"{args.clients} clients downloading {args.size_mb} MB each")
+        print(f"{'method':<30} {'time [s]':>9} {'MB/s':>8} "
+              f"{'server CPU [s]':>15} {'resume':>7}")
+        for name, legacy, handler_class in cases:
+            elapsed, cpu, received, digest = measure(path, legacy,
+                                                     handler_class,
+                                                     args.clients)
+            assert received == args.clients * args.size_mb * BUFFER
+            print(f"{name:<30} {elapsed:>9.2f} "
+                  f"{received / 2**20 / elapsed:>8.0f} {cpu:>15.2f} "
+                  f"{'ok' if digest == file_md5 else 'FAILED':>7}")
@@ -0,0 +1,57 @@
+"""Benchmark the latency of starting a program in a conda environment.
+
+Starting the interpreter through a shell that activates the environment,
+which the runs did before, is compared with executing the interpreter
+resolved at install time with the prepared environment variables. The
+program is an empty script, so the time is the launch overhead only.
+
+Usage: python benchmarks/bench_launch.py --env my_env
+       [--activate "conda activate "] [--repeat 20]
+"""
+import argparse
+import statistics
+import subprocess
+import time
+
+from gep_host.utils.launch import launch_command, launch_env, resolve_launch
+
+
+def timed(repeat: int, *args, **kwargs) -> list:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(*args, check=True, stdout=subprocess.DEVNULL,
+                       **kwargs)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--env", required=True,
+                        help="The name of an existing conda environment")
+    parser.add_argument("--activate", default="conda activate ",
+                        help="The activation command, as in host.cfg")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="Number of launches per method")
+    args = parser.parse_args()
+
+    conf = {"activate": args.activate}
+    start = time.perf_counter()
+    spec = resolve_launch(conf, args.env)
+    print(f"Resolving the environment once took "
+          f"{time.perf_counter() - start:.3f} s.")
+
+    cases = [("shell + activate",
+              lambda: timed(args.repeat,
+                            f'{args.activate}{args.env} && python -c pass',
+                            shell=True)),
+             ("direct exec",
+              lambda: timed(args.repeat, launch_command(spec, "-c pass"),
+                            env=launch_env(spec)))]
+    print(f"{'method':<20} {'median [ms]':>12} {'min [ms]':>9} "
+          f"{'max [ms]':>9}")
+    for name, func in cases:
+        times = func()
+        print(f"{name:<20} {statistics.median(times) * 1000:>12.1f} "
+              f"{min(times) * 1000:>9.1f} {max(times) * 1000:>9.1f}")
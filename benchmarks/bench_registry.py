@@ -0,0 +1,82 @@
+"""Benchmark the cost of one run status transition in the registry.
+
+A status transition updates the status of one run and appends a status
+event. Its cost should stay flat from 1k to 100k runs and must not touch
+the other rows. Only the sqlite backend meets this: the csv backend
+rereads and rewrites the whole table, so its cost grows with the number
+of runs. The growth of each backend is reported after the table.
+
+Usage: python benchmarks/bench_registry.py [--sizes 1000 10000 100000]
+"""
+import argparse
+import json
+import random
+import tempfile
+import time
+
+# the largest ratio of the costs at the largest and the smallest size
+# that still counts as flat
+FLAT = 2
+
+from gep_host.utils.registry import CsvRegistry, SqliteRegistry
+from gep_host.utils.set_conf_init import set_csv_files, set_folders
+
+
+def fill_runs(reg, size: int) -> None:
+    rows = [{"program_name": f"prg{i % 50}",
+             "purpose": f"purpose{i}",
+             "python_args": "-m my_module",
+             "setup_date": "2024-01-01 00:00:00",
+             "status": "Completed",
+             "uploaded_files": json.dumps({}),
+             "inherited_files": json.dumps({"input": "data/input.csv"}),
+             "registered_files": json.dumps({}),
+             "undefineds": json.dumps([]),
+             "outputs": json.dumps({"output": "results/output.csv"}),
+             "comment": "benchmark",
+             "notifications": json.dumps([])}
+            for i in range(size)]
+    reg.add_many("runs", rows)
+
+
+def time_transitions(reg, size: int, repeat: int) -> float:
+    """Return the mean time of one status transition in milliseconds."""
+    purposes = random.sample(range(size), repeat)
+    start = time.perf_counter()
+    for i in purposes:
+        run_id = {"program_name": f"prg{i % 50}", "purpose": f"purpose{i}"}
+        reg.set_status("runs", run_id, "running")
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", type=int,
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="Number of transitions timed per size")
+    args = parser.parse_args()
+
+    print(f"{'runs':>8} {'csv [ms]':>10} {'sqlite [ms]':>12}")
+    costs = {"csv": [], "sqlite": []}
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as host_root:
+            conf = {}
+            set_folders(host_root, conf)
+            set_csv_files(host_root, conf)
+            results = []
+            for reg in (CsvRegistry(conf), SqliteRegistry(conf["DB"])):
+                fill_runs(reg, size)
+                results.append(time_transitions(reg, size, args.repeat))
+        costs["csv"].append(results[0])
+        costs["sqlite"].append(results[1])
+        print(f"{size:>8} {results[0]:>10.2f} {results[1]:>12.3f}")
+
+    if len(args.sizes) > 1:
+        print(f"From {args.sizes[0]} to {args.sizes[-1]} runs:")
+        for backend, times in costs.items():
+            growth = times[-1] / times[0]
+            verdict = ("flat, meets the requirement" if growth <= FLAT
+                       else "grows with the table, does not meet "
+                       "the requirement")
+            print(f"  {backend:<7} x{growth:<7.1f} {verdict}")
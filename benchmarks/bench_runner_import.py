@@ -0,0 +1,98 @@
+"""Benchmark the startup of the run processes with -X importtime.
+
+The import of the runner, which the service starts for each run, is
+compared with the import of run_program, which the runs used before.
+The modules the runner must not load are checked too: the script exits
+with 1 if one of them is imported, so it can guard against regressions.
+With --master_config the configuration is also loaded, from the ini
+files for run_program and from the snapshot for the runner, and the
+registry is read the way a run waiting for resources reads it, which
+must not load pandas with the SQLite registry either.
+
+Usage: python benchmarks/bench_runner_import.py [--master_config path/to/MasterConfig.cfg] [--repeat 5]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# the runner must start without these
+HEAVY = ["flask", "werkzeug", "pandas", "psutil", "unidecode", "gevent"]
+# and must not load these while it waits for resources
+WAITING_HEAVY = ["flask", "werkzeug", "pandas", "gevent"]
+
+
+def import_times(code: str) -> dict:
+    """Return the cumulative import time in us of each top-level module."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          stderr=subprocess.PIPE, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def wall_time(code: str, repeat: int) -> float:
+    """Return the median time in s of starting python and running code."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--master_config",
+                        help="Load the configuration of this service too")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of process starts per entry point")
+    args = parser.parse_args()
+
+    cases = {"run_program": "import gep_host.utils.run_program",
+             "runner": ("import gep_host.utils.runner, "
+                        "gep_host.utils.registry, gep_host.utils.launch")}
+    if args.master_config:
+        from gep_host.utils.set_conf_init import save_conf_snapshot, set_conf
+        conf = {}
+        set_conf(conf, args.master_config)
+        snapshot = save_conf_snapshot(conf)
+        cases["run_program"] += (
+            "; from gep_host.utils.set_conf_init import set_conf; "
+            f"set_conf({{}}, {args.master_config!r})")
+        cases["runner"] += f"; import json; json.load(open({snapshot!r}))"
+        waiting = (cases["runner"]
+                   + "; from gep_host.utils.admission import run_needs"
+                   + f"; conf = json.load(open({snapshot!r}))"
+                   + "; reg = gep_host.utils.registry.get_registry(conf)"
+                   + "; [run_needs(conf, reg, run['program_name'])"
+                   + " for run in reg.rows('runs', status='running')]"
+                   + "; reg.rows('runs', status_prefix='queue ')")
+
+    print(f"{'entry point':<12} {'imports [ms]':>13} {'start [ms]':>11}")
+    for name, code in cases.items():
+        imported = import_times(code)
+        own = imported.get(f"gep_host.utils.{name}", 0)
+        elapsed = wall_time(code, args.repeat)
+        print(f"{name:<12} {own / 1000:>13.1f} {elapsed * 1000:>11.1f}")
+
+    loaded = sorted(mod for mod in import_times(cases["runner"])
+                    if mod.split(".")[0] in HEAVY)
+    if loaded:
+        print(f"The runner imports {', '.join(loaded)}.")
+        sys.exit(1)
+    print(f"The runner imports none of {', '.join(HEAVY)}.")
+    if args.master_config:
+        loaded = sorted(mod for mod in import_times(waiting)
+                        if mod.split(".")[0] in WAITING_HEAVY)
+        if loaded:
+            print(f"The waiting runner imports {', '.join(loaded)}.")
+            sys.exit(1)
+        print("The waiting runner imports none of "
+              f"{', '.join(WAITING_HEAVY)}.")
@@ -10,7 +10,11 @@ from flask import Flask
 from gevent.pywsgi import WSGIServer
 
 from .routes import main_routes, setup_dynamic_routes
-from .utils.set_conf_init import set_conf, load_pages
+from .utils.downloads import SendfileHandler
+from .utils.set_conf_init import set_conf, load_pages, save_conf_snapshot
+from .utils.scheduler import start_scheduler
+from .utils.env_pool import start_env_pool
+from .utils.env_lock import start_env_eviction
 from .utils.helpers import name_to_html_id
 from . import __version__
 
@@ -22,6 +26,9 @@ def parse_json(json_str):
 
 
 def format_file_size(size):
+    # The registry keeps every value as a string
+    size = int(float(size)) if size not in ("", None) else 0
+
     # Define the thresholds for each unit
     KB = 1024
     MB = KB * 1024
@@ -58,6 +65,7 @@ def configure_app(app: Flask, args: argparse.Namespace):
     mimetypes.add_type('font/woff2', '.woff2')
     prg_conf_path = set_conf(app.config, args.master_config)
     load_pages(app.config, prg_conf_path)
+    save_conf_snapshot(app.config)
 
     @app.context_processor
     def inject_config():
@@ -72,6 +80,7 @@ def configure_app(app: Flask, args: argparse.Namespace):
                     git_example=app.config['git_example'],
                     git_branch=app.config['git_branch'],
                     stripe_color=app.config['stripe_color'],
+                    run_setup=app.config['run_setup'],
                     top_line=app.config['top_line'])
 
     setup_dynamic_routes(app.config.get("static pages", {}))
@@ -80,6 +89,12 @@ def configure_app(app: Flask, args: argparse.Namespace):
     app.jinja_env.filters['filesize'] = format_file_size
     app.jinja_env.filters['name_to_html_id'] = name_to_html_id
 
+    # the reloader of the debug mode runs the app in a child process
+    if not args.debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_scheduler(app.config)
+        start_env_pool(app.config)
+        start_env_eviction(app.config)
+
     return app
 
 
@@ -114,7 +129,8 @@ if __name__ == "__main__":
     logging.info("Webservice is starting in prod mode.")
     http_server = WSGIServer(listener=(app.config['host_to'],
                                        app.config["port"]),
-                             application=app)
+                             application=app,
+                             handler_class=SendfileHandler)
     print("Server running on "
           f"http://{app.config['host_to']}:{app.config['port']}")
     http_server.serve_forever()
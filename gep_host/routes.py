@@ -1,31 +1,48 @@
 import json
 import logging
-import hashlib
 import multiprocessing
 import os
 import platform
-import psutil
+import re
 import shutil
 import sys
+import threading
+import time
+import traceback
 from configparser import ConfigParser, ExtendedInterpolation
 from datetime import datetime
 from io import StringIO
-from typing import List
+from typing import Callable, Dict, List
 
+import gevent
 import markdown
 import pandas as pd
 import psutil
 from flask import Blueprint, Response, current_app, flash, jsonify, redirect, render_template, request, send_file, send_from_directory, url_for
 from markupsafe import Markup
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
 from . import __version__
-from .utils import delete_program, delete_run, install_program, run_program
+from .utils import blobs, delete_program, delete_run, install_program, run_program, uploads
 from .utils.helpers import *
+from .utils.downloads import iter_in_threadpool, send_download
+from .utils.archiver import CODECS, available_codec, stream_archive, walk_files
+from .utils.env_cache import EnvCache
+from .utils.env_pool import EnvPool
+from .utils.git_mirror import mirrors
+from .utils.wheelhouse import wheels
+from .utils.registry import get_registry
+from .utils.scheduler import get_scheduler
+from .utils.notifier import FINAL_STATUS, get_notifier
 
 
 main_routes = Blueprint('main_routes', __name__)
 
+LOG_CHUNK = 1024 * 1024  # the largest part of a log sent at once
+LOG_MAX_WAIT = 25  # the longest time a log tail request is held, in seconds
+RUN_ZIP_PARTS = ["config", "inputs", "outputs", "log"]
+
 
 def count_not_status(data: pd.DataFrame, status: str) -> int:
     """Count how many times the col status doesn't start with status."""
@@ -38,17 +55,64 @@ def count_not_status(data: pd.DataFrame, status: str) -> int:
 
 def activity(data: pd.DataFrame, type: str) -> str:
     """Generate the message to be displayed."""
+    return activity_msg(count_not_status(data, FINAL_STATUS[type]), type)
+
+
+def activity_msg(active: int, type: str) -> str:
+    """Generate the message from the number of active rows."""
     if type == "programs":
-        active = count_not_status(data, "Installed")
         ret = f"There are {active} program installation(s) in progress."
     if type == "runs":
-        active = count_not_status(data, "Completed")
         ret = f"Total of {active} runs are in progress."
     return ret
 
 
+def tail_log(log_path: str, is_finished: Callable[[], bool]) -> Response:
+    """Return the bytes of the log written after the requested offset.
+
+    The offset is given by the ``offset`` query argument; a negative
+    offset counts from the end of the log and starts at a line boundary.
+    With ``wait`` the request is held for at most that many seconds until
+    new bytes arrive (long poll). At most LOG_CHUNK bytes are returned.
+    The offset to continue from is sent in the ``X-Log-Offset`` header,
+    and ``X-Log-Done`` is 1 if the log will not grow anymore.
+    """
+    if not os.path.isfile(log_path):
+        return "The log file is not found.", 404
+    offset = request.args.get("offset", 0, type=int)
+    wait = min(request.args.get("wait", 0, type=float), LOG_MAX_WAIT)
+    size = os.path.getsize(log_path)
+    from_end = offset < 0
+    if from_end:
+        offset = max(0, size + offset)
+
+    finished = is_finished()
+    deadline = time.monotonic() + wait
+    checked = time.monotonic()
+    while size <= offset and not finished and time.monotonic() < deadline:
+        gevent.sleep(0.5)
+        size = os.path.getsize(log_path)
+        if time.monotonic() - checked > 2:
+            finished = is_finished()
+            checked = time.monotonic()
+
+    size = os.path.getsize(log_path)  # what was written before finishing
+    with open(log_path, "rb") as ifile:
+        ifile.seek(offset)
+        data = ifile.read(max(0, min(size - offset, LOG_CHUNK)))
+    offset += len(data)
+    if from_end and offset > len(data):  # drop the partial first line
+        data = data[data.find(b"\n") + 1:]
+
+    resp = Response(data, mimetype="text/plain")
+    resp.headers["X-Log-Offset"] = str(offset)
+    resp.headers["X-Log-Done"] = "1" if finished and offset >= size else "0"
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
 def allowed_file(filename):
-    return '.' in filename and (filename.endswith('.zip') or filename.endswith('.tar.gz'))
+    return '.' in filename and filename.endswith(('.zip', '.tar.gz', '.tar.zst'))
 
 
 @main_routes.route('/')
@@ -103,18 +167,19 @@ def programs():
     """Show programs, confirm successful installation."""
     column = request.args.get('column', 'upload_date')
     direction = request.args.get('direction', 'desc')
-    prgs = pd.read_csv(current_app.config["PRG"], dtype=str).fillna("")
+    reg = get_registry(current_app.config)
     ascending = True if direction == "asc" else False
-    prgs.sort_values(by=column, ascending=ascending, inplace=True)
-    libs = pd.read_csv(current_app.config["LIB"]).sort_values(
-        by="upload_date", ascending=False)
+    prgs = reg.frame("programs", order_by=column, ascending=ascending)
+    libs = reg.frame("libs", status="Installed", order_by="upload_date",
+                     ascending=False)
 
     return render_template('programs.html',
                            programs=prgs,
                            libs=libs,
                            column=column,
                            direction=direction,
-                           activity=activity(prgs, "programs"))
+                           activity=activity(prgs, "programs"),
+                           live_table="programs")
 
 
 @main_routes.route('/program_install', methods=['POST'])
@@ -124,14 +189,23 @@ def program_install():
         flash("Program install requiested without post data", "warning")
         return programs()
 
-    # Logic for handling the file upload
+    # Logic for handling the file upload, or the file uploaded in chunks
     file = request.files['program_package']
-    if file.filename == "" and "git-source-url" not in request.form:
+    package_name = file.filename
+    package_upload = request.form.get("program_package_upload", "")
+    if package_upload != "":
+        try:
+            package_name = uploads.state(current_app.config,
+                                         package_upload)["filename"]
+        except KeyError:
+            flash('The uploaded package file is not found', 'warning')
+            return redirect(url_for("main_routes.programs"))
+    if package_name == "" and "git-source-url" not in request.form:
         flash('No selected package file or git source', 'warning')
         return redirect(url_for("main_routes.programs"))
 
-    if file.filename != "":
-        if not allowed_file(file.filename):
+    if package_name != "":
+        if not allowed_file(package_name):
             flash('Not allowed filetype', 'warning')
             return redirect(request.url)
 
@@ -156,21 +230,28 @@ def program_install():
 
     # save the file or pass git source
     git = {}
-    if file.filename == "":
+    if package_name == "":
         filename = f"{program_name}.zip"
         git["git-source-url"] = request.form["git-source-url"].strip()
         git["git-source-ref"] = request.form["git-source-ref"].strip()
     else:
-        filename = secure_filename(file.filename)
+        filename = secure_filename(package_name)
     base, ext = os.path.splitext(filename)
-    if ext == '.gz' and base.endswith('.tar'):
-        ext = '.tar.gz'
+    if ext in ('.gz', '.zst') and base.endswith('.tar'):
+        ext = '.tar' + ext
         base = base[:-4]
     nowstr = datetime.now().strftime('%Y%m%d%H%M%S')
     t_filename = f"{base}_{nowstr}{ext}"  # the target of the install script
     program_zip_path = os.path.join(current_app.config['PRGR'], t_filename)
-    if file.filename != "":
-        file.save(program_zip_path)
+    if package_upload != "":
+        try:
+            tmp_path, *_ = uploads.take(current_app.config, package_upload)
+        except (KeyError, ValueError) as err:
+            flash(f'The uploaded package file is not usable: {err}', 'warning')
+            return redirect(url_for("main_routes.programs"))
+        shutil.move(tmp_path, program_zip_path)
+    elif package_name != "":
+        blobs.save_upload(file, program_zip_path)
 
     # Execute install script in subprocess
     res = install_program.init_install(program_name,
@@ -198,6 +279,23 @@ def install_log(program_name: str):
         return programs()
 
 
+@main_routes.route('/install_log_tail/<program_name>')
+def install_log_tail(program_name: str):
+    """Return the new part of the install log, see tail_log."""
+    reg = get_registry(current_app.config)
+    if reg.find("programs", program_name=program_name) is None:
+        return "Program not found.", 404
+    log_path = os.path.join(current_app.config["PRGR"],
+                            program_name, "install_output_and_error.log")
+
+    def is_finished():
+        prg = reg.find("programs", program_name=program_name)
+        return prg is None or prg["status"].startswith(
+            FINAL_STATUS["programs"])
+
+    return tail_log(log_path, is_finished)
+
+
 @main_routes.route('/del_program/<program_name>')
 def del_program(program_name: str):
     exitcode, stdout = delete_program.init_del(program_name)
@@ -211,16 +309,15 @@ def del_program(program_name: str):
 
 @main_routes.route('/program/<program_name>')
 def get_prg(program_name: str):
-    prgs = pd.read_csv(current_app.config["PRG"])
-    zip_fname = prgs.loc[prgs["program_name"]
-                         == program_name, "zip_fname"].iloc[0]
+    prg = get_registry(current_app.config).find("programs",
+                                                 program_name=program_name)
+    if prg is None:
+        return "Program not found", 404
+    zip_fname = prg["zip_fname"]
     f_path = os.path.join(current_app.config["PRGR"], zip_fname)
     orig_fname = get_orig_fname(zip_fname)
 
-    return send_file(f_path,
-                     mimetype='main_routeslication/zip',
-                     as_attachment=True,
-                     download_name=orig_fname)
+    return send_download(f_path, orig_fname, as_attachment=True)
 
 
 @main_routes.route('/runs', methods=['GET'])
@@ -229,24 +326,23 @@ def runs():
     direction = request.args.get('direction', 'desc')
     program_name = request.args.get('program_name')
 
-    # Read the content of run_details.csv, filter and order it
-    runs = pd.read_csv(current_app.config["RUN"], dtype=str).fillna("")
-    act_msg = activity(runs, "runs")
-
-    # order
+    # Read the runs, filter and order them
+    reg = get_registry(current_app.config)
     ascending = True if direction == "asc" else False
-    runs.sort_values(by=column, ascending=ascending, inplace=True)
+    runs = reg.frame("runs", order_by=column, ascending=ascending)
+    act_msg = activity(runs, "runs")
 
     # filter
     if program_name is not None:
         runs = runs[runs["program_name"] == program_name]
 
-    prgs = pd.read_csv(current_app.config["PRG"], dtype=str).fillna("")
-
     prg_to_run = None
     md_template = None
     if program_name is not None:
-        prg_to_run = prgs.loc[prgs.program_name == program_name].iloc[0]
+        prg_to_run = reg.find("programs", program_name=program_name)
+        if prg_to_run is None:
+            flash(f"Program {program_name} is not found.", "warning")
+            return redirect(url_for("main_routes.runs"))
         readme_path = os.path.join(current_app.config["PRGR"],
                                    program_name, prg_to_run['readme'])
         if os.path.isfile(readme_path):
@@ -262,7 +358,8 @@ def runs():
                            readme=md_template,
                            direction=direction,
                            column=column,
-                           activity=act_msg)
+                           activity=act_msg,
+                           live_table="runs")
 
 
 @main_routes.route('/trigger_run', methods=['POST'])
@@ -297,20 +394,18 @@ def create_dynamic_route(page_key):
 
 @main_routes.route('/program/<program_name>/<path:input_path>')
 def get_program_input(program_name, input_path):
-    f_path = os.path.join(
-        current_app.config["PRGR"], program_name, input_path)
+    f_path = safe_join(current_app.config["PRGR"], program_name, input_path)
     logging.info("sending %s", f_path)
-    return send_from_directory(os.path.dirname(f_path),
-                               os.path.basename(f_path))
+    return send_download(f_path)
 
 
 @main_routes.route('/readme/<program_name>/')
 def get_program_readme(program_name):
-    prgs = pd.read_csv(current_app.config["PRG"])
-    prg = prgs.loc[prgs["program_name"] == program_name]
-    if prg.empty:
+    prg = get_registry(current_app.config).find("programs",
+                                                 program_name=program_name)
+    if prg is None:
         return "Program not found", 404
-    readme_path = prg["readme"].iloc[0]
+    readme_path = prg["readme"]
     readme_fpath = os.path.join(current_app.config["PRGR"],
                                 program_name, readme_path)
     if not os.path.isfile(readme_fpath):
@@ -325,11 +420,14 @@ def get_program_readme(program_name):
 
 @main_routes.route('/run/<program_name>/<purpose>/<path:file>')
 def get_run_file(program_name, purpose, file):
-    f_path = os.path.join(current_app.config["RUNR"],
-                          program_name,
-                          purpose,
-                          file)
-    return send_from_directory(os.path.dirname(f_path), os.path.basename(f_path))
+    f_path = safe_join(current_app.config["RUNR"], program_name, purpose, file)
+    if f_path is None or not os.path.isfile(f_path):
+        # the inherited files of a minimal run are in the program folder
+        run = get_registry(current_app.config).find(
+            "runs", program_name=program_name, purpose=purpose)
+        if run is not None and run.get("run_setup") == "minimal":
+            f_path = safe_join(current_app.config["PRGR"], program_name, file)
+    return send_download(f_path)
 
 
 @main_routes.route('/del_run/<program_name>/<purpose>')
@@ -347,19 +445,32 @@ def del_run(program_name: str, purpose: str):
 
 @main_routes.route('/stop_run/<program_name>/<purpose>')
 def stop_run(program_name: str, purpose: str):
-    runs = pd.read_csv(current_app.config["RUN"], dtype=str).fillna("")
-    match = (runs['program_name'] == program_name) \
-        & (runs['purpose'] == purpose)
+    reg = get_registry(current_app.config)
+    run_id = {"program_name": program_name, "purpose": purpose}
+    run = reg.find("runs", **run_id)
+
+    scheduler = get_scheduler()
+    if (run is not None and scheduler is not None
+            and scheduler.cancel(program_name, purpose)):
+        log_path = os.path.join(current_app.config["RUNR"], program_name,
+                                purpose, "run_output_and_error.log")
+        with open(log_path, "+a", encoding="utf-8") as ofile:
+            nowstr = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            print(f"{nowstr} The run is removed from the queue "
+                  "from the webservice.", file=ofile)
+        flash(f"Program {program_name} with purpose {purpose} "
+              "is removed from the queue.", "success")
+        return redirect(url_for("main_routes.runs"))
 
-    if not match.any() or runs[match]["PID"].iloc[0] == "":
-        if not match.any():
+    if run is None or run["PID"] == "":
+        if run is None:
             flash(f"No program {program_name} with purpose {purpose} is found",
                   "warning")
         else:
             flash(f"Program {program_name} with purpose {purpose} "
                   "has been already completed.", "warning")
         return redirect(url_for("main_routes.runs"))
-    pidstr = runs[match]["PID"].iloc[0]
+    pidstr = run["PID"]
     pid = int(float(pidstr))
 
     try:
@@ -368,8 +479,7 @@ def stop_run(program_name: str, purpose: str):
     except psutil.NoSuchProcess:
         flash(f"No process with PID {pid} found in this OS. "
               "Status of the program is updated.", "warning")
-        runs.loc[match, 'status'] = "Completed (terminated)"
-        runs.to_csv(current_app.config["RUN"], index=False)
+        reg.set_status("runs", run_id, "Completed (terminated)")
         process_exists = False
     except Exception as e:
         flash(f"An error occurred:<br><pre>{e}</pre>", "warning")
@@ -388,28 +498,17 @@ def stop_run(program_name: str, purpose: str):
             process.terminate()
             process.wait(3)
 
-            runs.loc[match, 'status'] = "Completed (terminated)"
-            runs.to_csv(current_app.config["RUN"], index=False)
+            reg.set_status("runs", run_id, "Completed (terminated)")
             flash(f"Process with PID {pid} is terminated.", "success")
 
         except psutil.NoSuchProcess:
             flash(f"Process PID {pid} existed, but died after its children are closed.",
                   "success")
-            runs.loc[filter_criteria, 'status'] = "Completed (terminated)"
-            runs.to_csv(current_app.config["RUN"], index=False)
+            reg.set_status("runs", run_id, "Completed (terminated)")
         except psutil.TimeoutExpired:
             flash(
                 f"Process with PID {pid} did not terminate in time.", "warning")
 
-    conf = current_app.config
-    setup_folder = os.path.join(conf["RUNR"],
-                                program_name,
-                                purpose)
-    zip_file = os.path.join(conf["ROOT"],
-                            f"{program_name}__{purpose}.zip")
-    shutil.make_archive(zip_file[:-4], 'zip',
-                        root_dir=setup_folder, base_dir='.')
-    shutil.move(zip_file, setup_folder)
     log_path = os.path.join(
         current_app.config["RUNR"], program_name, purpose, "run_output_and_error.log")
     with open(log_path, "+a", encoding="utf-8") as ofile:
@@ -419,12 +518,101 @@ def stop_run(program_name: str, purpose: str):
     return redirect(url_for("main_routes.runs"))
 
 
+def run_part_files(run: dict, part: str) -> Dict[str, str]:
+    """Map the archive names to the paths of the files of a run part."""
+    conf = current_app.config
+    setup_folder = os.path.join(conf["RUNR"], run["program_name"],
+                                run["purpose"])
+    files = {}
+    if part == "config":
+        files.update(walk_files(setup_folder, "config"))
+    elif part == "log":
+        files.update(walk_files(setup_folder, "run_output_and_error.log"))
+    elif part == "outputs":
+        for path in json.loads(run["outputs"] or "{}").values():
+            files.update(walk_files(setup_folder, path))
+    elif part == "inputs":
+        files.update(walk_files(setup_folder, "masterinput"))
+        for path in json.loads(run["uploaded_files"] or "{}").values():
+            files.update(walk_files(setup_folder, path))
+        prg_folder = os.path.join(conf["PRGR"], run["program_name"])
+        for path in json.loads(run["inherited_files"] or "{}").values():
+            # not in the run folder in a minimal run setup
+            files.update(walk_files(setup_folder, path)
+                         or walk_files(prg_folder, path))
+        for path in json.loads(run["registered_files"] or "{}").values():
+            if os.path.isfile(path):
+                files[os.path.join("registered",
+                                   os.path.basename(path))] = path
+    return files
+
+
+@main_routes.route('/run_zip/<program_name>/<purpose>')
+def run_zip(program_name: str, purpose: str):
+    """Stream a zip of the run folder, created while it is downloaded.
+
+    The parts argument selects what is zipped, a comma separated list of
+    config, inputs, outputs and log. Without it the whole run folder is
+    zipped. The format argument selects the codec, zip (default) or
+    tar.zst.
+    """
+    run = get_registry(current_app.config).find(
+        "runs", program_name=program_name, purpose=purpose)
+    if run is None:
+        return "Run not found.", 404
+    try:
+        codec = available_codec(request.args.get("format", "zip"))
+    except ValueError as err:
+        return str(err), 400
+    parts = request.args.get("parts")
+    if parts is None:
+        setup_folder = os.path.join(current_app.config["RUNR"],
+                                    program_name, purpose)
+        files = walk_files(setup_folder)
+        # the archive stored by earlier versions of the service
+        files.pop(f"{program_name}__{purpose}.zip", None)
+        zip_name = f"{program_name}__{purpose}"
+    else:
+        files = {}
+        for part in parts.split(","):
+            if part not in RUN_ZIP_PARTS:
+                return (f"Unknown part {part}, "
+                        f"choose from {', '.join(RUN_ZIP_PARTS)}."), 400
+            for arcname, path in run_part_files(run, part).items():
+                files.setdefault(arcname, path)
+        zip_name = f"{program_name}__{purpose}__{'_'.join(parts.split(','))}"
+
+    mimetype = "application/zip" if codec == "zip" else "application/zstd"
+    # compressing blocks, the parts are produced off the gevent hub
+    return Response(iter_in_threadpool(stream_archive(files, codec)),
+                    mimetype=mimetype,
+                    headers={"Content-Disposition": "attachment; "
+                             f"filename={zip_name}{CODECS[codec]}"})
+
+
 @main_routes.route('/run_log/<program_name>/<purpose>')
 def run_log(program_name: str, purpose: str):
     log_path = os.path.join(current_app.config["RUNR"], program_name, purpose)
     return send_from_directory(log_path, "run_output_and_error.log")
 
 
+@main_routes.route('/run_log_tail/<program_name>/<purpose>')
+def run_log_tail(program_name: str, purpose: str):
+    """Return the new part of the run log, see tail_log."""
+    reg = get_registry(current_app.config)
+    run_id = {"program_name": program_name, "purpose": purpose}
+    if reg.find("runs", **run_id) is None:
+        return "Run not found.", 404
+    log_path = os.path.join(current_app.config["RUNR"], program_name,
+                            purpose, "run_output_and_error.log")
+
+    def is_finished():
+        run = reg.find("runs", **run_id)
+        return run is None or run["status"].startswith(FINAL_STATUS["runs"])
+
+    return tail_log(log_path, is_finished)
+
+
 @main_routes.route('/template/<program_name>/')
 def get_template(program_name: str):
     conf_path = os.path.join(current_app.config["PRGR"],
@@ -454,6 +642,21 @@ def get_template(program_name: str):
     return response
 
 
+def extract_library(conf: dict, archive: str, masterfolder: str,
+                    library_name: str) -> None:
+    """Extract an uploaded library, then record the outcome as its status."""
+    lib_id = {"library_name": library_name}
+    try:
+        if not extract_file(archive, masterfolder):
+            raise ValueError("The library is not a zip, tar.gz or tar.zst "
+                             "file.")
+    except Exception as err:
+        get_registry(conf).set_status("libs", lib_id,
+                                      f"Error in extracting the library: {err}")
+        return
+    get_registry(conf).set_status("libs", lib_id, "Installed")
+
+
 @main_routes.route('/libraries', methods=['GET', 'POST'])
 def libraries():
     if request.method == 'POST':
@@ -482,15 +685,12 @@ def libraries():
         nowstr = datetime.now().strftime('%Y%m%d%H%M%S')
         t_filename = f"{base}_{nowstr}{ext}"
         program_zip_path = os.path.join(current_app.config["LIBR"], t_filename)
-        file.save(program_zip_path)
+        blobs.save_upload(file, program_zip_path)
 
-        # extract the file
         try:
             os.makedirs(masterfolder)
-            if not extract_file(program_zip_path, masterfolder):
-                raise Exception("The library is not a zip of tar.gz file.")
         except Exception as err:
-            msg = f"Error in unzipping the library: {err}"
+            msg = f"Error in creating the folder of the library: {err}"
             msg += f"Details:<br><pre>{traceback.format_exc()}</pre>"
             flash(msg, "warning")
             return redirect(url_for("main_routes.libraries"))
@@ -503,37 +703,41 @@ def libraries():
         if file_size > 2000000:
             file_size_str = f"{file_size/1024/1024:.0f} MB"
 
-        libs = pd.DataFrame()
+        reg = get_registry(current_app.config)
         used_in = json.dumps([])
-        libs = pd.read_csv(current_app.config["LIB"])
-        prev_entry = libs.loc[libs["library_name"] == library_name]
-        if not prev_entry.empty:
-            used_in = prev_entry["used_in"].iloc[0]
-            libs = libs.loc[libs["library_name"] != library_name]
-
-        new_entry = pd.DataFrame({
-            'library_name': [library_name],
-            'path_to_exec': [path_to_exec],
-            'upload_date': [nowstr],
-            'zip_path': [os.path.relpath(program_zip_path, current_app.config["ROOT"])],
-            'orig_filename': [filename],
-            'status': ["Installed"],
-            'size': [file_size_str],
+        prev_entry = reg.find("libs", library_name=library_name)
+        if prev_entry is not None:
+            used_in = prev_entry["used_in"]
+            reg.remove("libs", library_name=library_name)
+
+        new_entry = {
+            'library_name': library_name,
+            'path_to_exec': path_to_exec,
+            'upload_date': nowstr,
+            'zip_path': os.path.relpath(program_zip_path, current_app.config["ROOT"]),
+            'orig_filename': filename,
+            'status': "Extracting",
+            'size': file_size_str,
             'comment': request.form["comment"],
-            'used_in': [used_in]
-        })
-
-        libs = pd.concat([libs, new_entry], ignore_index=True)
-        libs.to_csv(current_app.config["LIB"], index=False)
-        flash(f"Library {library_name} is successfully uploaded.", "success")
+            'used_in': used_in
+        }
+        reg.add("libs", new_entry)
+
+        # extract the file in the background
+        threading.Thread(target=extract_library,
+                         args=(current_app.config, program_zip_path,
+                               masterfolder, library_name),
+                         daemon=True, name=f"extract-{library_name}").start()
+        flash(f"Library {library_name} is successfully uploaded, "
+              "it is being extracted.", "success")
         return redirect(url_for("main_routes.libraries"))
 
     column = request.args.get('column', 'upload_date')
     direction = request.args.get('direction', 'desc')
     ascending = True if direction == "asc" else False
 
-    libs = pd.read_csv(current_app.config["LIB"]).fillna("")
-    libs.sort_values(by=column, ascending=ascending, inplace=True)
+    libs = get_registry(current_app.config).frame("libs", order_by=column,
+                                                  ascending=ascending)
 
     return render_template("libraries.html", libs=libs, column=column, direction=direction)
 
@@ -541,10 +745,9 @@ def libraries():
 @main_routes.route('/del_lib/<library_name>')
 def del_library(library_name: str):
     try:
-        libs = pd.read_csv(current_app.config["LIB"])
-        used_in_raw = libs.loc[libs["library_name"]
-                               == library_name, "used_in"].iloc[0]
-        used_in = json.loads(used_in_raw)
+        reg = get_registry(current_app.config)
+        lib = reg.find("libs", library_name=library_name)
+        used_in = json.loads(lib["used_in"])
         if used_in != []:  # if it still in use
             flash(("The library's entry stays with a mark deleted, "
                    "because programs are still using it: "
@@ -553,15 +756,13 @@ def del_library(library_name: str):
                    "uninstall all programs using it. "
                    "Reinstalling is also possible."),
                   "warning")
-            libs.loc[libs["library_name"] ==
-                     library_name, "status"] = "deleted"
+            reg.update("libs", {"library_name": library_name},
+                       status="deleted")
         else:
-            zip_path = libs.loc[libs["library_name"] ==
-                                library_name, "zip_path"].iloc[0]
-            zip_loc = os.path.join(current_app.config["ROOT"], zip_path)
+            zip_loc = os.path.join(current_app.config["ROOT"],
+                                   lib["zip_path"])
             os.remove(zip_loc)
-            libs = libs[libs["library_name"] != library_name]
-        libs.to_csv(current_app.config["LIB"], index=False)
+            reg.remove("libs", library_name=library_name)
 
         path = os.path.join(current_app.config["LIBR"], library_name)
         if os.path.isdir(path):
@@ -586,17 +787,31 @@ def del_library(library_name: str):
 
 @main_routes.route('/lib/<library_name>')
 def get_lib(library_name):
-    libs = pd.read_csv(current_app.config["LIB"])
-    zip_path = libs.loc[libs["library_name"]
-                        == library_name, "zip_path"].iloc[0]
-    path_to_zip = os.path.join(current_app.config["ROOT"], zip_path)
-    orig_filename = libs.loc[libs["library_name"]
-                             == library_name, "orig_filename"].iloc[0]
-
-    return send_file(path_to_zip,
-                     mimetype='main_routeslication/zip',
-                     as_attachment=True,
-                     download_name=orig_filename)
+    lib = get_registry(current_app.config).find("libs",
+                                                library_name=library_name)
+    if lib is None:
+        return "Library not found", 404
+    path_to_zip = os.path.join(current_app.config["ROOT"], lib["zip_path"])
+    orig_filename = lib["orig_filename"]
+
+    return send_download(path_to_zip, orig_filename, as_attachment=True)
+
+
+@main_routes.route('/caches')
+def caches():
+    """Show the state of the conda environment pool and cache, the git
+    mirrors, the wheelhouse and the blob store."""
+    env_cache = EnvCache(current_app.config)
+    cached_envs = sorted(env_cache.entries().values(),
+                         key=lambda entry: entry["last_used"], reverse=True)
+    return render_template("caches.html",
+                           pool=EnvPool(current_app.config).state(),
+                           cached_envs=cached_envs,
+                           env_cache_size=env_cache.size,
+                           git_mirrors=mirrors(current_app.config),
+                           wheels=wheels(current_app.config),
+                           wheelhouse_size=current_app.config["wheelhouse_size"],
+                           blob_stats=blobs.stats(current_app.config))
 
 
 @main_routes.route('/files', methods=['GET'])
@@ -604,68 +819,117 @@ def upload_form():
     column = request.args.get('column', 'upload_date')
     direction = request.args.get('direction', 'desc')
 
-    df = pd.read_csv(current_app.config['FLE'])
-
-    if direction == 'desc':
-        df = df.sort_values(by=column, ascending=False)
-    else:
-        df = df.sort_values(by=column, ascending=True)
+    df = get_registry(current_app.config).frame(
+        "files", order_by=column, ascending=direction != 'desc')
 
     return render_template('upload.html', files=df, column=column, direction=direction)
 
 
+@main_routes.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload, see utils/uploads.py."""
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get("filename", "")))
+    try:
+        size = int(data["size"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"message": "The size of the file is missing."}), 400
+    if filename == "" or size < 0:
+        return jsonify({"message": "Invalid file name or size."}), 400
+    upload_id = uploads.create(current_app.config, filename, size)
+    return jsonify(uploads.state(current_app.config, upload_id)), 201
+
+
+@main_routes.route('/uploads/<upload_id>', methods=['GET', 'PUT'])
+def upload_chunk(upload_id: str):
+    """Return the state of an upload, or append the chunk at ?offset=."""
+    conf = current_app.config
+    try:
+        if request.method == 'PUT':
+            uploads.append(conf, upload_id,
+                           request.args.get("offset", -1, type=int),
+                           request.stream,
+                           request.headers.get("X-Chunk-Sha256") or None)
+        return jsonify(uploads.state(conf, upload_id))
+    except KeyError:
+        return jsonify({"message": "Upload not found."}), 404
+    except ValueError as err:
+        return jsonify({**uploads.state(conf, upload_id),
+                        "message": str(err)}), 409
+
+
+@main_routes.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id: str):
+    """Check the size and the md5 (?md5=) of a complete upload."""
+    try:
+        return jsonify(uploads.finalize(current_app.config, upload_id,
+                                        request.args.get("md5")))
+    except KeyError:
+        return jsonify({"message": "Upload not found."}), 404
+    except ValueError as err:
+        return jsonify({"message": str(err)}), 409
+
+
 @main_routes.route('/save_files', methods=['POST'])
 def save_files():
-    uploaded_files = [f for f in request.files.values()]
     data = []
     new_filenames = []
 
-    csv_path = current_app.config['FLE']
-    df = pd.read_csv(csv_path)
+    reg = get_registry(current_app.config)
+
+    def received():
+        """Yield the name, the temporary file, the md5 and the size of the
+        posted files and of the files uploaded in chunks."""
+        for file in request.files.values():
+            if file:
+                yield (file.filename,
+                       *blobs.receive(current_app.config, file))
+        for upload_id in request.form.getlist("file_upload"):
+            try:
+                tmp_path, file_hash, size, name = uploads.take(
+                    current_app.config, upload_id)
+            except (KeyError, ValueError) as err:
+                flash(f"An uploaded file is not found: {err}", "warning")
+                continue
+            yield name, tmp_path, file_hash, size
 
     comment = request.form.get("comment")
-    for file in uploaded_files:
-        if file:
-            # Save file with datestring added to filename
-            secure_fname = secure_filename(file.filename)
-            file_content = file.read()
-            file_hash = hashlib.md5(file_content).hexdigest()
-            file.seek(0)
-
-            filename, file_extension = os.path.splitext(secure_fname)
-            new_filename = f"{filename}_{file_hash[:8]}{file_extension}"
-            now = datetime.now()
-
-            filepath = os.path.join(current_app.config['FLSR'], new_filename)
-            matches = df.loc[df["hash"] == file_hash]
-            if len(matches):
-                other_fname = matches["filename"].iloc[0]
-                flash(f"File named {file.filename} has the same content as "
-                      f"{other_fname}. This file is not saved.",
-                      "warning")
-                continue
-            file.save(filepath)
-
-            # Calculate file size and hash
-            size = len(file_content)
-
-            # Save file details to CSV
-            data.append({
-                "filename": new_filename,
-                "upload_date": now.strftime('%Y-%m-%d %H:%M:%S'),
-                "size": size,
-                "hash": file_hash,
-                "comment": comment,
-                "used_in": "[]"
-            })
-            new_filenames.append(new_filename)
+    for orig_fname, tmp_path, file_hash, size in received():
+        # Save file with datestring added to filename
+        secure_fname = secure_filename(orig_fname)
+
+        filename, file_extension = os.path.splitext(secure_fname)
+        new_filename = f"{filename}_{file_hash[:8]}{file_extension}"
+        now = datetime.now()
+
+        filepath = os.path.join(current_app.config['FLSR'], new_filename)
+        match = reg.find("files", hash=file_hash)
+        if match is not None:
+            os.remove(tmp_path)
+            other_fname = match["filename"]
+            flash(f"File named {orig_fname} has the same content as "
+                  f"{other_fname}. This file is not saved.",
+                  "warning")
+            continue
+        blobs.store_file(current_app.config, tmp_path, filepath,
+                         file_hash)
+
+        # Save file details to CSV
+        data.append({
+            "filename": new_filename,
+            "upload_date": now.strftime('%Y-%m-%d %H:%M:%S'),
+            "size": size,
+            "hash": file_hash,
+            "comment": comment,
+            "used_in": "[]"
+        })
+        new_filenames.append(new_filename)
 
     if len(new_filenames):
         flash(f"{len(new_filenames)} file(s) are successfully saved: "
               f"{', '.join(new_filenames)}", "success")
 
-    df = pd.concat([df, pd.DataFrame(data)], ignore_index=True)
-    df.to_csv(csv_path, index=False)
+    reg.add_many("files", data)
 
     return jsonify({"success": True, "message": "Files uploaded successfully"})
 
@@ -674,20 +938,15 @@ def save_files():
 def get_file():
     filename_full = request.args.get('filename')
     directory, filename = os.path.split(filename_full)
-    csv_path = current_app.config['FLE']
-    df = pd.read_csv(csv_path)
-    matches = df.loc[df["filename"] == filename, "dir"]
-    if matches.empty:
+    match = get_registry(current_app.config).find("files", filename=filename)
+    if match is None:
         return "File not found in the database", 404
-    m_dir = matches.iloc[0]
-    if pd.isna(m_dir):
+    if match["dir"] == "":
         location = os.path.join(current_app.config["FLSR"], filename)
     else:
         location = os.path.join(directory, filename)
     if os.path.isfile(location):
-        return send_file(location,
-                         as_attachment=True,
-                         download_name=filename)
+        return send_download(location, filename, as_attachment=True)
     else:
         return "File not found in the system", 404
 
@@ -697,15 +956,13 @@ def delete_file():
     filename = request.args.get('filename')
 
     # check if file is in database
-    csv_path = current_app.config['FLE']
-    df = pd.read_csv(csv_path)
-    matches = df['filename'] == filename
-    if not matches.any():
+    reg = get_registry(current_app.config)
+    match = reg.find("files", filename=filename)
+    if match is None:
         return jsonify({"message": "File not found in the database"}), 404
 
     # remove from database
-    updated_df = df[~matches]
-    updated_df.to_csv(csv_path, index=False)
+    reg.remove("files", filename=filename)
 
     # detect of the file was just registered
     if os.path.sep in filename or "/" in filename:
@@ -715,6 +972,7 @@ def delete_file():
     file_path = os.path.join(current_app.config['FLSR'], filename)
     if os.path.exists(file_path):
         os.remove(file_path)
+        blobs.gc(current_app.config, [match["hash"]])
         return jsonify({"message": "File successfully deleted"}), 200
     else:
         return jsonify({"message": "File not found on the server, so the entry is removed"}), 200
@@ -736,10 +994,9 @@ def register_files():
             warning_message += f"File {local} is not found on the server.\n"
             continue
 
-        csv_path = current_app.config['FLE']
-        df = pd.read_csv(csv_path)
+        reg = get_registry(current_app.config)
         directory, filename = os.path.split(local)
-        if (df["filename"] == filename).any():
+        if reg.find("files", filename=filename) is not None:
             warning_message += f"Filename {local} is already registered.\n"
             continue
 
@@ -752,8 +1009,7 @@ def register_files():
                      "dir": directory,
                      "used_in": "[]"}
 
-        df = pd.concat([df, pd.DataFrame([new_entry])], ignore_index=True)
-        df.to_csv(csv_path, index=False)
+        reg.add("files", new_entry)
 
         success_message += f"File {local} is successfully registered.\n"
 
@@ -767,24 +1023,57 @@ def register_files():
     return jsonify({"message": warning_message}), 400
 
 
-@main_routes.route('/check_status', methods=['POST'])
-def check_status():
-    # Get the current status sent by the client
-    data_received = request.json
-    activity_msg = data_received.get('status', ' ')
-    prev_count = activity_msg.split()[2]
-    # You can log or use this as required
-    if "program" in activity_msg:
-        data = pd.read_csv(current_app.config["PRG"])
-        msg = activity(data, "programs")
-    elif "run" in activity_msg:
-        data = pd.read_csv(current_app.config["RUN"])
-        msg = activity(data, "runs")
-    else:
-        return jsonify({'to_reload': False})
-
-    curr_count = msg.split()[2]
-    if prev_count == curr_count:
-        return jsonify({'to_reload': False})
-
-    return jsonify({'to_reload': True, "active_msg": msg})
+@main_routes.route('/status_events')
+def status_events():
+    """Stream the status changes of programs or runs as Server-Sent Events.
+
+    Each event carries the changed row and the new activity message. A
+    ``reload`` event is sent if the connection missed some events.
+    """
+    table = request.args.get("table")
+    if table not in FINAL_STATUS:
+        return "Unknown table.", 404
+    notifier = get_notifier(current_app.config)
+
+    def stream():
+        seq = notifier.seq
+        yield "retry: 5000\n\n"
+        while True:
+            events, seq = notifier.wait(seq)
+            if events is None:
+                yield "event: reload\ndata: {}\n\n"
+                continue
+            sent = False
+            for event in events:
+                if event["table"] != table:
+                    continue
+                event["activity"] = activity_msg(
+                    notifier.active.get(table, 0), table)
+                yield f"data: {json.dumps(event)}\n\n"
+                sent = True
+            if not sent:  # keep the connection and notice if it is closed
+                yield ": keep-alive\n\n"
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache",
+                             "X-Accel-Buffering": "no"})
+
+
+@main_routes.route('/row/programs/<program_name>')
+def program_row(program_name: str):
+    """Render a single program row, to update it in place."""
+    program = get_registry(current_app.config).find(
+        "programs", program_name=program_name)
+    if program is None:
+        return "Program not found.", 404
+    return render_template('program_row.html', program=program)
+
+
+@main_routes.route('/row/runs/<program_name>/<purpose>')
+def run_row(program_name: str, purpose: str):
+    """Render a single run row, to update it in place."""
+    run = get_registry(current_app.config).find(
+        "runs", program_name=program_name, purpose=purpose)
+    if run is None:
+        return "Run not found.", 404
+    return render_template('run_row.html', run=run)
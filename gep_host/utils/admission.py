@@ -0,0 +1,114 @@
+"""Admit runs only when the host has the cores and memory they need.
+
+The needs of a run are the ones of its program: the cores and the peak
+memory in GB declared in the ``resources`` section of the MasterConfig.cfg
+of the program, e.g.::
+
+    [resources]
+    cores = 4
+    memory = 8
+
+What is not declared is inferred from the last completed runs of the
+program, whose CPU time per wall time and peak RSS the runner records.
+A program without declaration and history needs ``run_default_cores``
+cores and no memory.
+
+A run is admitted if the CPU usage of the host is at most
+``run_max_cpu`` percent, its cores fit next to the cores booked by the
+running runs and ``run_reserved_cores``, and its memory fits into the
+available memory minus ``run_reserved_memory`` GB and the memory the
+running runs are still expected to take up to their peak (host.cfg). A
+run is always admitted if no other run is running, so a program needing
+more than the host has still runs, alone.
+"""
+import json
+import math
+import os
+from typing import Dict, Iterable, Optional, Tuple
+
+import psutil
+
+# number of completed runs the needs are inferred from
+HISTORY = 5
+
+
+def run_needs(conf: dict, reg, prg_name: str) -> Dict[str, float]:
+    """Return the cores and the memory in MB a run of the program needs."""
+    prg = reg.find("programs", program_name=prg_name)
+    declared = {}
+    if prg is not None and prg.get("resources"):
+        declared = json.loads(prg["resources"])
+    cores = declared.get("cores")
+    memory = declared.get("memory")
+    if cores is None or memory is None:
+        past = [run for run in reg.rows("runs", program_name=prg_name,
+                                        status="Completed")
+                if run.get("peak_rss")][-HISTORY:]
+        if past:
+            if cores is None:
+                cores = math.ceil(max(float(run["cores_used"])
+                                      for run in past))
+            if memory is None:
+                memory = max(float(run["peak_rss"]) for run in past)
+    return {"cores": max(1, int(cores or conf["run_default_cores"])),
+            "memory": float(memory or 0)}
+
+
+def _rss(pid: int) -> float:
+    """Return the memory in MB used by a process and its children."""
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.Error:
+        return 0
+    rss = 0
+    for child in procs:
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss / 2 ** 20
+
+
+def refusal(conf: dict, needs: Dict[str, float],
+            running: Iterable[Tuple[int, Dict[str, float]]],
+            interval: Optional[float] = None) -> Optional[str]:
+    """Tell why a run cannot start now.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    needs : Dict[str, float]
+        The needs of the run, see ``run_needs``.
+    running : Iterable[Tuple[int, Dict[str, float]]]
+        The PID and the needs of each running run.
+    interval : Optional[float]
+        The CPU usage is measured over this many seconds, or since the
+        previous call if None.
+
+    Returns
+    -------
+    Optional[str]
+        None if the run can start, otherwise the reason.
+    """
+    running = list(running)
+    cpu_usage = psutil.cpu_percent(interval=interval)
+    if cpu_usage > conf["run_max_cpu"]:
+        return f"CPU usage {cpu_usage}%"
+    if not running:
+        return None
+
+    booked = sum(run["cores"] for _, run in running)
+    free_cores = os.cpu_count() - conf["run_reserved_cores"] - booked
+    if needs["cores"] > free_cores:
+        return f"{needs['cores']} cores needed, {max(free_cores, 0)} free"
+
+    # the running runs may not have reached their peak yet
+    expected = sum(max(0, run["memory"] - _rss(pid)) for pid, run in running)
+    free_memory = (psutil.virtual_memory().available / 2 ** 20
+                   - conf["run_reserved_memory"] * 1024 - expected)
+    if needs["memory"] > free_memory:
+        return (f"{needs['memory']:.0f} MB memory needed, "
+                f"{max(free_memory, 0):.0f} MB available")
+    return None
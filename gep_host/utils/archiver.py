@@ -0,0 +1,265 @@
+"""Create archives of programs and runs.
+
+Two codecs are available:
+
+- ``zip``: zip with deflate, readable everywhere. The files are cut into
+  blocks that are compressed in parallel threads with raw deflate (zlib
+  releases the GIL while compressing) and joined into one deflate stream
+  per file, the way pigz does. Each block is primed with the end of the
+  previous one, so the ratio is close to that of a single stream.
+- ``tar.zst``: tar compressed with zstd, much faster at a similar ratio.
+  It needs the optional zstandard package, which compresses with
+  multiple threads itself. Without it, zip is used.
+
+Run archives are not stored, they are created when they are downloaded:
+the archive is written into a small buffer and handed over chunk by
+chunk, so the response starts right away and neither the disk nor the
+memory usage depends on the size of the run.
+
+The generators read the files and wait for the compressing threads with
+blocking calls, nothing here yields to the gevent hub. A caller on the
+hub of the web server has to produce each part in a thread, see
+``downloads.iter_in_threadpool``, otherwise no other request is served
+while an archive is created.
+"""
+import collections
+import io
+import logging
+import os
+import struct
+import tarfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # optional, tar.zst falls back to zip
+    zstandard = None
+
+BLOCK = 1024 * 1024  # bytes compressed in one piece
+WINDOW = 32 * 1024  # the deflate window, used to prime the next block
+CODECS = {"zip": ".zip", "tar.zst": ".tar.zst"}
+_zstd_warned = False  # the missing zstandard is logged only once
+
+
+class _StreamBuffer(io.RawIOBase):
+    """Collect what the archive writer writes until it is taken out.
+
+    The buffer is not seekable, so zipfile writes the central directory
+    relying on the sizes and checksums written after the data of each
+    file (data descriptors).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.data += data
+        return len(data)
+
+    def take(self) -> bytes:
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+
+def walk_files(root: str, rel_path: str = ".") -> Dict[str, str]:
+    """Map the archive names to the paths of the files under root/rel_path.
+
+    rel_path can be a file or a folder; missing paths are skipped.
+    """
+    files = {}
+    path = os.path.normpath(os.path.join(root, rel_path))
+    if os.path.isfile(path):
+        files[os.path.relpath(path, root)] = path
+    for dirpath, _, fnames in os.walk(path):
+        for fname in fnames:
+            fpath = os.path.join(dirpath, fname)
+            files[os.path.relpath(fpath, root)] = fpath
+    return files
+
+
+def _read_blocks(path: str) -> Iterator[Tuple[bytes, bytes, bool]]:
+    """Yield the blocks of a file with the preceding window and if last."""
+    with open(path, "rb") as ifile:
+        prev = b""
+        data = ifile.read(BLOCK)
+        while True:
+            nxt = ifile.read(BLOCK) if data else b""
+            yield data, prev[-WINDOW:], not nxt
+            if not nxt:
+                return
+            prev, data = data, nxt
+
+
+def _deflate(data: bytes, zdict: bytes, last: bool, level: int) -> bytes:
+    """Compress a block into a part of a raw deflate stream.
+
+    All but the last block end with a sync flush, so the parts can be
+    concatenated.
+    """
+    if zdict:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    flush = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    return comp.compress(data) + comp.flush(flush)
+
+
+def stream_zip(files: Dict[str, str], workers: Optional[int] = None,
+               level: int = 6) -> Iterator[bytes]:
+    """Yield a zip archive of the files part by part.
+
+    Parameters
+    ----------
+    files : Dict[str, str]
+        The archive names mapped to the paths of the files.
+    workers : Optional[int], optional
+        The number of compressing threads, by default the CPU count.
+    level : int, optional
+        The deflate compression level, by default 6.
+    """
+    workers = workers or os.cpu_count() or 1
+    out = _StreamBuffer()
+    with zipfile.ZipFile(out, "w") as zfile, \
+            ThreadPoolExecutor(workers) as pool:
+        pending: collections.deque = collections.deque()
+        entry = {}
+
+        def write(arcname, path, data, last, future):
+            if arcname != entry.get("arcname"):  # the first block
+                zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.flag_bits |= 0x08  # sizes and CRC after the data
+                zinfo.header_offset = zfile.fp.tell()
+                zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+                zfile.fp.write(zinfo.FileHeader(zip64))
+                zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+                entry.update(arcname=arcname, zinfo=zinfo, zip64=zip64)
+            zinfo = entry["zinfo"]
+            compressed = future.result()
+            zfile.fp.write(compressed)
+            zinfo.CRC = zlib.crc32(data, zinfo.CRC)
+            zinfo.compress_size += len(compressed)
+            zinfo.file_size += len(data)
+            if last:
+                fmt = "<LLQQ" if entry["zip64"] else "<LLLL"
+                zfile.fp.write(struct.pack(fmt, 0x08074b50, zinfo.CRC,
+                                           zinfo.compress_size,
+                                           zinfo.file_size))
+                zfile.filelist.append(zinfo)
+                zfile.NameToInfo[arcname] = zinfo
+                zfile.start_dir = zfile.fp.tell()
+                entry.clear()
+
+        for arcname, path in files.items():
+            for data, zdict, last in _read_blocks(path):
+                future = pool.submit(_deflate, data, zdict, last, level)
+                pending.append((arcname, path, data, last, future))
+                while len(pending) > 2 * workers:
+                    write(*pending.popleft())
+                    if out.data:
+                        yield out.take()
+        while pending:
+            write(*pending.popleft())
+            if out.data:
+                yield out.take()
+    yield out.take()
+
+
+def stream_tar_zst(files: Dict[str, str], workers: Optional[int] = None,
+                   level: int = 3) -> Iterator[bytes]:
+    """Yield a zstd compressed tar archive of the files part by part.
+
+    Parameters
+    ----------
+    files : Dict[str, str]
+        The archive names mapped to the paths of the files.
+    workers : Optional[int], optional
+        The number of compressing threads, by default the CPU count.
+    level : int, optional
+        The zstd compression level, by default 3.
+
+    Raises
+    ------
+    ImportError
+        If the zstandard package is not installed.
+    """
+    if zstandard is None:
+        raise ImportError("tar.zst archives need the zstandard package.")
+    workers = workers or os.cpu_count() or 1
+    cctx = zstandard.ZstdCompressor(level=level, threads=workers)
+    comp = cctx.compressobj()
+
+    def tar_parts():
+        for arcname, path in files.items():
+            tarinfo = tarfile.TarInfo(arcname)
+            fstat = os.stat(path)
+            tarinfo.size = fstat.st_size
+            tarinfo.mtime = fstat.st_mtime
+            tarinfo.mode = fstat.st_mode & 0o7777
+            yield tarinfo.tobuf(format=tarfile.PAX_FORMAT)
+            written = 0
+            with open(path, "rb") as ifile:
+                while written < tarinfo.size:
+                    data = ifile.read(min(BLOCK, tarinfo.size - written))
+                    if not data:  # the file shrank, keep the announced size
+                        data = bytes(tarinfo.size - written)
+                    written += len(data)
+                    yield data
+            yield bytes(-tarinfo.size % tarfile.BLOCKSIZE)  # padding
+        yield bytes(2 * tarfile.BLOCKSIZE)  # end of archive
+
+    for data in tar_parts():
+        compressed = comp.compress(data)
+        if compressed:
+            yield compressed
+    yield comp.flush()
+
+
+def stream_archive(files: Dict[str, str], codec: str = "zip",
+                   workers: Optional[int] = None) -> Iterator[bytes]:
+    """Yield the archive of the files with the codec, see CODECS."""
+    if codec == "tar.zst":
+        return stream_tar_zst(files, workers)
+    return stream_zip(files, workers)
+
+
+def available_codec(codec: str) -> str:
+    """Return the codec, or zip if it cannot be used here."""
+    if codec not in CODECS:
+        raise ValueError(f"Unknown archive codec {codec}, "
+                         f"choose from {', '.join(CODECS)}.")
+    if codec == "tar.zst" and zstandard is None:
+        global _zstd_warned
+        if not _zstd_warned:
+            logging.warning("The zstandard package is not installed, "
+                            "zip is used instead of tar.zst.")
+            _zstd_warned = True
+        return "zip"
+    return codec
+
+
+def make_archive(base_name: str, root_dir: str, codec: str = "zip",
+                 workers: Optional[int] = None) -> str:
+    """Archive the content of root_dir, like shutil.make_archive.
+
+    Returns
+    -------
+    str
+        The path of the archive, base_name with the extension of the
+        codec used.
+    """
+    codec = available_codec(codec)
+    archive_path = base_name + CODECS[codec]
+    files = walk_files(root_dir)
+    with open(archive_path, "wb") as ofile:
+        for data in stream_archive(files, codec, workers):
+            ofile.write(data)
+    return archive_path
@@ -0,0 +1,262 @@
+"""Store each distinct uploaded file once, keyed by its content.
+
+The uploaded inputs of the runs, the files of uploaded masterinput
+archives and the files saved on the Files tab are kept in
+HostRoot/blobs/<md5[:2]>/<md5>. The run folders and the files folder
+get read-only hardlinks to them, so uploading the same content again
+takes no disk space, and a run cannot modify the input of another run by
+writing into it.
+
+The number of hardlinks of a blob is its reference count: a blob linked
+only from the store is not used anymore and is removed by ``gc``, which
+runs after runs and files are deleted and checks only the blobs they
+referenced (the md5 of a registered file, the ``blobs`` of a run).
+Storing and collecting hold the same lock, between the threads and the
+processes (HostRoot/blobs/.lock), so a blob is never collected between
+the check and the new link. If the destination is on another device
+than the store, the blob is copied instead.
+
+Uploads are written to disk in chunks of ``CHUNK`` bytes and hashed in
+the same pass, so the memory an upload takes does not depend on its
+size, and a file appears under its final name only when it is complete.
+"""
+import contextlib
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, threads are still locked
+    fcntl = None
+
+CHUNK = 1024 * 1024
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _locked(conf: dict):
+    """Lock the store against gc and stores of other threads and processes."""
+    os.makedirs(conf["BLBR"], exist_ok=True)
+    with _lock, open(os.path.join(conf["BLBR"], ".lock"), "a") as lockf:
+        if fcntl is not None:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+        yield
+
+
+def blob_path(conf: dict, digest: str) -> str:
+    """Return the path of the blob of the content with this md5."""
+    return os.path.join(conf["BLBR"], digest[:2], digest)
+
+
+def file_md5(path: str) -> str:
+    """Return the md5 of a file, read in chunks."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as ifile:
+        for chunk in iter(lambda: ifile.read(CHUNK), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def link_blob(conf: dict, digest: str, dest: str) -> None:
+    """Hardlink the blob to dest, copy it if it is on another device."""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(blob_path(conf, digest), dest)
+    except FileNotFoundError:  # the blob is missing, not the device
+        raise
+    except OSError:  # another device or no hardlinks
+        shutil.copyfile(blob_path(conf, digest), dest)
+
+
+def store_file(conf: dict, src: str, dest: str,
+               digest: Optional[str] = None) -> str:
+    """Move a new file into the store and put a link to it at dest.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    src : str
+        The new file, a temporary one on the device of the store; it is
+        moved into the store or removed.
+    dest : str
+        Where the file is needed.
+    digest : Optional[str]
+        The md5 of the file if already known.
+
+    Returns
+    -------
+    str
+        The md5 of the file.
+    """
+    if digest is None:
+        digest = file_md5(src)
+    blob = blob_path(conf, digest)
+    with _locked(conf):
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:  # the content is already stored
+            link_blob(conf, digest, dest)
+            os.remove(src)
+            return digest
+        except FileNotFoundError:  # not yet, or collected, store it again
+            pass
+        os.chmod(src, READ_ONLY)
+        os.replace(src, blob)
+        link_blob(conf, digest, dest)
+    return digest
+
+
+def _write(upload, ofile) -> Tuple[str, int]:
+    """Copy an upload to ofile in chunks, hashing it in the same pass."""
+    md5 = hashlib.md5()
+    size = 0
+    for chunk in iter(lambda: upload.stream.read(CHUNK), b""):
+        md5.update(chunk)
+        ofile.write(chunk)
+        size += len(chunk)
+    return md5.hexdigest(), size
+
+
+def save_upload(upload, path: str) -> Tuple[str, int]:
+    """Save an uploaded file (werkzeug FileStorage) to path.
+
+    The file is written under a temporary name next to path and renamed
+    when complete, so path never holds a partial upload.
+
+    Returns
+    -------
+    Tuple[str, int]
+        The md5 and the size of the file.
+    """
+    fdesc, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                       suffix=".part")
+    try:
+        with os.fdopen(fdesc, "wb") as ofile:
+            digest, size = _write(upload, ofile)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return digest, size
+
+
+def receive(conf: dict, upload) -> Tuple[str, str, int]:
+    """Save an uploaded file next to the store.
+
+    Returns
+    -------
+    Tuple[str, str, int]
+        The path of the temporary file, its md5 and its size; the caller
+        passes it to ``store_file`` or removes it.
+    """
+    fdesc, tmp_path = tempfile.mkstemp(dir=conf["BLBR"], suffix=".part")
+    try:
+        with os.fdopen(fdesc, "wb") as ofile:
+            digest, size = _write(upload, ofile)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest, size
+
+
+def store_upload(conf: dict, upload, dest: str) -> str:
+    """Store an uploaded file and link it to dest.
+
+    Returns
+    -------
+    str
+        The md5 of the file.
+    """
+    tmp_path, digest, _ = receive(conf, upload)
+    try:
+        return store_file(conf, tmp_path, dest, digest)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+
+def store_tree(conf: dict, folder: str) -> List[str]:
+    """Replace the files of a folder with links to stored blobs.
+
+    Returns
+    -------
+    List[str]
+        The md5 of the files stored.
+    """
+    digests = []
+    for dirpath, _, fnames in os.walk(folder):
+        for fname in fnames:
+            path = os.path.join(dirpath, fname)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            fstat = os.stat(path)
+            if fstat.st_nlink > 1:  # already a link to a blob
+                continue
+            fdesc, tmp_path = tempfile.mkstemp(dir=conf["BLBR"],
+                                               suffix=".part")
+            os.close(fdesc)
+            shutil.move(path, tmp_path)
+            digests.append(store_file(conf, tmp_path, path))
+    return digests
+
+
+def stats(conf: dict) -> Dict[str, int]:
+    """Return the number and size of the blobs, and the size they save."""
+    count = size = saved = 0
+    for blob in _blobs(conf):
+        fstat = os.stat(blob)
+        count += 1
+        size += fstat.st_size
+        saved += fstat.st_size * max(fstat.st_nlink - 2, 0)
+    return {"count": count, "size": size, "saved": saved}
+
+
+def _blobs(conf: dict):
+    if not os.path.isdir(conf["BLBR"]):
+        return
+    for entry in os.scandir(conf["BLBR"]):
+        if entry.is_dir():
+            for blob in os.scandir(entry.path):
+                if blob.is_file():
+                    yield blob.path
+
+
+def gc(conf: dict, digests: Optional[Iterable[str]] = None) -> int:
+    """Remove the blobs no run or file links to.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    digests : Optional[Iterable[str]]
+        The md5 of the blobs the deleted runs or files referenced, only
+        these are checked. By default the whole store is checked.
+
+    Returns
+    -------
+    int
+        The number of removed blobs.
+    """
+    removed = 0
+    with _locked(conf):
+        if digests is None:
+            candidates = list(_blobs(conf))
+        else:
+            candidates = [blob_path(conf, digest) for digest in set(digests)
+                          if digest]
+        for blob in candidates:
+            try:
+                if os.stat(blob).st_nlink == 1:
+                    os.remove(blob)
+                    removed += 1
+            except FileNotFoundError:  # collected by another process
+                pass
+    return removed
@@ -3,7 +3,6 @@ import subprocess
 import shutil
 import sys
 import traceback
-import pandas as pd
 
 from flask import current_app
 
@@ -40,22 +39,22 @@ def delete_program(masterconf_path: str, program_name: str):
     # the price of using the same file where the deletion is initiated from python
     # and where the console script's deletion is implemented
     from gep_host.utils.set_conf_init import set_conf
+    from gep_host.utils.registry import get_registry
     from helpers import remove_readonly, remove_val_from_json
     config = {}
     set_conf(config, masterconf_path)
+    reg = get_registry(config)
 
     code = 0
     try:
         masterfolder = os.path.join(config["PRGR"], program_name)
         # 1. remove program_details.csv and get the zip_fname
-        df = pd.read_csv(config["PRG"], dtype=str)
-        zip_fname = df.loc[df['program_name'] ==
-                           program_name, "zip_fname"].iloc[0]
-        df = df[df['program_name'] != program_name]
-        df.to_csv(config["PRG"], index=False)
+        prg = reg.find("programs", program_name=program_name)
+        zip_fname = prg["zip_fname"]
+        reg.remove("programs", program_name=program_name)
 
         # 2. remove the folder recursively
-        if zip_fname != zip_fname:
+        if zip_fname == "":
             print("Program package file is not associated with the program.")
         else:
             zip_path = os.path.join(config["PRGR"], zip_fname)
@@ -71,14 +70,18 @@ def delete_program(masterconf_path: str, program_name: str):
             print("The program folder has been already deleted.")
             code = 2
 
-        # 3. Remove the conda environment
-        cmd = f'conda env remove -n {program_name}'
-        run_and_verify(cmd)
+        # 3. Remove the conda environment and its lock
+        if prg.get("env_state") != "evicted":
+            cmd = f'conda env remove -n {program_name}'
+            run_and_verify(cmd)
+        shutil.rmtree(os.path.join(config["LCKR"], program_name),
+                      ignore_errors=True)
 
-        libs = pd.read_csv(config["LIB"])
-        libs["used_in"] = libs["used_in"].apply(remove_val_from_json,
-                                                val_2_remove=program_name)
-        libs.to_csv(config["LIB"], index=False)
+        for lib in reg.frame("libs").itertuples():
+            used_in = remove_val_from_json(lib.used_in or "[]", program_name)
+            if used_in != lib.used_in:
+                reg.update("libs", {"library_name": lib.library_name},
+                           used_in=used_in)
 
         return code
 
@@ -92,10 +95,13 @@ def delete_program(masterconf_path: str, program_name: str):
         # If there's any error, update status in program_details.csv
         print(f"Error deleting program {program_name}: {e}")
         print(traceback.format_exc())
-        put_back = pd.DataFrame({"program_name": [program_name],
-                                 "status": ["Installed (deleting with error)"]})
-        df = pd.concat([df, put_back])
-        df.to_csv(config["PRG"], index=False)
+        status = "Installed (deleting with error)"
+        if reg.find("programs", program_name=program_name) is None:
+            reg.add("programs", {"program_name": program_name,
+                                 "status": status})
+        else:
+            reg.update("programs", {"program_name": program_name},
+                       status=status)
         if os.path.isdir(masterfolder):
             with open(os.path.join(masterfolder, "install_output_and_error.log"), 'a') as logf:
                 print(f"Error deleting program {program_name}: {e}", file=logf)
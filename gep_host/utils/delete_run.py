@@ -1,10 +1,10 @@
+import json
 import os
 import subprocess
 import shutil
 import sys
 import traceback
 
-import pandas as pd
 from flask import current_app
 
 
@@ -30,23 +30,31 @@ def delete_run(masterconf_path: str, program_name: str, purpose: str):
     """
     # the price of using the same file where the deletion is initiated from python
     # and where the console script's deletion is implemented
+    from gep_host.utils.blobs import gc
     from gep_host.utils.set_conf_init import set_conf
+    from gep_host.utils.registry import get_registry
     config = {}
     set_conf(config, masterconf_path)
+    reg = get_registry(config)
 
     try:
-        files = pd.read_csv(config["FLE"], dtype=str)
         # Unregister files
         runid = f"{program_name}__{purpose}"
-        files["used_in"] = files["used_in"].apply(remove_val_from_json,
-                                                  val_2_remove=runid)
-        files.to_csv(config["FLE"], index=False)
+        run = reg.find("runs", program_name=program_name, purpose=purpose)
+        digests = None  # not recorded by earlier versions, check all
+        if run is not None and run.get("blobs"):
+            digests = json.loads(run["blobs"])
+        if run is not None:
+            reg_files = json.loads(run["registered_files"] or "{}")
+            for path in reg_files.values():
+                fname = os.path.basename(path)
+                reg_file = reg.find("files", filename=fname)
+                if reg_file is not None:
+                    used_in = remove_val_from_json(reg_file["used_in"], runid)
+                    reg.update("files", {"filename": fname}, used_in=used_in)
 
         # 1. remove run_details.csv
-        df = pd.read_csv(config["RUN"], dtype=str)
-        df = df[~((df['program_name'] == program_name)
-                & (df['purpose'] == purpose))]
-        df.to_csv(config["RUN"], index=False)
+        reg.remove("runs", program_name=program_name, purpose=purpose)
 
         # 2. remove the folder recursively
         setup_folder = os.path.join(config["RUNR"],
@@ -54,6 +62,7 @@ def delete_run(masterconf_path: str, program_name: str, purpose: str):
                                     purpose)
         remove_readonly(setup_folder)
         shutil.rmtree(setup_folder)
+        gc(config, digests)
 
         # Check if the parent folder (program folder) is empty
         program_folder = os.path.join(config["RUNR"], program_name)
@@ -71,11 +80,12 @@ def delete_run(masterconf_path: str, program_name: str, purpose: str):
         print("Error deleting program",
               f"{program_name} with purpose {purpose}: {e}")
         print(traceback.format_exc())
-        put_back = pd.DataFrame({"program_name": [program_name],
-                                 "purpose": [purpose],
-                                 "status": ["Completed (run delete error)"]})
-        df = pd.concat([df, put_back])
-        df.to_csv(config["RUN"], index=False)
+        run_id = {"program_name": program_name, "purpose": purpose}
+        if reg.find("runs", **run_id) is None:
+            reg.add("runs", {**run_id,
+                             "status": "Completed (run delete error)"})
+        else:
+            reg.update("runs", run_id, status="Completed (run delete error)")
         return 2
 
 
@@ -0,0 +1,190 @@
+"""Serve file downloads with byte ranges, validators and sendfile.
+
+The programs, the libraries, the registered files, the program inputs
+and the files of the runs are sent by ``send_download``:
+
+- a ``Range`` request gets the requested bytes with status 206, so a
+  broken download is continued where it stopped instead of starting
+  over; ``If-Range`` restarts it if the file has changed meanwhile,
+- the response has an ``ETag`` and a ``Last-Modified`` header, a request
+  with a matching ``If-None-Match`` or ``If-Modified-Since`` gets an empty
+  304 response,
+- the body is a ``FileRange``, which the gevent server of the service
+  (with ``SendfileHandler``) sends with ``os.sendfile``: the bytes go from
+  the page cache to the socket without being copied through python, in
+  blocks of ``BLOCK`` bytes, the other downloads are served in between.
+  Other servers, e.g. the one of ``--debug``, iterate it in blocks.
+
+Responses produced by blocking generators, e.g. the run archives, are
+passed through ``iter_in_threadpool``, so the hub serves the other
+requests while the next part is produced.
+"""
+import mimetypes
+import os
+import stat
+import unicodedata
+from typing import Iterable, Iterator, Optional
+from urllib.parse import quote
+
+import gevent
+from flask import Response, abort, request
+from gevent.pywsgi import WSGIHandler
+from gevent.socket import wait_write
+from gevent.ssl import SSLSocket
+
+BLOCK = 1024 * 1024  # bytes read or sent at once
+
+
+class FileRange:
+    """A byte range of a file as a WSGI response body.
+
+    The file is opened only when the body is sent, so a 304 response or a
+    HEAD request does not open it.
+    """
+
+    def __init__(self, path: str, start: int, length: int):
+        self.path = path
+        self.start = start
+        self.length = length
+
+    def __iter__(self) -> Iterator[bytes]:
+        remaining = self.length
+        with open(self.path, "rb") as ifile:
+            ifile.seek(self.start)
+            while remaining > 0:
+                data = ifile.read(min(remaining, BLOCK))
+                if not data:  # the file was truncated meanwhile
+                    break
+                remaining -= len(data)
+                yield data
+
+    def sendfile(self, sock) -> int:
+        """Send the range to a gevent socket with ``os.sendfile``.
+
+        Returns
+        -------
+        int
+            The number of bytes sent.
+        """
+        offset, end = self.start, self.start + self.length
+        with open(self.path, "rb") as ifile:
+            while offset < end:
+                try:
+                    sent = os.sendfile(sock.fileno(), ifile.fileno(), offset,
+                                       min(end - offset, BLOCK))
+                except BlockingIOError:  # the socket buffer is full
+                    wait_write(sock.fileno())
+                    continue
+                if sent == 0:  # the file was truncated meanwhile
+                    break
+                offset += sent
+        return offset - self.start
+
+
+class SendfileHandler(WSGIHandler):
+    """The gevent request handler sending ``FileRange`` bodies zero-copy."""
+
+    def process_result(self):
+        if (not isinstance(self.result, FileRange)
+                or not hasattr(os, "sendfile")
+                or isinstance(self.socket, SSLSocket)):
+            return super().process_result()
+        self.write(b"")  # the status line and the headers
+        if self.response_use_chunked:  # no Content-Length, not expected
+            return super().process_result()
+        sent = self.result.sendfile(self.socket)
+        self.response_length += sent
+        if sent < self.result.length:  # cannot keep the promised length
+            self.close_connection = True
+
+
+def iter_in_threadpool(parts: Iterable[bytes]) -> Iterator[bytes]:
+    """Yield the parts of a blocking iterable, each produced in a thread.
+
+    The parts are produced one after the other in the threadpool of the
+    gevent hub, the hub serves the other requests meanwhile. The iterable
+    is closed in the threadpool too, e.g. when the client disconnects.
+    """
+    pool = gevent.get_hub().threadpool
+    parts = iter(parts)
+    done = object()
+    try:
+        while True:
+            part = pool.spawn(next, parts, done).get()
+            if part is done:
+                return
+            yield part
+    finally:
+        close = getattr(parts, "close", None)
+        if close is not None:
+            pool.spawn(close).get()
+
+
+def _disposition(download_name: str) -> dict:
+    """Return the file name parameters of Content-Disposition."""
+    names = {"filename": download_name}
+    try:
+        download_name.encode("ascii")
+    except UnicodeEncodeError:  # RFC 2231 name with an ascii fallback
+        simple = unicodedata.normalize("NFKD", download_name)
+        names = {"filename": simple.encode("ascii", "ignore").decode("ascii"),
+                 "filename*": "UTF-8''" + quote(download_name,
+                                                safe="!#$&+^`|~")}
+    return names
+
+
+def send_download(path: Optional[str], download_name: Optional[str] = None,
+                  as_attachment: bool = False,
+                  mimetype: Optional[str] = None) -> Response:
+    """Send a file, or the requested part of it, for the current request.
+
+    Parameters
+    ----------
+    path : Optional[str]
+        The file to send; None (an unsafe path) or a missing file gives
+        404.
+    download_name : Optional[str], optional
+        The file name offered to the browser, by default the name of the
+        file.
+    as_attachment : bool, optional
+        Whether the browser should save the file instead of showing it.
+    mimetype : Optional[str], optional
+        The content type, by default guessed from download_name.
+
+    Returns
+    -------
+    Response
+        200 with the file, 206 with the requested range, 304 if the
+        client's copy is up to date or 416 if the range is outside the
+        file.
+    """
+    try:
+        fstat = os.stat(path) if path is not None else None
+    except OSError:
+        fstat = None
+    if fstat is None or not stat.S_ISREG(fstat.st_mode):
+        abort(404)
+    download_name = download_name or os.path.basename(path)
+    if mimetype is None:
+        mimetype = (mimetypes.guess_type(download_name)[0]
+                    or "application/octet-stream")
+
+    resp = Response(FileRange(path, 0, fstat.st_size), mimetype=mimetype,
+                    direct_passthrough=True)
+    resp.content_length = fstat.st_size
+    resp.last_modified = int(fstat.st_mtime)
+    # a replaced file gets a new inode, a rewritten one a new mtime
+    resp.set_etag(f"{fstat.st_mtime_ns:x}-{fstat.st_size:x}-"
+                  f"{fstat.st_ino:x}")
+    resp.cache_control.no_cache = True
+    resp.headers.set("Content-Disposition",
+                     "attachment" if as_attachment else "inline",
+                     **_disposition(download_name))
+
+    # 304, or 206 with Content-Range, or 416; If-Range is checked too
+    resp.make_conditional(request.environ, accept_ranges=True,
+                          complete_length=fstat.st_size)
+    if resp.status_code == 206:
+        rng = resp.content_range
+        resp.response = FileRange(path, rng.start, rng.stop - rng.start)
+    return resp
@@ -0,0 +1,167 @@
+"""Reuse conda environments of earlier installs with the same dependencies.
+
+Creating the conda environment of a program and installing its
+dependencies takes minutes. After a successful install the environment
+is cloned into the cache under a key computed from everything that
+determines its content: the python version, the way the dependencies are
+installed, the files declaring them (requirements.txt, setup.py,
+setup.cfg, pyproject.toml) and the selected libraries. An install with
+the same key clones the cached environment instead, which conda does
+with hardlinks to its package cache, in seconds.
+
+The cache keeps at most ``env_cache_size`` (host.cfg) environments and
+removes the least recently used one beyond that. Its index is a JSON
+file in the host root.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import subprocess
+from datetime import datetime
+from typing import Iterable
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, no locking
+    fcntl = None
+
+DEP_FILES = ["requirements.txt", "setup.py", "setup.cfg", "pyproject.toml"]
+ENV_PREFIX = "gep_env_cache_"
+
+
+def conda(cmd: str) -> bool:
+    """Run a conda command, print its output and return if it succeeded."""
+    print(cmd, flush=True)
+    proc = subprocess.run(cmd, shell=True, text=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    print(proc.stdout, flush=True)
+    return proc.returncode == 0
+
+
+@contextlib.contextmanager
+def locked_json(path: str):
+    """Yield the dict saved in a JSON file and save it back, exclusively.
+
+    The file is locked against other processes while the dict is used.
+    A missing file gives an empty dict. The dict is written to a
+    temporary file that replaces the index when complete, so a failed
+    write leaves the previous index intact.
+    """
+    with open(path + ".lock", "w") as lockf:
+        if fcntl is not None:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+        data = {}
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as ifile:
+                data = json.load(ifile)
+        yield data
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as ofile:
+                json.dump(data, ofile, indent=1)
+                ofile.flush()
+                os.fsync(ofile.fileno())
+            os.replace(path + ".tmp", path)
+        except BaseException:
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+            raise
+
+
+class EnvCache:
+    """The cache of conda environments of a host.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    """
+
+    def __init__(self, conf: dict):
+        self.index_path = conf["ENVC"]
+        self.size = conf["env_cache_size"]
+
+    def _index(self):
+        """Lock the index against other installs, yield it and save it."""
+        return locked_json(self.index_path)
+
+    @staticmethod
+    def key(masterfolder: str, python_version: str, install_cmd: str,
+            libs: Iterable[str]) -> str:
+        """Return the key of the environment of a program.
+
+        Parameters
+        ----------
+        masterfolder : str
+            The folder of the program with the files declaring its
+            dependencies.
+        python_version : str
+            The requested python version.
+        install_cmd : str
+            The command installing the dependencies.
+        libs : Iterable[str]
+            Identifiers of the selected libraries, e.g. their name and
+            upload date.
+        """
+        digest = hashlib.sha256()
+        for part in [python_version, install_cmd] + sorted(libs):
+            digest.update(part.encode("utf-8") + b"\0")
+        for fname in DEP_FILES:
+            path = os.path.join(masterfolder, fname)
+            digest.update(fname.encode("utf-8") + b"\0")
+            if os.path.isfile(path):
+                with open(path, "rb") as ifile:
+                    digest.update(hashlib.sha256(ifile.read()).digest())
+        return digest.hexdigest()
+
+    def clone(self, key: str, env_name: str) -> bool:
+        """Create env_name from the cached environment if there is one.
+
+        Returns
+        -------
+        bool
+            True if the environment is created from the cache.
+        """
+        if self.size <= 0:
+            return False
+        with self._index() as index:
+            entry = index.get(key)
+            if entry is None:
+                return False
+            entry["last_used"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            entry["hits"] = entry.get("hits", 0) + 1
+        if conda(f'conda create -y -n {env_name} --clone {entry["env"]}'):
+            return True
+        print("The cached environment cannot be cloned, "
+              "it is removed from the cache.", flush=True)
+        with self._index() as index:
+            index.pop(key, None)
+        conda(f'conda env remove -y -n {env_name}')
+        return False
+
+    def add(self, key: str, env_name: str, python_version: str) -> None:
+        """Put a copy of env_name into the cache and evict the oldest."""
+        if self.size <= 0:
+            return
+        cache_env = ENV_PREFIX + key[:16]
+        with self._index() as index:
+            if key in index:
+                return
+        if not conda(f'conda create -y -n {cache_env} --clone {env_name}'):
+            return
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._index() as index:
+            index[key] = {"env": cache_env, "python_version": python_version,
+                          "created": now, "last_used": now, "hits": 0,
+                          "source": env_name}
+            evicted = sorted(index, key=lambda k: index[k]["last_used"])
+            evicted = evicted[:max(0, len(index) - self.size)]
+            for old_key in evicted:
+                conda(f'conda env remove -y -n {index.pop(old_key)["env"]}')
+
+    def entries(self) -> dict:
+        """Return the index of the cache."""
+        if not os.path.isfile(self.index_path):
+            return {}
+        with open(self.index_path, "r", encoding="utf-8") as ifile:
+            return json.load(ifile)
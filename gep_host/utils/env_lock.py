@@ -0,0 +1,234 @@
+"""Record the environments of the programs and remove the idle ones.
+
+At the end of an install the environment of the program is locked: the
+conda packages are listed with their exact builds (``conda list
+--explicit``) and the pip packages with their versions (``pip freeze``)
+in HostRoot/env_locks/<program>. The environments of programs not run
+for ``env_idle_days`` days are removed, and if the environments take
+more than ``env_disk_budget`` GB, the least recently used ones are
+removed too (host.cfg). The next run of such a program recreates its
+environment from the lock before it starts, the conda packages from the
+package cache of conda and the pip packages from the wheelhouse when
+they are there.
+
+The registry keeps the prefix of the environment (``env_prefix``), the
+time of the last run (``last_used``) and whether the environment is
+``present``, ``evicted`` or being rebuilt (``env_state``).
+"""
+import contextlib
+import json
+import os
+import subprocess
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from .env_cache import conda
+from .registry import get_registry
+from .wheelhouse import pip_command
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, no locking
+    fcntl = None
+
+
+def lock_dir(conf: dict, program_name: str) -> str:
+    """Return the folder of the lock files of a program."""
+    return os.path.join(conf["LCKR"], program_name)
+
+
+def _output(cmd: str, cwd: Optional[str] = None) -> str:
+    """Run a command and return its output, raise if it fails."""
+    return subprocess.run(cmd, shell=True, text=True, cwd=cwd, check=True,
+                          stdout=subprocess.PIPE).stdout
+
+
+@contextlib.contextmanager
+def _locked(path: str):
+    """Keep other runs from rebuilding the same environment."""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, ".lock"), "w") as lockf:
+        if fcntl is not None:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+        yield
+
+
+def write_lock(conf: dict, program_name: str, local_install: bool,
+               lib_paths: List[str]) -> str:
+    """Record the packages of the environment of a program.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    program_name : str
+        The program, also the name of its environment.
+    local_install : bool
+        If the program itself is installed into the environment with
+        ``pip install .``.
+    lib_paths : List[str]
+        The paths of the libraries added with ``conda develop``.
+
+    Returns
+    -------
+    str
+        The prefix of the environment.
+    """
+    activate = f'{conf["activate"]}{program_name}'
+    path = lock_dir(conf, program_name)
+    os.makedirs(path, exist_ok=True)
+    explicit = _output(f'conda list -n {program_name} --explicit')
+    freeze = _output(f'{activate} && pip freeze --exclude-editable')
+    prefix = _output(f'{activate} && python -c "import sys; '
+                     'print(sys.prefix)"').strip().splitlines()[-1]
+    with open(os.path.join(path, "conda.txt"), "w") as ofile:
+        ofile.write(explicit)
+    with open(os.path.join(path, "pip.txt"), "w") as ofile:
+        # packages installed from a path or url, e.g. the program, are skipped
+        ofile.writelines(line + "\n" for line in freeze.splitlines()
+                         if "==" in line and " @ " not in line)
+    with open(os.path.join(path, "lock.json"), "w") as ofile:
+        json.dump({"local_install": local_install, "lib_paths": lib_paths},
+                  ofile, indent=1)
+    return prefix
+
+
+def rebuild_env(conf: dict, program_name: str) -> None:
+    """Recreate the evicted environment of a program from its lock.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If a step of the rebuild fails, the environment stays evicted.
+    """
+    reg = get_registry(conf)
+    prg_id = {"program_name": program_name}
+    path = lock_dir(conf, program_name)
+    with _locked(path):
+        prg = reg.find("programs", **prg_id)
+        if prg is None or prg.get("env_state") != "evicted":
+            return  # rebuilt by a run started at the same time
+        reg.update("programs", prg_id, env_state="rebuilding")
+        try:
+            with open(os.path.join(path, "lock.json"), "r") as ifile:
+                meta = json.load(ifile)
+            activate = f'{conf["activate"]}{program_name}'
+            masterfolder = os.path.join(conf["PRGR"], program_name)
+            cmds = [f'conda create -y -n {program_name} '
+                    f'--file "{os.path.join(path, "conda.txt")}"']
+            pip_lock = os.path.join(path, "pip.txt")
+            if os.path.getsize(pip_lock) > 0:
+                pip_args = f'--no-deps -r "{pip_lock}"'
+                cmds.append(f'{activate} && {pip_command(conf, pip_args)}')
+            if meta["local_install"]:
+                cmds.append(f'{activate} && pip install --no-deps .')
+            if meta["lib_paths"]:
+                cmds.append(" && ".join(
+                    [activate] + [f'conda develop "{lib_path}"'
+                                  for lib_path in meta["lib_paths"]]))
+            for cmd in cmds:
+                print(cmd, flush=True)
+                print(_output(cmd, cwd=masterfolder), flush=True)
+        except Exception:
+            conda(f'conda env remove -y -n {program_name}')
+            reg.update("programs", prg_id, env_state="evicted")
+            raise
+        reg.update("programs", prg_id, env_state="present")
+
+
+def env_size(prefix: str) -> int:
+    """Return the bytes removing the environment would free.
+
+    Files hardlinked from the package cache of conda are not counted.
+    """
+    size = 0
+    for dirpath, _, fnames in os.walk(prefix):
+        for fname in fnames:
+            try:
+                fstat = os.lstat(os.path.join(dirpath, fname))
+            except OSError:
+                continue
+            if fstat.st_nlink == 1:
+                size += fstat.st_size
+    return size
+
+
+def evict_envs(conf: dict) -> List[str]:
+    """Remove the environments idle for too long or beyond the budget.
+
+    Programs with queued or running runs are kept.
+
+    Returns
+    -------
+    List[str]
+        The programs whose environment is removed.
+    """
+    idle_days = conf["env_idle_days"]
+    budget = conf["env_disk_budget"] * 1024 ** 3
+    reg = get_registry(conf)
+    runs = reg.frame("runs")
+    busy = set(runs[~runs.status.str.startswith("Completed")].program_name)
+    prgs = reg.frame("programs", status_prefix="Installed")
+    if "env_state" not in prgs.columns:
+        return []
+    prgs = prgs[prgs.env_state == "present"]
+    candidates = sorted(prgs.itertuples(),
+                        key=lambda prg: prg.last_used or prg.upload_date)
+    sizes = {prg.program_name: env_size(prg.env_prefix)
+             for prg in candidates if budget > 0 and prg.env_prefix}
+    total = sum(sizes.values())
+    limit = datetime.now() - timedelta(days=idle_days)
+    evicted = []
+    for prg in candidates:
+        if prg.program_name in busy or not os.path.isfile(
+                os.path.join(lock_dir(conf, prg.program_name), "lock.json")):
+            continue
+        last_used = datetime.strptime(prg.last_used or prg.upload_date,
+                                      '%Y-%m-%d %H:%M:%S')
+        idle = idle_days > 0 and last_used < limit
+        over = budget > 0 and total > budget
+        if not idle and not over:
+            continue
+        if conda(f'conda env remove -y -n {prg.program_name}'):
+            reg.update("programs", {"program_name": prg.program_name},
+                       env_state="evicted")
+            total -= sizes.get(prg.program_name, 0)
+            evicted.append(prg.program_name)
+    return evicted
+
+
+class EnvEvictor:
+    """Check the environments in a background thread of the service."""
+
+    def __init__(self, conf: dict, interval: float = 3600):
+        self.conf = conf
+        self.interval = interval
+        self.thread = threading.Thread(target=self._loop, daemon=True,
+                                       name="env-evictor")
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                evicted = evict_envs(self.conf)
+                if evicted:
+                    print("The environments of these programs are removed: "
+                          f"{', '.join(evicted)}", flush=True)
+            except Exception as err:
+                print(f"The environments could not be checked: {err}",
+                      flush=True)
+            time.sleep(self.interval)
+
+
+_evictor: Optional[EnvEvictor] = None
+
+
+def start_env_eviction(conf: dict) -> Optional[EnvEvictor]:
+    """Start removing the idle environments if a limit is set."""
+    global _evictor
+    if _evictor is None and (conf["env_idle_days"] > 0
+                             or conf["env_disk_budget"] > 0):
+        _evictor = EnvEvictor(conf)
+        _evictor.thread.start()
+    return _evictor
@@ -0,0 +1,174 @@
+"""Keep blank conda environments ready for the next installs.
+
+Every install that cannot reuse a cached environment starts with
+creating a blank one with python and conda-build, which means solving
+and linking the same packages each time. The pool creates these blank
+environments in advance, ``env_pool`` in host.cfg sets how many for
+which python version, e.g. ``3.10:2, 3.11:1``. An install claims one from
+the pool, takes it over under the name of the program and the service
+creates a new one in the background.
+
+The state of the pool and the number of hits and misses of each python
+version are kept in a JSON file in the host root.
+"""
+import threading
+import time
+from typing import Dict, Optional
+
+from .env_cache import conda, locked_json
+
+ENV_PREFIX = "gep_env_pool_"
+
+
+def parse_pool_sizes(setting: str) -> Dict[str, int]:
+    """Parse the env_pool setting, ``version:size`` items separated by commas.
+
+    Raises
+    ------
+    ValueError
+        If an item is not a version and a size.
+    """
+    sizes = {}
+    for item in setting.split(","):
+        if item.strip() == "":
+            continue
+        version, _, size = item.partition(":")
+        if not version.strip().replace(".", "").isdigit():
+            raise ValueError(f"Invalid python version in env_pool: {item}")
+        sizes[version.strip()] = int(size)
+    return sizes
+
+
+class EnvPool:
+    """The pool of blank conda environments of a host.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    """
+
+    def __init__(self, conf: dict):
+        self.index_path = conf["ENVP"]
+        self.sizes = conf["env_pool"]
+
+    def _index(self):
+        """Lock the state against other processes, yield it and save it."""
+        return locked_json(self.index_path)
+
+    @staticmethod
+    def blank_env_cmd(env_name: str, python_version: str) -> str:
+        """Return the command creating the blank environment of an install."""
+        return (f'conda create -y -n {env_name} '
+                f'python={python_version} conda-build')
+
+    def claim(self, python_version: str, env_name: str) -> bool:
+        """Take over a ready environment of the pool as env_name.
+
+        The environment is removed from the pool before it is renamed, so
+        two installs cannot claim the same one.
+
+        Returns
+        -------
+        bool
+            True if env_name is created from the pool.
+        """
+        with self._index() as index:
+            ready = index.setdefault("ready", {}).get(python_version, [])
+            stats = index.setdefault("stats", {}).setdefault(
+                python_version, {"hits": 0, "misses": 0})
+            pool_env = ready.pop(0) if ready else None
+            stats["hits" if pool_env else "misses"] += 1
+        if pool_env is None:
+            return False
+        # conda envs cannot be moved, renaming clones with hardlinks
+        if conda(f'conda create -y -n {env_name} --clone {pool_env}'):
+            conda(f'conda env remove -y -n {pool_env}')
+            return True
+        conda(f'conda env remove -y -n {env_name}')
+        conda(f'conda env remove -y -n {pool_env}')
+        return False
+
+    def refill(self) -> None:
+        """Create the environments missing from the pool, one at a time."""
+        while True:
+            with self._index() as index:
+                ready = index.setdefault("ready", {})
+                creating = index.setdefault("creating", {})
+                missing = [ver for ver, size in self.sizes.items()
+                           if len(ready.get(ver, [])) + sum(
+                               1 for v in creating.values() if v == ver)
+                           < size]
+                if not missing:
+                    return
+                version = missing[0]
+                pool_env = (f'{ENV_PREFIX}{version.replace(".", "_")}_'
+                            f'{int(time.time() * 1000)}')
+                creating[pool_env] = version
+            created = conda(self.blank_env_cmd(pool_env, version))
+            with self._index() as index:
+                index["creating"].pop(pool_env, None)
+                if created:
+                    index["ready"].setdefault(version, []).append(pool_env)
+            if not created:
+                conda(f'conda env remove -y -n {pool_env}')
+                print(f"The pool env of python {version} cannot be created.",
+                      flush=True)
+                return
+
+    def recover(self) -> None:
+        """Remove the environments left half-created by a stopped service."""
+        with self._index() as index:
+            abandoned = list(index.pop("creating", {}))
+        for pool_env in abandoned:
+            conda(f'conda env remove -y -n {pool_env}')
+
+    def state(self) -> Dict[str, Dict[str, int]]:
+        """Return the size, ready, hits and misses of each python version."""
+        with self._index() as index:
+            ready = index.get("ready", {})
+            stats = index.get("stats", {})
+            creating = index.get("creating", {})
+        state = {}
+        for ver in sorted(set(self.sizes) | set(ready) | set(stats)):
+            state[ver] = {"size": self.sizes.get(ver, 0),
+                          "ready": len(ready.get(ver, [])),
+                          "creating": sum(1 for v in creating.values()
+                                          if v == ver),
+                          **stats.get(ver, {"hits": 0, "misses": 0})}
+        return state
+
+
+class PoolFiller:
+    """Refill the pool in a background thread of the service.
+
+    The installs run in their own processes, so the thread checks the
+    pool every interval seconds instead of being notified.
+    """
+
+    def __init__(self, conf: dict, interval: float = 30):
+        self.pool = EnvPool(conf)
+        self.interval = interval
+        self.thread = threading.Thread(target=self._loop, daemon=True,
+                                       name="env-pool")
+
+    def _loop(self) -> None:
+        self.pool.recover()
+        while True:
+            try:
+                self.pool.refill()
+            except Exception as err:
+                print(f"The env pool could not be refilled: {err}", flush=True)
+            time.sleep(self.interval)
+
+
+_filler: Optional[PoolFiller] = None
+
+
+def start_env_pool(conf: dict) -> Optional[PoolFiller]:
+    """Start refilling the pool of this process if env_pool is set."""
+    global _filler
+    if _filler is None and conf["env_pool"]:
+        _filler = PoolFiller(conf)
+        _filler.thread.start()
+    return _filler
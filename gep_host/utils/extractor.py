@@ -0,0 +1,225 @@
+"""Extract archives in a single pass with bounded memory.
+
+zip, tar (plain, gz, bz2, xz) and tar.zst archives are extracted, the
+format is recognised from the first bytes. The members are written
+through buffers of ``BLOCK`` bytes, so the memory usage does not depend
+on the size of the archive or of its members.
+
+- tar archives are read as one stream, member after member. If all
+  members are in a single top folder, the folder is stripped. This is
+  decided lazily: the members are written stripped as long as they are
+  in the top folder of the first one, and what is written is moved into
+  that folder when a member outside it shows up.
+- zip archives are extracted as they are, without stripping. Their
+  members are compressed one by one, so the members larger than
+  ``PARALLEL_SIZE`` are extracted in parallel threads (zlib releases the
+  GIL while decompressing), the others in the order they are stored.
+
+Members with an absolute path or ``..`` in it, and links or writes
+leading outside the target folder are rejected with a ValueError.
+"""
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, List, Optional, Set, Union
+
+try:
+    import zstandard
+except ImportError:  # optional, tar.zst archives cannot be extracted
+    zstandard = None
+
+BLOCK = 1024 * 1024  # bytes written at once
+PARALLEL_SIZE = 16 * 1024 * 1024  # zip members extracted in a thread
+ZIP_MAGIC = (b"PK\x03\x04", b"PK\x05\x06")
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _parts(name: str) -> List[str]:
+    """Split a member name into path components, reject unsafe names."""
+    name = name.replace("\\", "/")
+    if name.startswith("/") or re.match(r"[A-Za-z]:", name):
+        raise ValueError(f"The archive member {name} has an absolute path.")
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise ValueError(f"The archive member {name} points outside the "
+                         "target folder.")
+    return parts
+
+
+def _inside(dest: str, path: str) -> bool:
+    """Tell if path, with its links resolved, is in the folder dest."""
+    real = os.path.realpath(path)
+    return real == dest or real.startswith(dest + os.sep)
+
+
+def _target(dest: str, parts: List[str]) -> str:
+    """Return the path of a member, check that it is written into dest."""
+    path = os.path.join(dest, *parts)
+    if not _inside(dest, os.path.dirname(path)) or os.path.islink(path):
+        raise ValueError(f"The archive member {'/'.join(parts)} leads "
+                         "outside the target folder.")
+    return path
+
+
+def _copy(src: BinaryIO, path: str, mode: Optional[int] = None,
+          mtime: Optional[float] = None) -> None:
+    """Write a member to path in blocks."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as ofile:
+        shutil.copyfileobj(src, ofile, BLOCK)
+    if mode is not None:
+        os.chmod(path, mode)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def _unstrip(dest: str, root: Optional[str], written: Set[str]) -> None:
+    """Move what was written with the top folder stripped into it."""
+    if root is None or not written:
+        return
+    tmp = tempfile.mkdtemp(dir=dest)
+    for name in written:
+        os.rename(os.path.join(dest, name), os.path.join(tmp, name))
+    os.rename(tmp, os.path.join(dest, root))
+    os.chmod(os.path.join(dest, root), 0o755)
+
+
+def extract_tar(fileobj: BinaryIO, dest: str) -> None:
+    """Extract a tar stream into dest, stripping a common top folder."""
+    dest = os.path.realpath(dest)
+    root = None  # the stripped top folder
+    stripping = True
+    written: Set[str] = set()
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tfile:
+        for member in tfile:
+            parts = _parts(member.name)
+            if not parts:
+                continue
+            if stripping:
+                if root in (None, parts[0]) and (len(parts) > 1
+                                                 or member.isdir()):
+                    root = parts[0]
+                    parts = parts[1:]
+                    if not parts:  # the top folder itself
+                        continue
+                    written.add(parts[0])
+                else:  # not a common top folder
+                    _unstrip(dest, root, written)
+                    stripping = False
+            path = _target(dest, parts)
+            if member.isdir():
+                os.makedirs(path, exist_ok=True)
+            elif member.isfile():
+                _copy(tfile.extractfile(member), path, member.mode & 0o777,
+                      member.mtime)
+            elif member.issym():
+                link = os.path.join(os.path.dirname(path), member.linkname)
+                if os.path.isabs(member.linkname) or not _inside(dest, link):
+                    raise ValueError(f"The link {member.name} points outside "
+                                     "the target folder.")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.symlink(member.linkname, path)
+            elif member.islnk():  # to a member written before
+                link_parts = _parts(member.linkname)
+                if stripping and link_parts[:1] == [root]:
+                    link_parts = link_parts[1:]
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.link(_target(dest, link_parts), path)
+            # devices and fifos are skipped
+
+
+def _extract_member(archive: str, name: str, path: str) -> None:
+    """Extract a zip member with its own handle of the archive."""
+    with zipfile.ZipFile(archive) as zfile, zfile.open(name) as src:
+        _copy(src, path)
+
+
+def extract_zip(archive: Union[str, BinaryIO], dest: str,
+                workers: Optional[int] = None) -> None:
+    """Extract a zip archive into dest, the large members in parallel.
+
+    Parameters
+    ----------
+    archive : Union[str, BinaryIO]
+        The path of the archive, or the archive opened; the members of an
+        opened archive are extracted one after the other.
+    dest : str
+        The target folder.
+    workers : Optional[int], optional
+        The number of threads for the large members, by default the CPU
+        count.
+    """
+    dest = os.path.realpath(dest)
+    workers = workers or os.cpu_count() or 1
+    with zipfile.ZipFile(archive) as zfile, \
+            ThreadPoolExecutor(workers) as pool:
+        futures = []
+        for info in sorted(zfile.infolist(), key=lambda i: i.header_offset):
+            parts = _parts(info.filename)
+            if not parts:
+                continue
+            path = _target(dest, parts)
+            if info.is_dir():
+                os.makedirs(path, exist_ok=True)
+            elif info.file_size >= PARALLEL_SIZE and isinstance(archive, str):
+                futures.append(pool.submit(_extract_member, archive,
+                                           info.filename, path))
+            else:
+                with zfile.open(info) as src:
+                    _copy(src, path)
+        for future in futures:
+            future.result()
+
+
+def extract(archive: Union[str, BinaryIO], dest: str,
+            workers: Optional[int] = None) -> bool:
+    """Extract a zip, tar or tar.zst archive into the folder dest.
+
+    Parameters
+    ----------
+    archive : Union[str, BinaryIO]
+        The path of the archive, or the archive opened in binary mode.
+    dest : str
+        The target folder, created if missing.
+    workers : Optional[int], optional
+        The number of threads extracting the large zip members.
+
+    Returns
+    -------
+    bool
+        False if the archive is not in a known format.
+
+    Raises
+    ------
+    ValueError
+        If a member would be written outside dest.
+    ImportError
+        If the archive is tar.zst and the zstandard package is missing.
+    """
+    os.makedirs(dest, exist_ok=True)
+    ifile = open(archive, "rb") if isinstance(archive, str) else archive
+    try:
+        head = ifile.read(512 + 265)
+        ifile.seek(-len(head), os.SEEK_CUR)
+        if head[:4] in ZIP_MAGIC:
+            extract_zip(archive, dest, workers)
+        elif head[:4] == ZSTD_MAGIC:
+            if zstandard is None:
+                raise ImportError("tar.zst archives need the zstandard "
+                                  "package.")
+            dctx = zstandard.ZstdDecompressor()
+            with dctx.stream_reader(ifile, read_size=BLOCK) as reader:
+                extract_tar(reader, dest)
+        elif (head[:2] == b"\x1f\x8b" or head[:3] == b"BZh"
+              or head[:6] == b"\xfd7zXZ\x00" or head[257:262] == b"ustar"):
+            extract_tar(ifile, dest)
+        else:
+            return False
+    finally:
+        if ifile is not archive:
+            ifile.close()
+    return True
@@ -0,0 +1,120 @@
+"""Get the files of git sourced programs through local mirrors.
+
+Each remote repository is kept as a bare mirror in the git_mirrors
+folder of the host root. The first install from a remote clones it, the
+later ones only fetch what is new. The program folder is then created
+from the mirror with only the requested commit: a repository is
+initialised in the program folder and the commit is fetched with depth
+1, so neither the history nor a temporary copy of the files is written.
+Submodules are fetched with depth 1 from their own remotes.
+"""
+import contextlib
+import hashlib
+import os
+import re
+from datetime import datetime
+from typing import Dict, List
+
+import git
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, no locking
+    fcntl = None
+
+
+def mirror_path(conf: dict, url: str) -> str:
+    """Return the folder of the mirror of a remote repository."""
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_",
+                  os.path.basename(url.rstrip("/")))
+    if not name.endswith(".git"):
+        name += ".git"
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(conf["GITM"], f"{digest}-{name}")
+
+
+@contextlib.contextmanager
+def _locked(path: str):
+    """Keep other installs from using the mirror at the same time."""
+    with open(path + ".lock", "w") as lockf:
+        if fcntl is not None:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+        yield
+
+
+def update_mirror(path: str, url: str) -> git.Repo:
+    """Clone the remote into the mirror or fetch what is new."""
+    if os.path.isdir(path):
+        mirror = git.Repo(path)
+        mirror.git.fetch("--prune", "origin")
+    else:
+        mirror = git.Repo.clone_from(url, path, mirror=True)
+    # let the program folders fetch any commit, not only the branch heads
+    with mirror.config_writer() as config:
+        config.set_value("uploadpack", "allowAnySHA1InWant", "true")
+    return mirror
+
+
+def export_ref(conf: dict, url: str, ref: str, dest: str) -> str:
+    """Put the files of a commit of a remote repository into dest.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    url : str
+        The remote repository, any URL git understands, e.g. file://.
+    ref : str
+        A branch, a tag or a (short) commit hash.
+    dest : str
+        The program folder, it may contain files not in the repository.
+
+    Returns
+    -------
+    str
+        The full hash of the commit.
+    """
+    os.makedirs(conf["GITM"], exist_ok=True)
+    path = mirror_path(conf, url)
+    with _locked(path):
+        mirror = update_mirror(path, url)
+        sha = mirror.git.rev_parse("--verify", f"{ref}^{{commit}}")
+        repo = git.Repo.init(dest)
+        repo.git.fetch("--depth", "1", f"file://{os.path.abspath(path)}", sha)
+    repo.git.checkout("-q", "FETCH_HEAD")
+    # relative submodule URLs are resolved against the real remote
+    repo.git.remote("add", "origin", url)
+    if os.path.isfile(os.path.join(dest, ".gitmodules")):
+        cmd = repo.git
+        if url.startswith("file://") or os.path.isdir(url):
+            # git refuses local submodules unless the source is local too
+            cmd = repo.git(c="protocol.file.allow=always")
+        try:
+            cmd.submodule("update", "--init", "--recursive", "--depth", "1")
+        except git.GitCommandError:  # the remote refuses unadvertised commits
+            cmd.submodule("update", "--init", "--recursive")
+    return sha
+
+
+def mirrors(conf: dict) -> List[Dict[str, str]]:
+    """Return the remote URL, folder, size and last fetch of each mirror."""
+    found = []
+    if not os.path.isdir(conf["GITM"]):
+        return found
+    for name in sorted(os.listdir(conf["GITM"])):
+        path = os.path.join(conf["GITM"], name)
+        if not os.path.isdir(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(dirpath, fname))
+                   for dirpath, _, fnames in os.walk(path)
+                   for fname in fnames)
+        with git.Repo(path).config_reader() as config:
+            url = config.get_value('remote "origin"', "url", "")
+        fetched = os.path.join(path, "FETCH_HEAD")
+        if not os.path.isfile(fetched):  # not fetched since the clone
+            fetched = path
+        found.append({"name": name, "url": url, "size": size,
+                      "fetched": datetime.fromtimestamp(
+                          os.path.getmtime(fetched)).strftime(
+                              '%Y-%m-%d %H:%M:%S')})
+    return found
@@ -1,11 +1,14 @@
+from __future__ import annotations
+
 import os
+import stat
 import subprocess
 from datetime import datetime
 import json
-import zipfile
-import tarfile
+from typing import TYPE_CHECKING
 
-import pandas as pd
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 def alnum(name, extra_allowed="_"):
@@ -18,18 +21,33 @@ def safer_call(name):
 
 def concat_to(new_entry: pd.DataFrame, filename: str) -> None:
     """Add new entry/entries to file, create if doesn't exist."""
+    import pandas as pd
     old_entries = pd.read_csv(filename)
     runs = pd.concat([old_entries, new_entry], ignore_index=True)
     runs.to_csv(filename, index=False)
 
 
 def remove_readonly(path):
-    """Recursively remove read-only attributes from files and directories."""
+    """Recursively remove read-only attributes from files and directories.
+
+    Only the write permission is added, the other bits (e.g. execute)
+    are kept. Files hardlinked from another folder (the read-only links
+    to the blob store, see blobs.store_file) are left read-only on POSIX
+    systems, where they can be deleted anyway, so that the shared content
+    stays protected.
+    """
     for root, dirs, files in os.walk(path):
         for name in files:
-            os.chmod(os.path.join(root, name), 0o666)
+            fpath = os.path.join(root, name)
+            fstat = os.lstat(fpath)
+            if stat.S_ISLNK(fstat.st_mode):
+                continue
+            if os.name == "nt" or fstat.st_nlink == 1:
+                os.chmod(fpath, fstat.st_mode | stat.S_IWUSR)
         for name in dirs:
-            os.chmod(os.path.join(root, name), 0o777)
+            dpath = os.path.join(root, name)
+            if not os.path.islink(dpath):
+                os.chmod(dpath, os.stat(dpath).st_mode | stat.S_IWUSR)
 
 
 def remove_val_from_json(json_str, val_2_remove):
@@ -42,10 +60,12 @@ def extract_file(file_data, extract_path) -> bool:
     """
     Extracts the contents of a zip or tar file to the specified directory.
 
+    The archive is read in a single pass, see ``extractor.extract``.
+
     Parameters
     ----------
     file_data : str
-        The path to the zip or tar file.
+        The path to the zip, tar.gz or tar.zst file, or the file opened.
     extract_path : str
         The directory where the contents will be extracted.
 
@@ -54,27 +74,8 @@ def extract_file(file_data, extract_path) -> bool:
     bool
         True if the extraction is successful, False otherwise.
     """
-    if zipfile.is_zipfile(file_data):
-        with zipfile.ZipFile(file_data) as zf:
-            zf.extractall(extract_path)
-    elif tarfile.is_tarfile(file_data):
-        with tarfile.open(file_data, 'r:*') as tf:
-            members = tf.getmembers()
-            # Check if there is only one root directory
-            root_dirs = {m.name.split('/')[0]
-                         for m in members if '/' in m.name}
-            if len(root_dirs) == 1:
-                root_dir = root_dirs.pop() + '/'
-                for member in members:
-                    if member.name.startswith(root_dir):
-                        # Remove the root directory from the path
-                        member.name = member.name[len(root_dir):]
-                        tf.extract(member, extract_path)
-            else:
-                tf.extractall(extract_path)
-    else:
-        return False
-    return True
+    from gep_host.utils.extractor import extract
+    return extract(file_data, extract_path)
 
 
 def get_orig_fname(zip_fname: str) -> str:
@@ -93,6 +94,8 @@ def get_orig_fname(zip_fname: str) -> str:
     """
     if zip_fname.endswith(".zip"):
         orig_fname = zip_fname[:-19] + zip_fname[-4:]  # remove timestamp
+    elif zip_fname.endswith(".tar.zst"):
+        orig_fname = zip_fname[:-23] + zip_fname[-8:]
     else:
         orig_fname = zip_fname[:-22] + zip_fname[-7:]
     return orig_fname
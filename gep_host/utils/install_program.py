@@ -7,12 +7,9 @@ from datetime import datetime
 from configparser import ConfigParser, ExtendedInterpolation
 from typing import Union, List, Dict, Tuple
 import traceback
-import shutil
 import re
-import tempfile
-
-import pandas as pd
-import git
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 def init_install(program_name: str,
@@ -44,55 +41,84 @@ def init_install(program_name: str,
         0 if success, warning message otherwise.
     """
     from flask import current_app
-    # trigger the installation
-    selected_libs_str = ""
-    if opt_args[0]:
-        selected_libs_str = "--list-of-libs " + " ".join(opt_args[0])
+    from .registry import get_registry, new_event
+    from .scheduler import get_install_scheduler
     masterfolder = os.path.join(current_app.config["PRGR"], program_name)
     os.makedirs(masterfolder)
     if git_source == {}:
-        source = program_zip_path
-        s_extra = ""
         source_rep = "file upload"
     else:
-        source = git_source["git-source-url"]
-        s_extra = f' -s {git_source["git-source-ref"]}'
         source_rep = " ".join(git_source.values())
-    exe_test = ""
-    if opt_args[2] != "":
-        exe_test = f' -t "{opt_args[2]}"'
-    cmd = (f'python {__file__} {current_app.config["masterconf_path"]} {program_name} {source} '
-           f'{python_version} {selected_libs_str} {s_extra} {exe_test}')
-    with open(os.path.join(masterfolder,
-                           "install_output_and_error.log"), 'w') as logf:
-        proc = subprocess.Popen(cmd, shell=True,
-                                stdout=logf, stderr=logf)
 
     # Update program details CSV
-    new_entry = pd.DataFrame({
-        'program_name': [program_name],
-        'upload_date': [datetime.now().strftime('%Y-%m-%d %H:%M:%S')],
-        'python_version': [python_version],
-        'status': ['installing'],
-        'PID': [proc.pid],
-        'zip_fname': [program_zip_path],
-        'selected_libs': [" ".join(opt_args[0])],
-        'def_args': [opt_args[1]],
-        'exe_test': [opt_args[2]],
-        'source': [source_rep],
+    new_entry = {
+        'program_name': program_name,
+        'upload_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python_version': python_version,
+        'status': 'installing',
+        'PID': '',
+        'zip_fname': program_zip_path,
+        'selected_libs': " ".join(opt_args[0]),
+        'def_args': opt_args[1],
+        'exe_test': opt_args[2],
+        'source': source_rep,
         'inputs': json.dumps({}),
         'outputs': json.dumps({}),
         'version': json.dumps({}),
-        'readme': [""]
-    })
-    df = pd.read_csv(current_app.config["PRG"], dtype=str)
-    if len(df[df['program_name'] == program_name]) == 0:
-        df = pd.concat([df, new_entry], ignore_index=True)
-        df.to_csv(current_app.config["PRG"], index=False)
+        'readme': "",
+        'stages': json.dumps({stage: "pending" for stage in STAGES})
+    }
+    reg = get_registry(current_app.config)
+    if reg.find("programs", program_name=program_name) is None:
+        reg.add("programs", new_entry)
+        reg.append_event(new_event("programs", {"program_name": program_name},
+                                   'installing'))
+
+    # queue the install in the scheduler of the service if there is one
+    log_path = os.path.join(masterfolder, "install_output_and_error.log")
+    scheduler = get_install_scheduler()
+    if scheduler is not None:
+        with open(log_path, 'w') as logf:
+            now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            print(f"{now_str} The install is queued.", file=logf)
+        scheduler.submit(program_name)
+    else:  # trigger the installation
+        cmd = install_command(current_app.config, new_entry)
+        with open(log_path, 'w') as logf:
+            proc = subprocess.Popen(cmd, shell=True,
+                                    stdout=logf, stderr=logf)
+        reg.update("programs", {"program_name": program_name}, PID=proc.pid)
 
     return 0
 
 
+def install_command(conf: dict, prg: Dict[str, str]) -> str:
+    """Return the command installing a registered program.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    prg : Dict[str, str]
+        The row of the program in the registry.
+    """
+    selected_libs_str = ""
+    if prg["selected_libs"]:
+        selected_libs_str = "--list-of-libs " + prg["selected_libs"]
+    if prg["source"] == "file upload":
+        source = prg["zip_fname"]
+        s_extra = ""
+    else:
+        source, ref = prg["source"].split(" ", 1)
+        s_extra = f' -s {ref}'
+    exe_test = ""
+    if prg["exe_test"] != "":
+        exe_test = f' -t "{prg["exe_test"]}"'
+    return (f'python {__file__} {conf["masterconf_path"]} '
+            f'{prg["program_name"]} {source} {prg["python_version"]} '
+            f'{selected_libs_str} {s_extra} {exe_test}')
+
+
 def run_and_verify(cmd: str, cwd=None):
     print(cmd)
     proc = subprocess.run(cmd, cwd=cwd, shell=True, text=True,
@@ -174,8 +200,10 @@ def update_status(app_conf: Dict[str, str],
                   required_libs: List[str],
                   test_command: Union[str, None]) -> str:
     from helpers import get_orig_fname
-    df = pd.read_csv(app_conf["PRG"], dtype=str)
-    if len(df[df['program_name'] == program_name]) == 0:  # initialize the entry
+    from gep_host.utils.registry import get_registry
+    reg = get_registry(app_conf)
+    prg = reg.find("programs", program_name=program_name)
+    if prg is None:  # initialize the entry
         selected_libs_str = ""
         if required_libs:
             selected_libs_str = "--list-of-libs " + " ".join(required_libs)
@@ -186,37 +214,106 @@ def update_status(app_conf: Dict[str, str],
             nowstr = datetime.now().strftime('%Y%m%d%H%M%S')
             program_zip_path = f"{program_name}_{nowstr}.zip"
             source_rep = " ".join(program_source)
-        new_entry = pd.DataFrame({
-            'program_name': [program_name],
-            'upload_date': [datetime.now().strftime('%Y-%m-%d %H:%M:%S')],
-            'python_version': [required_python_version],
-            'status': [""],
-            'PID': [os.getpid()],
-            'zip_fname': [program_zip_path],
-            'selected_libs': [selected_libs_str],
-            'def_args': [""],
-            'exe_test': [test_command if test_command else ""],
-            'source': [source_rep],
+        new_entry = {
+            'program_name': program_name,
+            'upload_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'python_version': required_python_version,
+            'status': "",
+            'PID': os.getpid(),
+            'zip_fname': program_zip_path,
+            'selected_libs': selected_libs_str,
+            'def_args': "",
+            'exe_test': test_command if test_command else "",
+            'source': source_rep,
             'inputs': json.dumps({}),
             'outputs': json.dumps({}),
             'version': json.dumps({})
-        })
-        df = pd.concat([df, new_entry], ignore_index=True, axis=0)
+        }
+        reg.add("programs", new_entry)
     else:
-        program_zip_path = df.loc[df['program_name']
-                                  == program_name, 'zip_fname'].values[0]
-    df.loc[df['program_name'] == program_name,
-           'status'] = 'getting the files'
-    df.to_csv(app_conf["PRG"], index=False)
+        program_zip_path = prg['zip_fname']
+    reg.set_status("programs", {"program_name": program_name},
+                   'getting the files')
     program_zip_fpath = os.path.join(app_conf["PRGR"], program_zip_path)
     return program_zip_fpath
 
 
 def clean_up_install(app_conf: Dict[str, str], program_name: str, code: int):
-    df = pd.read_csv(app_conf["PRG"], dtype=str)
-    df.loc[df['program_name'] == program_name, 'status'] =\
-        f'Installed with error ({code})'
-    df.to_csv(app_conf["PRG"], index=False)
+    from gep_host.utils.registry import get_registry
+    get_registry(app_conf).set_status("programs",
+                                      {"program_name": program_name},
+                                      f'Installed with error ({code})')
+
+
+STAGES = ["files", "env", "packages", "libs", "archive"]
+
+
+class InstallStages:
+    """Report the state of each stage of an install to the registry.
+
+    Some stages run at the same time, the status of the program lists
+    the messages of all running stages, the ``stages`` column holds the
+    state of each of them: pending, running, done or failed.
+    """
+
+    def __init__(self, reg, prg_id: Dict[str, str]):
+        self.reg = reg
+        self.prg_id = prg_id
+        self.states = {stage: "pending" for stage in STAGES}
+        self.messages: Dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def _set(self, stage: str, state: str, status: str = "") -> None:
+        with self.lock:
+            self.states[stage] = state
+            if state == "running":
+                self.messages[stage] = status
+            else:
+                self.messages.pop(stage, None)
+            status = ", ".join(self.messages.values()) or status
+            if status:
+                self.reg.set_status("programs", self.prg_id, status,
+                                    stages=json.dumps(self.states))
+            else:
+                self.reg.update("programs", self.prg_id,
+                                stages=json.dumps(self.states))
+
+    def start(self, stage: str, status: str) -> None:
+        self._set(stage, "running", status)
+
+    def done(self, stage: str) -> None:
+        self._set(stage, "done")
+
+    def fail(self) -> None:
+        """Mark the running stages failed."""
+        for stage, state in list(self.states.items()):
+            if state == "running":
+                self._set(stage, "failed")
+
+
+def create_blank_env(app_conf: Dict[str, str], program_name: str,
+                     python_version: str, stages: InstallStages) -> None:
+    """Create the conda env of the program with python only, from the pool
+    if possible."""
+    from gep_host.utils.env_pool import EnvPool
+    stages.start("env", 'creating conda env')
+    if not EnvPool(app_conf).claim(python_version, program_name):
+        run_and_verify(EnvPool.blank_env_cmd(program_name, python_version))
+    stages.done("env")
+
+
+def prepare_env(app_conf: Dict[str, str], program_name: str,
+                python_version: str, env_cache, cache_key: str,
+                stages: InstallStages) -> bool:
+    """Clone the cached conda env of the key, or create a blank env if
+    it is not cached. Return True if the env is cloned from the cache."""
+    if cache_key in env_cache.entries():
+        stages.start("env", 'cloning cached conda env')
+        if env_cache.clone(cache_key, program_name):
+            stages.done("env")
+            return True
+    create_blank_env(app_conf, program_name, python_version, stages)
+    return False
 
 
 def install_program(masterconf_path: str,
@@ -226,9 +323,22 @@ def install_program(masterconf_path: str,
                     required_libs: List[str],
                     test_args: Union[str, None]) -> None:
     from gep_host.utils.set_conf_init import set_conf
+    from gep_host.utils.registry import get_registry
+    from gep_host.utils.archiver import make_archive
+    from gep_host.utils.env_cache import EnvCache
+    from gep_host.utils.env_lock import write_lock
+    from gep_host.utils.launch import resolve_launch
+    from gep_host.utils.git_mirror import export_ref
+    from gep_host.utils.wheelhouse import fill as fill_wheelhouse, pip_command
     from helpers import extract_file
     app_conf = {}
     set_conf(app_conf, masterconf_path)
+    reg = get_registry(app_conf)
+    prg_id = {"program_name": program_name}
+    stages = InstallStages(reg, prg_id)
+    # the conda env is cloned from the cache or created blank while the
+    # config and the versions of the program are read
+    env_pool = ThreadPoolExecutor(1)
 
     try:
         # 1. Update status in program_details.csv
@@ -236,36 +346,44 @@ def install_program(masterconf_path: str,
             app_conf, program_source, required_libs, test_args)
 
         # 2. get the files and version info
+        stages.start("files", 'getting the files')
         masterfolder = os.path.join(app_conf["PRGR"], program_name)
         # Extract zip to the masterfolder
         if isinstance(program_source, str):
             if not extract_file(prg_zip_fpath, masterfolder):
                 print(f"Error: failed to extract the file {prg_zip_fpath}")
 
-        # or git clone and checkout
+        # or fetch the commit from the local mirror of the repo
         else:
-            tmpdir = tempfile.mkdtemp()
-            try:
-                repo = git.Repo.clone_from(program_source[0], tmpdir)
-
-                # Initialize and update all submodules
-                for submodule in repo.submodules:
-                    submodule.update(init=True)
+            sha = export_ref(app_conf, program_source[0], program_source[1],
+                             masterfolder)
+            print(f"{program_source[1]} is checked out at commit {sha}")
 
-                # Checkout to the desired state
-                repo.git.checkout(program_source[1])
-
-                # Copy contents of the temporary directory into masterfolder
-                for item in os.listdir(tmpdir):
-                    s = os.path.join(tmpdir, item)
-                    d = os.path.join(masterfolder, item)
-                    if os.path.isdir(s):
-                        shutil.copytree(s, d, dirs_exist_ok=True)
-                    else:
-                        shutil.copy2(s, d)
-            finally:
-                # Explicitly attempt to delete the temporary directory
-                shutil.rmtree(tmpdir, ignore_errors=True)
+        # the cache key depends on the dependency files, the cache is
+        # looked up before a blank env is created for nothing
+        activate_env_command = f'{app_conf["activate"]}{program_name}'
+        if os.path.isfile(os.path.join(masterfolder, "setup.py")) and \
+            (test_args is None or
+             not os.path.isfile(os.path.join(masterfolder, "requirements.txt"))):
+            print("setup.py is found")
+            pip_install_command = ' && pip install .'
+            pip_args = '.'
+        elif os.path.isfile(os.path.join(masterfolder, "requirements.txt")):
+            print("requirements.txt is found")
+            pip_install_command = ' && pip install -r requirements.txt'
+            pip_args = '-r requirements.txt'
+        else:
+            pip_install_command = ""
+            pip_args = ""
+        lib_ids = [f"{lib.library_name} {lib.upload_date}"
+                   for lib in reg.frame("libs").itertuples()
+                   if lib.library_name in required_libs]
+        env_cache = EnvCache(app_conf)
+        cache_key = env_cache.key(masterfolder, required_python_version,
+                                  pip_install_command, lib_ids)
+        env_ready = env_pool.submit(prepare_env, app_conf, program_name,
+                                    required_python_version, env_cache,
+                                    cache_key, stages)
 
         # 2. save location of readme, relative to program's root
         readme_path = "README.md"
@@ -278,6 +396,7 @@ def install_program(masterconf_path: str,
         config_file = os.path.join(masterfolder, 'config', 'MasterConfig.cfg')
         inputs = {}
         outputs = {}
+        resources = {}
         if os.path.isfile(config_file):
             config = ConfigParser(
                 interpolation=ExtendedInterpolation())
@@ -310,46 +429,51 @@ def install_program(masterconf_path: str,
                         code = 3
                     outputs[option] = rel_ofile
 
-        version = get_versions(masterfolder)
-        df = pd.read_csv(app_conf["PRG"], dtype=str)
-        df.loc[df['program_name'] == program_name, 'readme'] = readme_path
-
-        df.loc[df['program_name'] == program_name,
-               'inputs'] = json.dumps(inputs)
-        df.loc[df['program_name'] == program_name,
-               'outputs'] = json.dumps(outputs)
+            # the cores and the memory in GB the runs need, see admission
+            if config.has_section("resources"):
+                try:
+                    if config.has_option("resources", "cores"):
+                        resources["cores"] = config.getint("resources",
+                                                           "cores")
+                    if config.has_option("resources", "memory"):
+                        resources["memory"] = 1024 * config.getfloat(
+                            "resources", "memory")
+                except ValueError as err:
+                    print(f"The resources section is ignored: {err}")
+                    resources = {}
 
-        df.loc[df["program_name"] == program_name, "version"] = version
+        version = get_versions(masterfolder)
 
-        # 4. Create a new conda environment with the provided python version
-        df.loc[df['program_name'] == program_name,
-               'status'] = 'creating conda env'
-        df.to_csv(app_conf["PRG"], index=False)
-        c_cmd = f'conda create -y -n {program_name} python={required_python_version} conda-build'
-        run_and_verify(c_cmd)
+        # 4. Wait for the conda env, cloned from the cache or blank
+        reg.update("programs", prg_id,
+                   readme=readme_path,
+                   inputs=json.dumps(inputs),
+                   outputs=json.dumps(outputs),
+                   resources=json.dumps(resources),
+                   version=version)
+        stages.done("files")
+        from_cache = env_ready.result()
 
         # 4. Activate the new conda environment and install the program using pip
-        df = pd.read_csv(app_conf["PRG"], dtype=str)
-        df.loc[df['program_name'] == program_name,
-               'status'] = 'installing packages'
-        df.to_csv(app_conf["PRG"], index=False)
-        activate_env_command = f'{app_conf["activate"]}{program_name}'
-        if os.path.isfile(os.path.join(masterfolder, "setup.py")) and \
-            (test_args is None or
-             not os.path.isfile(os.path.join(masterfolder, "requirements.txt"))):
-            print("setup.py is found")
-            pip_install_command = ' && pip install .'
-        elif os.path.isfile(os.path.join(masterfolder, "requirements.txt")):
-            print("requirements.txt is found")
-            pip_install_command = ' && pip install -r requirements.txt'
+        if from_cache:
+            # the dependencies are in place, only the program may differ
+            if pip_install_command == ' && pip install .':
+                stages.start("packages", 'installing packages')
+                run_and_verify(f'{activate_env_command} && '
+                               'pip install --no-deps .', cwd=masterfolder)
         else:
-            pip_install_command = ""
-        i_cmd = f'{activate_env_command} {pip_install_command}'
-        run_and_verify(i_cmd, cwd=masterfolder)
+            stages.start("packages", 'installing packages')
+            i_cmd = activate_env_command
+            if pip_args:
+                i_cmd += f' && {pip_command(app_conf, pip_args)}'
+            run_and_verify(i_cmd, cwd=masterfolder)
+        stages.done("packages")
 
         # 5. add the libraries
+        lib_paths = []
         if len(required_libs) > 0:
-            libs = pd.read_csv(app_conf["LIB"])
+            stages.start("libs", 'adding the libraries')
+            libs = reg.frame("libs")
             conda_devs = [f'{app_conf["activate"]}{program_name}']
             for lib in libs.itertuples():
                 if lib.library_name not in required_libs:
@@ -358,39 +482,75 @@ def install_program(masterconf_path: str,
                                     lib.library_name,
                                     lib.path_to_exec)
                 conda_devs.append(f'conda develop "{path}"')
+                lib_paths.append(path)
 
                 used_in_raw = lib.used_in
                 used_in = json.loads(used_in_raw)
                 used_in.append(program_name)
                 used_in_raw = json.dumps(used_in)
-                libs.loc[libs["library_name"] ==
-                         lib.library_name, "used_in"] = used_in_raw
-            libs.to_csv(app_conf["LIB"], index=False)
+                reg.update("libs", {"library_name": lib.library_name},
+                           used_in=used_in_raw)
             cmd = " && ".join(conda_devs)
             run_and_verify(cmd, cwd=masterfolder)
+        stages.done("libs")
 
         # 6. compress the folder if it was git
-        if isinstance(program_source, str) is not None:
-            df = pd.read_csv(app_conf["PRG"], dtype=str)
-            df.loc[df['program_name'] == program_name,
-                   'status'] = 'creating the zip from repo'
-            df.to_csv(app_conf["PRG"], index=False)
-            shutil.make_archive(prg_zip_fpath[:-4], 'zip',
-                                root_dir=masterfolder, base_dir='.')
+        if not isinstance(program_source, str):
+            stages.start("archive", 'creating the zip from repo')
+            make_archive(prg_zip_fpath[:-4], masterfolder)
+        stages.done("archive")
+
+        # 7. record the environment to be able to recreate it
+        env_fields = {}
+        try:
+            env_prefix = write_lock(app_conf, program_name,
+                                    pip_install_command == ' && pip install .',
+                                    lib_paths)
+            env_fields = {"env_prefix": env_prefix, "env_state": "present",
+                          "last_used": datetime.now().strftime(
+                              '%Y-%m-%d %H:%M:%S')}
+        except Exception:
+            print("The environment could not be locked, it is never removed "
+                  "before the program is deleted.",
+                  traceback.format_exc(), sep="\n")
+        try:
+            env_fields["launch"] = json.dumps(
+                resolve_launch(app_conf, program_name))
+        except Exception:
+            print("The interpreter of the environment could not be resolved, "
+                  "the runs activate the environment.",
+                  traceback.format_exc(), sep="\n")
 
         # 7. Update status in program_details.csv to installed
-        df = pd.read_csv(app_conf["PRG"], dtype=str)
-        df.loc[df['program_name'] == program_name, 'status'] = 'Installed'
-        df.loc[df['program_name'] == program_name, 'PID'] = ''
-        df.to_csv(app_conf["PRG"], index=False)
+        reg.set_status("programs", prg_id, 'Installed', PID='', **env_fields)
+
+        # 8. keep a copy of the environment and the wheels of its packages
+        # for the next installs
+        if not from_cache:
+            try:
+                env_cache.add(cache_key, program_name, required_python_version)
+            except Exception:
+                print("The environment could not be cached.",
+                      traceback.format_exc(), sep="\n")
+        try:
+            fill_wheelhouse(app_conf, activate_env_command)
+        except Exception:
+            print("The wheels could not be added to the wheelhouse.",
+                  traceback.format_exc(), sep="\n")
         return 0
 
     except subprocess.CalledProcessError as err:
         print(f"Error calling subprocess:", traceback.format_exc(), sep="\n")
+        env_pool.shutdown()
+        stages.fail()
         clean_up_install(app_conf, program_name, err.returncode)
     except Exception:
         print(f"Error in python script.", traceback.format_exc(), sep="\n")
+        env_pool.shutdown()
+        stages.fail()
         clean_up_install(app_conf, program_name, 1)
+    finally:
+        env_pool.shutdown()
 
     return 1
 
@@ -0,0 +1,112 @@
+"""Keep concurrent runs on their own cores and within their limits.
+
+On Linux each run gets a set of cores of its own, as many as its
+program needs (see ``admission``), from the cores of the service minus
+the first ``run_reserved_cores`` ones, which are left to the web server.
+The runner pins itself and so the program to the set, and tells the
+thread pools of OpenMP and the BLAS libraries to use as many threads as
+cores it has. The set is recorded with the run (``cpus`` column), so
+the next runs get the other cores.
+
+If ``run_cgroup`` in host.cfg is a cgroup v2 folder delegated to the
+user of the service, each run is also put into a cgroup of its own
+there, with its CPU time limited to its cores (``cpu.max``) and its
+memory to the memory its program declares (``memory.max``). The limits
+need the cpu and memory controllers in the ``cgroup.subtree_control``
+of that folder, missing controllers are skipped.
+"""
+import os
+from typing import Dict, Iterable, List, Optional
+
+THREAD_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+
+def allowed_cpus(conf: dict) -> List[int]:
+    """Return the cores the runs may use, empty if pinning is unsupported."""
+    if not conf["run_affinity"] or not hasattr(os, "sched_getaffinity"):
+        return []
+    cpus = sorted(os.sched_getaffinity(0))
+    if conf["run_reserved_cores"] < len(cpus):
+        cpus = cpus[conf["run_reserved_cores"]:]
+    return cpus
+
+
+def assign_cpus(conf: dict, cores: int, taken: Iterable[int]) -> List[int]:
+    """Choose the cores of a run, the ones no running run has first.
+
+    If not enough cores are free, e.g. the run needs more than the host
+    has, the run shares the least used ones.
+    """
+    cpus = allowed_cpus(conf)
+    if not cpus:
+        return []
+    usage = {cpu: 0 for cpu in cpus}
+    for cpu in taken:
+        if cpu in usage:
+            usage[cpu] += 1
+    return sorted(sorted(cpus, key=lambda cpu: usage[cpu])[:max(1, cores)])
+
+
+def parse_cpus(value: str) -> List[int]:
+    """Return the cores of a run as recorded in the registry."""
+    return [int(cpu) for cpu in value.split(",") if cpu.strip() != ""]
+
+
+def thread_env(env: Optional[Dict[str, str]], threads: int
+               ) -> Dict[str, str]:
+    """Set the size of the thread pools, unless the program sets them."""
+    env = dict(os.environ if env is None else env)
+    for name in THREAD_VARS:
+        env.setdefault(name, str(threads))
+    return env
+
+
+def create_cgroup(conf: dict, name: str, cores: int,
+                  memory: Optional[float]) -> Optional[str]:
+    """Create the cgroup of a run with its limits.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    name : str
+        The name of the cgroup, unique among the running runs.
+    cores : int
+        The CPU time is limited to this many cores.
+    memory : Optional[float]
+        The memory limit in MB, None for no limit.
+
+    Returns
+    -------
+    Optional[str]
+        The folder of the cgroup, None if cgroups are not used.
+    """
+    parent = conf["run_cgroup"]
+    if not parent or not os.path.isfile(
+            os.path.join(parent, "cgroup.controllers")):
+        return None
+    path = os.path.join(parent, name)
+    os.makedirs(path, exist_ok=True)
+    limits = {"cpu.max": f"{cores * 100000} 100000"}
+    if memory:
+        limits["memory.max"] = str(int(memory * 2 ** 20))
+    for fname, value in limits.items():
+        fpath = os.path.join(path, fname)
+        if os.path.isfile(fpath):  # the controller is enabled
+            with open(fpath, "w") as ofile:
+                ofile.write(value)
+    return path
+
+
+def join_cgroup(path: str) -> None:
+    """Move the calling process into the cgroup."""
+    with open(os.path.join(path, "cgroup.procs"), "w") as ofile:
+        ofile.write(str(os.getpid()))
+
+
+def remove_cgroup(path: str) -> None:
+    """Remove the cgroup of a finished run."""
+    try:
+        os.rmdir(path)
+    except OSError as err:  # a process of the run is still alive
+        print(f"The cgroup {path} could not be removed: {err}", flush=True)
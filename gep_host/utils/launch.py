@@ -0,0 +1,96 @@
+"""Start the programs with the interpreter of their environment directly.
+
+Activating a conda environment in a shell only changes environment
+variables: the bin folder of the environment is put on the PATH and a
+few variables (CONDA_PREFIX, the ones of the activation scripts of the
+packages) are set. At the end of an install the interpreter of the
+environment and these changes are resolved once and stored with the
+program (``launch`` column of the registry), so a run executes the
+interpreter without a shell and without ``conda activate``. The
+libraries added with ``conda develop`` need nothing extra, they are in a
+.pth file of the environment that the interpreter reads itself.
+
+Programs installed before, or whose interpreter is gone, are still
+started through the activation command.
+"""
+import json
+import os
+import shlex
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+# changed by every shell, not by the activation
+_VOLATILE = {"_", "SHLVL", "PWD", "OLDPWD"}
+
+_DUMP_ENV = ("import json, os, sys; "
+             "print(json.dumps([sys.executable, dict(os.environ)]))")
+
+
+def _dump(cmd: str) -> list:
+    proc = subprocess.run(cmd, shell=True, text=True, check=True,
+                          stdout=subprocess.PIPE)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def resolve_launch(conf: dict, program_name: str) -> Dict:
+    """Resolve the interpreter and the activation of an environment.
+
+    Returns
+    -------
+    Dict
+        The path of the interpreter (``python``), the variables the
+        activation sets (``set``), prepends to (``prepend``) and removes
+        (``unset``).
+    """
+    _, before = _dump(f'"{sys.executable}" -c "{_DUMP_ENV}"')
+    python, after = _dump(f'{conf["activate"]}{program_name} && '
+                          f'python -c "{_DUMP_ENV}"')
+    spec = {"python": python, "set": {}, "prepend": {}, "unset": []}
+    for name, value in after.items():
+        old = before.get(name)
+        if name in _VOLATILE or value == old:
+            continue
+        if old and value.endswith(os.pathsep + old):
+            # keep the PATH of the service at run time, not the current one
+            spec["prepend"][name] = value[:-len(old)]
+        else:
+            spec["set"][name] = value
+    spec["unset"] = sorted(set(before) - set(after) - _VOLATILE)
+    return spec
+
+
+def load_launch(prg: Optional[Dict[str, str]]) -> Optional[Dict]:
+    """Return the launch of a program row, None if it must be activated."""
+    if prg is None or not prg.get("launch"):
+        return None
+    spec = json.loads(prg["launch"])
+    if not os.path.isfile(spec["python"]):
+        return None
+    return spec
+
+
+def launch_env(spec: Dict, env: Optional[Dict[str, str]] = None
+               ) -> Dict[str, str]:
+    """Return the environment variables of a run, as if activated.
+
+    Parameters
+    ----------
+    spec : Dict
+        The launch of the program, see ``resolve_launch``.
+    env : Optional[Dict[str, str]]
+        The variables to start from, the ones of this process by default.
+    """
+    env = dict(os.environ if env is None else env)
+    for name in spec["unset"]:
+        env.pop(name, None)
+    env.update(spec["set"])
+    for name, prefix in spec["prepend"].items():
+        env[name] = prefix + env[name] if env.get(name) else \
+            prefix.rstrip(os.pathsep)
+    return env
+
+
+def launch_command(spec: Dict, args: str) -> List[str]:
+    """Return the command line executing the interpreter with the args."""
+    return [spec["python"]] + shlex.split(args, posix=os.name != "nt")
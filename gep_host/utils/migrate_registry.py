@@ -0,0 +1,74 @@
+"""Import the CSV registries into the SQLite registry.
+
+Usage: python -m gep_host.utils.migrate_registry path/to/MasterConfig.cfg
+
+The CSV files created by set_csv_files are left untouched. After a
+successful import, set ``registry = sqlite`` in host.cfg.
+"""
+import argparse
+import sys
+from typing import Dict
+
+from gep_host.utils.registry import TABLES, CsvRegistry, SqliteRegistry
+from gep_host.utils.set_conf_init import set_conf
+
+
+def migrate(conf: dict, overwrite: bool = False) -> Dict[str, int]:
+    """Copy every row of the CSV tables into the SQLite database.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    overwrite : bool, optional
+        Empty the database tables before the import, by default False.
+
+    Returns
+    -------
+    Dict[str, int]
+        The number of imported rows per table.
+
+    Raises
+    ------
+    ValueError
+        If a database table already has rows and overwrite is not set.
+    """
+    csv_reg = CsvRegistry(conf)
+    sql_reg = SqliteRegistry(conf["DB"])
+
+    for table in TABLES:
+        if sql_reg.find(table) is not None and not overwrite:
+            raise ValueError(f"Table {table} in {conf['DB']} is not empty. "
+                             "Use --overwrite to replace its content.")
+
+    counts = {}
+    for table in TABLES:
+        rows = csv_reg.frame(table).to_dict("records")
+        sql_reg.remove(table)
+        sql_reg.add_many(table, rows)
+        counts[table] = len(rows)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Import the CSV registries into the SQLite registry.")
+    parser.add_argument("master_config",
+                        help=('Required: path to the master config file. '
+                              'This file contains the paths for the service.'),
+                        metavar="path/to/MasterConfig.cfg")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Replace the rows already in the database.")
+    args = parser.parse_args()
+
+    conf = {}
+    set_conf(conf, args.master_config)
+    try:
+        res = migrate(conf, args.overwrite)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    for table, count in res.items():
+        print(f"{table}: {count} rows imported into {conf['DB']}")
+    print("Set registry = sqlite in the host settings to use the database.")
+    sys.exit(0)
@@ -0,0 +1,91 @@
+"""Share the status events of the registry with the open pages.
+
+Every open programs or runs page keeps a Server-Sent Events connection
+to the service. Instead of each connection reading the registry, one
+notifier per process follows the event log of the registry at most once
+per interval and keeps the recent events in memory. The connections
+only wait for new events in this buffer, so the cost of the status
+updates does not grow with the number of open pages.
+"""
+import collections
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import gevent
+
+from .registry import get_registry
+
+# a row is active until its status starts with this prefix
+FINAL_STATUS = {"programs": "Installed", "runs": "Completed"}
+
+
+class StatusNotifier:
+    """Follow the event log of the registry for all the connections.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    interval : float, optional
+        The time between two reads of the event log in seconds,
+        by default 1.
+    size : int, optional
+        The number of recent events kept in memory, by default 1000.
+    """
+
+    def __init__(self, conf: dict, interval: float = 1, size: int = 1000):
+        self.conf = conf
+        self.interval = interval
+        self.events: collections.deque = collections.deque(maxlen=size)
+        self.seq = 0  # the number of events seen since the start
+        self.active: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.checked = 0.0
+        self.cursor = get_registry(conf).events_end()
+
+    def _refresh(self) -> None:
+        """Read the new events if the last read is older than interval."""
+        with self.lock:
+            if time.monotonic() - self.checked < self.interval:
+                return
+            self.checked = time.monotonic()
+            reg = get_registry(self.conf)
+            events, self.cursor = reg.events_since(self.cursor)
+            for table in {event["table"] for event in events}:
+                if table in FINAL_STATUS:
+                    self.active[table] = (
+                        reg.count(table)
+                        - reg.count(table, status_prefix=FINAL_STATUS[table]))
+            for event in events:
+                self.seq += 1
+                self.events.append((self.seq, event))
+
+    def wait(self, seq: int, timeout: float = 15
+             ) -> Tuple[Optional[List[Dict[str, str]]], int]:
+        """Wait for the events after seq, return them and the new seq.
+
+        An empty list is returned if no event arrives within timeout, and
+        None if the events after seq are no longer in the buffer.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self._refresh()
+            if self.seq > seq:
+                if self.events[0][0] > seq + 1:  # some were dropped
+                    return None, self.seq
+                return [ev for num, ev in self.events if num > seq], self.seq
+            if time.monotonic() > deadline:
+                return [], seq
+            gevent.sleep(self.interval)
+
+
+_notifier: Optional[StatusNotifier] = None
+
+
+def get_notifier(conf: dict) -> StatusNotifier:
+    """Return the notifier of this process, create it at the first call."""
+    global _notifier
+    if _notifier is None:
+        _notifier = StatusNotifier(conf)
+    return _notifier
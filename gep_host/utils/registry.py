@@ -0,0 +1,570 @@
+"""Metadata registry of programs, runs, libraries and files.
+
+The service keeps four tables. The original backend stores each of them
+in a CSV file (see :func:`set_conf_init.set_csv_files`) and rewrites the
+whole file on every change. The SQLite backend keeps them in a single
+database in WAL mode, with indexes on the lookup keys, so that reading
+or updating one row does not depend on the size of the table.
+
+The backend is selected with the ``registry`` setting in host.cfg
+(``csv`` or ``sqlite``). Existing CSV files can be imported into the
+database with :mod:`gep_host.utils.migrate_registry`.
+
+Status changes made with :meth:`Registry.set_status` are also appended
+to an event log, which can be followed with :meth:`Registry.events_since`
+without reading the tables. Only the last ``EVENTS_KEPT`` events are kept.
+
+pandas is imported on first use of a DataFrame, so the processes that
+read rows of the SQLite registry with ``find`` and ``rows`` and update
+them, e.g. the runs, do not load it.
+"""
+from __future__ import annotations
+
+import contextlib
+import csv
+import os
+import sqlite3
+import sys
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, threads are still locked
+    fcntl = None
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+TABLES = {
+    "programs": {
+        "conf_key": "PRG",
+        "columns": ["program_name", "upload_date", "python_version",
+                    "status", "PID", "zip_fname", "selected_libs",
+                    "def_args", "exe_test", "source", "inputs", "outputs",
+                    "version", "readme", "stages", "env_prefix",
+                    "last_used", "env_state", "launch",
+                    "resources"],
+        "indexes": [["program_name"]],
+        "numeric": [],
+    },
+    "runs": {
+        "conf_key": "RUN",
+        "columns": ["program_name", "purpose", "python_args",
+                    "setup_date", "status", "uploaded_files",
+                    "inherited_files", "registered_files",
+                    "undefineds", "outputs", "comment",
+                    "notifications", "PID", "run_setup",
+                    "cores_used", "peak_rss", "cpus", "blobs"],
+        "indexes": [["program_name", "purpose"], ["status"]],
+        "numeric": [],
+    },
+    "libs": {
+        "conf_key": "LIB",
+        "columns": ["library_name", "path_to_exec", "upload_date",
+                    "zip_path", "orig_filename", "status", "size",
+                    "comment", "used_in"],
+        "indexes": [["library_name"]],
+        "numeric": [],
+    },
+    "files": {
+        "conf_key": "FLE",
+        "columns": ["filename", "upload_date", "size", "hash", "comment",
+                    "used_in", "dir"],
+        "indexes": [["filename"], ["hash"]],
+        "numeric": ["size"],
+    },
+}
+
+EVENT_COLUMNS = ["time", "table", "name", "purpose", "status"]
+EVENTS_KEPT = 10000  # the older events are removed from the log
+# the csv event log is cut back to EVENTS_KEPT rows beyond this size
+EVENT_LOG_BYTES = 2 * 1024 * 1024
+
+
+def _to_str(value) -> str:
+    """Store every value as text, missing values as empty string."""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    pd = sys.modules.get("pandas")  # missing values come from DataFrames
+    try:
+        if pd is not None and pd.isna(value):
+            return ""
+        if isinstance(value, float) and value != value:
+            return ""
+    except (TypeError, ValueError):  # lists, dicts
+        pass
+    return str(value)
+
+
+def new_event(table: str, where: Dict[str, str], status: str) -> Dict[str, str]:
+    """Describe a status change of the row identified by where."""
+    keys = list(where.values())
+    return {"time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "table": table,
+            "name": _to_str(keys[0]) if keys else "",
+            "purpose": _to_str(where.get("purpose", "")),
+            "status": _to_str(status)}
+
+
+class Registry(ABC):
+    """Common interface of the registry backends.
+
+    Every value is stored and returned as a string; missing values are
+    empty strings. Rows are selected by equality on keyword arguments,
+    e.g. ``find("runs", program_name="prg", purpose="test")``, and
+    optionally by the beginning of their status with ``status_prefix``.
+    A backend implements the abstract methods.
+    """
+
+    @abstractmethod
+    def frame(self, table: str, order_by: Optional[str] = None,
+              ascending: bool = True, status_prefix: Optional[str] = None,
+              **where) -> pd.DataFrame:
+        """Return the matching rows as a DataFrame of strings."""
+
+    def rows(self, table: str, order_by: Optional[str] = None,
+             ascending: bool = True, status_prefix: Optional[str] = None,
+             **where) -> List[Dict[str, str]]:
+        """Return the matching rows as dicts, like ``frame``.
+
+        The SQLite backend reads them without pandas.
+        """
+        return self.frame(table, order_by, ascending, status_prefix,
+                          **where).to_dict("records")
+
+    @abstractmethod
+    def count(self, table: str, status_prefix: Optional[str] = None,
+              **where) -> int:
+        """Return the number of matching rows."""
+
+    @abstractmethod
+    def find(self, table: str, **where) -> Optional[Dict[str, str]]:
+        """Return the first matching row or None."""
+
+    def add(self, table: str, row: Dict) -> None:
+        """Append a new row."""
+        self.add_many(table, [row])
+
+    @abstractmethod
+    def add_many(self, table: str, rows: Iterable[Dict]) -> None:
+        """Append new rows."""
+
+    @abstractmethod
+    def update(self, table: str, where: Dict[str, str], **fields) -> int:
+        """Set the fields of the matching rows, return their count."""
+
+    @abstractmethod
+    def remove(self, table: str, **where) -> int:
+        """Delete the matching rows, return their count."""
+
+    def set_status(self, table: str, where: Dict[str, str], status: str,
+                   **fields) -> int:
+        """Update the status and fields of the matching rows.
+
+        The change is also recorded in the event log.
+
+        Parameters
+        ----------
+        table : str
+            One of the keys of TABLES.
+        where : Dict[str, str]
+            The key columns identifying the row(s).
+        status : str
+            The new status.
+        **fields
+            Other columns to set in the same update.
+
+        Returns
+        -------
+        int
+            The number of updated rows.
+        """
+        count = self.update(table, where, status=status, **fields)
+        self.append_event(new_event(table, where, status))
+        return count
+
+    @abstractmethod
+    def append_event(self, event: Dict[str, str]) -> None:
+        """Append an event to the log, see EVENT_COLUMNS."""
+
+    @abstractmethod
+    def events_since(self, cursor: int) -> Tuple[List[Dict[str, str]], int]:
+        """Return the events after the cursor and the new cursor.
+
+        A cursor of 0 means the beginning of the log.
+        """
+
+    @abstractmethod
+    def events_end(self) -> int:
+        """Return the cursor after the last event, to follow new events."""
+
+
+class CsvRegistry(Registry):
+    """The original backend: one CSV file per table, read with pandas.
+
+    A change reads, modifies and rewrites the whole file, so a status
+    change gets slower as the table grows and only the SQLite backend
+    keeps it independent of the other rows. The changes of
+    a table are serialized between the threads with a lock and between
+    the processes (runs, installs) with a lock file, and the file is
+    replaced atomically, so readers never see a partial table.
+    """
+
+    def __init__(self, conf: dict):
+        self.paths = {table: conf[spec["conf_key"]]
+                      for table, spec in TABLES.items()}
+        self.events_path = conf["EVT"]
+        self.lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def _locked(self, path: str):
+        """Lock a file against the changes of other threads and processes."""
+        with self.lock, open(path + ".lock", "a") as lockf:
+            if fcntl is not None:
+                fcntl.flock(lockf, fcntl.LOCK_EX)
+            yield
+
+    def _read(self, table: str) -> pd.DataFrame:
+        import pandas as pd
+        return pd.read_csv(self.paths[table], dtype=str).fillna("")
+
+    def _write(self, table: str, data: pd.DataFrame) -> None:
+        tmp_path = self.paths[table] + ".tmp"
+        data.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, self.paths[table])
+
+    @staticmethod
+    def _mask(data: pd.DataFrame, where: Dict[str, str],
+              status_prefix: Optional[str] = None) -> pd.Series:
+        import pandas as pd
+        mask = pd.Series(True, index=data.index)
+        if status_prefix is not None:
+            mask &= data["status"].str.startswith(status_prefix)
+        for col, val in where.items():
+            if col not in data.columns:
+                return pd.Series(False, index=data.index)
+            mask &= data[col] == _to_str(val)
+        return mask
+
+    def frame(self, table, order_by=None, ascending=True,
+              status_prefix=None, **where):
+        data = self._read(table)
+        if where or status_prefix is not None:
+            data = data[self._mask(data, where, status_prefix)]
+        if order_by is not None:
+            key = None
+            if order_by in TABLES[table]["numeric"]:
+                import pandas as pd
+                def key(col): return pd.to_numeric(col, errors="coerce")
+            data = data.sort_values(by=order_by, ascending=ascending,
+                                    key=key)
+        return data
+
+    def count(self, table, status_prefix=None, **where):
+        data = self._read(table)
+        return int(self._mask(data, where, status_prefix).sum())
+
+    def find(self, table, **where):
+        data = self._read(table)
+        match = data[self._mask(data, where)]
+        if match.empty:
+            return None
+        return match.iloc[0].to_dict()
+
+    def add_many(self, table, rows):
+        import pandas as pd
+        new_entries = pd.DataFrame([{k: _to_str(v) for k, v in row.items()}
+                                    for row in rows])
+        with self._locked(self.paths[table]):
+            data = pd.concat([self._read(table), new_entries],
+                             ignore_index=True)
+            self._write(table, data.fillna(""))
+
+    def update(self, table, where, **fields):
+        with self._locked(self.paths[table]):
+            data = self._read(table)
+            mask = self._mask(data, where)
+            for col, val in fields.items():
+                if col not in data.columns:
+                    data[col] = ""
+                data.loc[mask, col] = _to_str(val)
+            self._write(table, data)
+        return int(mask.sum())
+
+    def remove(self, table, **where):
+        with self._locked(self.paths[table]):
+            data = self._read(table)
+            mask = self._mask(data, where)
+            self._write(table, data[~mask])
+        return int(mask.sum())
+
+    def append_event(self, event):
+        with self._locked(self.events_path):
+            new_file = not os.path.isfile(self.events_path)
+            with open(self.events_path, "a", newline="",
+                      encoding="utf-8") as ofile:
+                writer = csv.DictWriter(ofile, fieldnames=EVENT_COLUMNS)
+                if new_file:
+                    writer.writeheader()
+                writer.writerow(event)
+                size = ofile.tell()
+            if size > EVENT_LOG_BYTES:
+                self._cut_events()
+
+    def _cut_events(self) -> None:
+        """Keep the header and the last EVENTS_KEPT rows of the event log.
+
+        The file is replaced atomically, the cursors pointing beyond its
+        new end or into the middle of a row are reset by events_since.
+        """
+        with open(self.events_path, "rb") as ifile:
+            lines = ifile.readlines()
+        tmp_path = self.events_path + ".tmp"
+        with open(tmp_path, "wb") as ofile:
+            ofile.writelines(lines[:1] + lines[1:][-EVENTS_KEPT:])
+        os.replace(tmp_path, self.events_path)
+
+    def events_since(self, cursor):
+        if not os.path.isfile(self.events_path):
+            return [], cursor
+        lines = []
+        with open(self.events_path, "rb") as ifile:
+            if cursor > 0:  # the log has been cut since the last call
+                ifile.seek(cursor - 1)
+                if ifile.read(1) != b"\n":
+                    return [], self.events_end()
+            if cursor == 0:
+                ifile.readline()  # header
+                cursor = ifile.tell()
+            ifile.seek(cursor)
+            for line in ifile:
+                if not line.endswith(b"\n"):  # a row being written
+                    break
+                lines.append(line.decode("utf-8"))
+                cursor += len(line)
+        reader = csv.DictReader(lines, fieldnames=EVENT_COLUMNS)
+        return list(reader), cursor
+
+    def events_end(self):
+        if not os.path.isfile(self.events_path):
+            return 0
+        with open(self.events_path, "rb") as ifile:
+            ifile.seek(0, os.SEEK_END)
+            end = ifile.tell()
+            ifile.seek(max(0, end - 4096))
+            tail = ifile.read()
+        # stop before a row being written
+        return end - len(tail) + tail.rfind(b"\n") + 1
+
+
+class SqliteRegistry(Registry):
+    """All tables in one SQLite database in WAL mode.
+
+    The connection is shared by the threads of a process, its use is
+    serialized with a lock. Concurrent processes (runs, installs) are
+    handled by SQLite's own locking with a generous busy timeout.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(db_path, timeout=60,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.columns: Dict[str, List[str]] = {}
+        with self.lock:
+            for table, spec in TABLES.items():
+                self._create(table, spec)
+            cols = ", ".join(f'"{col}" TEXT NOT NULL DEFAULT \'\''
+                             for col in EVENT_COLUMNS)
+            self.con.execute('CREATE TABLE IF NOT EXISTS events '
+                             f'(id INTEGER PRIMARY KEY AUTOINCREMENT, {cols})')
+
+    def _create(self, table: str, spec: dict) -> None:
+        cols = ", ".join(f'"{col}" TEXT NOT NULL DEFAULT \'\''
+                         for col in spec["columns"])
+        self.con.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({cols})')
+        for index in spec["indexes"]:
+            name = f"idx_{table}_{'_'.join(index)}"
+            idx_cols = ", ".join(f'"{col}"' for col in index)
+            self.con.execute(f'CREATE INDEX IF NOT EXISTS "{name}" '
+                             f'ON "{table}" ({idx_cols})')
+        info = self.con.execute(f'PRAGMA table_info("{table}")').fetchall()
+        self.columns[table] = [row[1] for row in info]
+
+    def _check(self, table: str, cols: Iterable[str]) -> None:
+        """Column names are put into the SQL, so only known ones pass."""
+        for col in cols:
+            if col not in self.columns[table]:
+                raise KeyError(f"Unknown column {col} in table {table}")
+
+    def _add_columns(self, table: str, cols: Iterable[str]) -> None:
+        for col in cols:
+            if col not in self.columns[table] and '"' not in col:
+                self.con.execute(f'ALTER TABLE "{table}" ADD COLUMN '
+                                 f'"{col}" TEXT NOT NULL DEFAULT \'\'')
+                self.columns[table].append(col)
+
+    def _where(self, table: str, where: Dict[str, str],
+               status_prefix: Optional[str] = None):
+        self._check(table, where)
+        conds = [f'"{col}" = ?' for col in where]
+        params = [_to_str(val) for val in where.values()]
+        if status_prefix is not None:  # a range, so that the index is used
+            conds.append('"status" >= ? AND "status" < ?')
+            params += [status_prefix, status_prefix + "\U0010ffff"]
+        if not conds:
+            return "", []
+        return f" WHERE {' AND '.join(conds)}", params
+
+    def _select(self, table: str, order_by: Optional[str], ascending: bool,
+                status_prefix: Optional[str], where: Dict[str, str]):
+        clause, params = self._where(table, where, status_prefix)
+        sql = f'SELECT * FROM "{table}"{clause}'
+        if order_by is not None:
+            self._check(table, [order_by])
+            col = f'"{order_by}"'
+            if order_by in TABLES[table]["numeric"]:
+                col = f"CAST({col} AS REAL)"
+            sql += f" ORDER BY {col} {'ASC' if ascending else 'DESC'}"
+        else:
+            sql += " ORDER BY rowid"
+        return sql, params
+
+    def frame(self, table, order_by=None, ascending=True,
+              status_prefix=None, **where):
+        with self.lock:
+            sql, params = self._select(table, order_by, ascending,
+                                       status_prefix, where)
+            import pandas as pd
+            return pd.read_sql_query(sql, self.con, params=params)
+
+    def rows(self, table, order_by=None, ascending=True,
+             status_prefix=None, **where):
+        with self.lock:
+            sql, params = self._select(table, order_by, ascending,
+                                       status_prefix, where)
+            cur = self.con.execute(sql, params)
+            cols = [d[0] for d in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def count(self, table, status_prefix=None, **where):
+        with self.lock:
+            clause, params = self._where(table, where, status_prefix)
+            cur = self.con.execute(f'SELECT COUNT(*) FROM "{table}"{clause}',
+                                   params)
+            return cur.fetchone()[0]
+
+    def find(self, table, **where):
+        with self.lock:
+            clause, params = self._where(table, where)
+            cur = self.con.execute(f'SELECT * FROM "{table}"{clause} '
+                                   'ORDER BY rowid LIMIT 1', params)
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return dict(zip([d[0] for d in cur.description], row))
+
+    def add_many(self, table, rows):
+        rows = [{k: _to_str(v) for k, v in row.items()} for row in rows]
+        if not rows:
+            return
+        with self.lock:
+            self._add_columns(table, {col for row in rows for col in row})
+            self.con.execute("BEGIN IMMEDIATE")
+            try:
+                for row in rows:
+                    cols = ", ".join(f'"{col}"' for col in row)
+                    marks = ", ".join("?" for _ in row)
+                    self.con.execute(f'INSERT INTO "{table}" ({cols}) '
+                                     f'VALUES ({marks})', list(row.values()))
+                self.con.execute("COMMIT")
+            except Exception:
+                self.con.execute("ROLLBACK")
+                raise
+
+    def update(self, table, where, **fields):
+        if not fields:
+            return 0
+        with self.lock:
+            self._add_columns(table, fields)
+            clause, params = self._where(table, where)
+            sets = ", ".join(f'"{col}" = ?' for col in fields)
+            values = [_to_str(val) for val in fields.values()]
+            cur = self.con.execute(f'UPDATE "{table}" SET {sets}{clause}',
+                                   values + params)
+            return cur.rowcount
+
+    def remove(self, table, **where):
+        with self.lock:
+            clause, params = self._where(table, where)
+            cur = self.con.execute(f'DELETE FROM "{table}"{clause}', params)
+            return cur.rowcount
+
+    def append_event(self, event):
+        cols = ", ".join(f'"{col}"' for col in EVENT_COLUMNS)
+        with self.lock:
+            cur = self.con.execute(
+                f"INSERT INTO events ({cols}) VALUES (?, ?, ?, ?, ?)",
+                [event[col] for col in EVENT_COLUMNS])
+            # the ids keep growing, the cursors stay valid
+            self.con.execute("DELETE FROM events WHERE id <= ?",
+                             [cur.lastrowid - EVENTS_KEPT])
+
+    def events_since(self, cursor):
+        cols = ", ".join(f'"{col}"' for col in EVENT_COLUMNS)
+        with self.lock:
+            rows = self.con.execute(f"SELECT id, {cols} FROM events "
+                                    "WHERE id > ? ORDER BY id",
+                                    [cursor]).fetchall()
+        if rows:
+            cursor = rows[-1][0]
+        return [dict(zip(EVENT_COLUMNS, row[1:])) for row in rows], cursor
+
+    def events_end(self):
+        with self.lock:
+            row = self.con.execute("SELECT MAX(id) FROM events").fetchone()
+        return row[0] or 0
+
+
+BACKENDS = {"csv": lambda conf: CsvRegistry(conf),
+            "sqlite": lambda conf: SqliteRegistry(conf["DB"])}
+
+_registries: Dict[tuple, Registry] = {}
+
+
+def get_registry(conf: dict) -> Registry:
+    """Return the registry selected in the configuration.
+
+    One registry object is kept per backend and location in a process.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+
+    Returns
+    -------
+    Registry
+        The backend instance.
+
+    Raises
+    ------
+    ValueError
+        If the configured backend is unknown.
+    """
+    backend = conf.get("registry", "csv")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown registry backend {backend}. "
+                         f"Choose from {', '.join(BACKENDS)}.")
+    location = conf["DB"] if backend == "sqlite" else conf["PRG"]
+    if (backend, location) not in _registries:
+        _registries[(backend, location)] = BACKENDS[backend](conf)
+    return _registries[(backend, location)]
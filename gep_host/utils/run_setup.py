@@ -0,0 +1,144 @@
+"""Create the folder of a run from the folder of the installed program.
+
+With ``run_setup = copy`` in host.cfg the whole program folder is copied
+for every run. With ``run_setup = link`` the files are cloned with
+reflinks on filesystems supporting them (btrfs, xfs): the data blocks
+are shared with the program folder until one of the copies is modified,
+so setting up a run takes the same time and disk space regardless of the
+size of the program, and a run writing into a file does not change the
+installed program. Where reflinks are not supported (e.g. ext4, or the
+runs are on another device), the files are copied. Hardlinks are not
+used, a run could modify the program through them.
+
+The files a run is expected to write, the config file and the declared
+outputs, are always real copies.
+
+A run can also be set up as ``minimal`` (the default is set by
+``run_setup`` and can be changed for each run). The run folder then
+contains only the config file, the uploaded inputs and the folders of
+the outputs. Inherited inputs are read from the program folder, and the
+program is executed from the run folder with the program folder on the
+python path.
+"""
+import os
+import shutil
+import stat
+from typing import Dict, Iterable, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # from linux/fs.h
+
+RUN_SETUPS = ["copy", "link", "minimal"]
+
+
+def reflink(src: str, dst: str) -> None:
+    """Clone src to dst sharing the data blocks, raise OSError if unsupported."""
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform.")
+    with open(src, "rb") as ifile, open(dst, "wb") as ofile:
+        try:
+            fcntl.ioctl(ofile.fileno(), FICLONE, ifile.fileno())
+        except OSError:
+            ofile.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def reflink_or_copy(src: str, dst: str) -> str:
+    """Clone src to dst with a reflink if possible, copy it otherwise.
+
+    Can be used as the copy_function of shutil.copytree.
+
+    Returns
+    -------
+    str
+        The destination path.
+    """
+    try:
+        reflink(src, dst)
+        return dst
+    except OSError:
+        return shutil.copy2(src, dst)
+
+
+def copy_writable(src: str, dst: str) -> str:
+    """Copy src to dst, the copy is writable even if src is read-only."""
+    shutil.copy2(src, dst)
+    os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+    return dst
+
+
+def materialize(src_root: str, dst_root: str, rel_path: str) -> None:
+    """Replace a shared file or the files of a shared folder with copies."""
+    dst = os.path.join(dst_root, rel_path)
+    src = os.path.join(src_root, rel_path)
+    if os.path.isfile(dst):
+        os.remove(dst)
+        copy_writable(src, dst)
+    elif os.path.isdir(dst):
+        shutil.rmtree(dst)
+        shutil.copytree(src, dst, copy_function=copy_writable)
+
+
+def link_tree(src_root: str, dst_root: str, own: Iterable[str]) -> None:
+    """Create dst_root from src_root sharing the files where possible.
+
+    Parameters
+    ----------
+    src_root : str
+        The folder of the installed program.
+    dst_root : str
+        The folder of the run, must not exist.
+    own : Iterable[str]
+        Paths relative to the roots that the run gets its own copy of.
+    """
+    shutil.copytree(src_root, dst_root, copy_function=reflink_or_copy)
+    for rel_path in own:
+        materialize(src_root, dst_root, rel_path)
+
+
+def minimal_tree(src_root: str, dst_root: str, outputs: Iterable[str]) -> None:
+    """Create dst_root with the config of src_root and the output folders.
+
+    Parameters
+    ----------
+    src_root : str
+        The folder of the installed program.
+    dst_root : str
+        The folder of the run, must not exist.
+    outputs : Iterable[str]
+        The output files relative to the roots.
+    """
+    os.makedirs(os.path.join(dst_root, "config"))
+    config_file = os.path.join("config", "MasterConfig.cfg")
+    if os.path.isfile(os.path.join(src_root, config_file)):
+        copy_writable(os.path.join(src_root, config_file),
+                      os.path.join(dst_root, config_file))
+    for output in outputs:
+        os.makedirs(os.path.join(dst_root, os.path.dirname(output)),
+                    exist_ok=True)
+
+
+def minimal_call(args: str, src_root: str, dst_root: str
+                 ) -> Tuple[str, Dict[str, str]]:
+    """Return the python arguments and environment of a minimal run.
+
+    A script given by a relative path is taken from the program folder if
+    it is not in the run folder, and the program folder is put on the
+    python path so that its modules can be imported with ``-m``.
+    """
+    parts = args.split(maxsplit=1)
+    if parts and not parts[0].startswith("-"):
+        script = parts[0]
+        if not os.path.exists(os.path.join(dst_root, script)) and \
+                os.path.isfile(os.path.join(src_root, script)):
+            parts[0] = os.path.join(src_root, script)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [src_root] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    return " ".join(parts), env
@@ -0,0 +1,370 @@
+"""Execute a run in a detached process, the entry point of the runs.
+
+The process imports only what the lifecycle of a run needs and only
+when it needs it: psutil if the run waits for resources, the environment lock
+if the environment has to be rebuilt, smtplib when the emails are sent.
+Neither flask nor pandas (with the SQLite registry) is loaded. The
+configuration is not parsed from MasterConfig.cfg and host.cfg again,
+the process that starts the run writes it to a JSON snapshot
+(``conf_snapshot.json`` in the host root, see
+``set_conf_init.save_conf_snapshot``) that the run reads.
+
+Usage: python runner.py path/to/conf_snapshot.json program purpose
+"""
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+import traceback
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+
+def send_email(subject: str, body: str, receiver_emails: List[str],
+               username: str = "gep_host_service") -> None:
+    """Send an email with the message body to the recipients."""
+    import smtplib
+    import socket
+    from unidecode import unidecode
+    hostname = socket.gethostname()
+    sender_email = f"{username}@{hostname}"
+
+    # Construct the email content
+    message = unidecode(f"Subject: {subject}\n\n{body}")
+
+    ret = 0
+    for receiver_email in receiver_emails:
+        try:
+            # Use a context manager to ensure the session is properly closed
+            with smtplib.SMTP("localhost") as server:
+                server.sendmail(sender_email, receiver_email, message)
+        except smtplib.SMTPException as e:
+            ret = e
+        finally:
+            return ret
+
+
+def wait_in_queue(prg_name: str, purp: str, conf: dict):
+    """Wait until the host has the cores and memory the run needs.
+
+    Only the row of this run is read and written while waiting; the
+    other queued runs are renumbered once, when this run leaves the queue.
+    See ``admission`` for when a run is admitted.
+    """
+    from gep_host.utils.admission import refusal, run_needs
+    from gep_host.utils.registry import get_registry
+    reg = get_registry(conf)
+    run_id = {"program_name": prg_name, "purpose": purp}
+    msg = ""
+    priority = 0
+    needs = {prg_name: run_needs(conf, reg, prg_name)}
+    while True:
+        running = []
+        for run in reg.rows("runs", status="running"):
+            if run["PID"] == "":
+                continue
+            if run["program_name"] not in needs:
+                needs[run["program_name"]] = run_needs(conf, reg,
+                                                       run["program_name"])
+            running.append((int(float(run["PID"])),
+                            needs[run["program_name"]]))
+        reason = refusal(conf, needs[prg_name], running, interval=0.5)
+
+        if reason is not None:
+            if priority == 0:
+                # Assign the next available priority
+                now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                print(f"{now_str} Started waiting for resources: {reason}.",
+                      flush=True)
+                priority = reg.count("runs", status_prefix="queue") + 1
+                reg.set_status("runs", run_id, f'queue {priority}')
+
+            time.sleep(2 ** priority)
+
+        else:
+            # Set the current run to 'running'
+            if priority:
+                now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                print(f"{now_str} Finished waiting for resources.")
+            reg.set_status("runs", run_id, 'running')
+
+            # Reorganize the queue to fill any gaps
+            queued_runs = sorted(reg.rows("runs", status_prefix="queue "),
+                                 key=lambda run: int(run["status"][6:]))
+            for new_priority, run in enumerate(queued_runs, start=1):
+                if run["status"] != f'queue {new_priority}':
+                    reg.set_status("runs",
+                                   {"program_name": run["program_name"],
+                                    "purpose": run["purpose"]},
+                                   f'queue {new_priority}')
+            return msg
+
+
+def stream_output(cmd: Union[str, List[str]], cwd: str,
+                  timestamps: bool = False,
+                  env: Optional[Dict[str, str]] = None,
+                  preexec_fn: Optional[Callable[[], None]] = None
+                  ) -> Optional[Dict[str, float]]:
+    """Run the command and write its output to the stdout of this process.
+
+    A command given as a string is run by the shell, a list is executed
+    directly. preexec_fn is called in the child before the command.
+
+    The stdout of the run is the run log, so without timestamps the child
+    inherits it and writes to the log directly. With timestamps the output
+    is read line by line and each line is prefixed with the time it was
+    read. In both cases the log can be followed while the program runs
+    and the memory used does not depend on the amount of output.
+
+    Returns
+    -------
+    Optional[Dict[str, float]]
+        The CPU time per wall time (``cores_used``) and the peak memory
+        in MB (``peak_rss``) of the command, None where not measured.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If the command returns with a non-zero exit code.
+    """
+    sys.stdout.flush()
+    start = time.monotonic()
+    shell = isinstance(cmd, str)
+    if not timestamps:
+        proc = subprocess.Popen(cmd, shell=shell, cwd=cwd, env=env,
+                                stdout=sys.stdout, stderr=subprocess.STDOUT,
+                                preexec_fn=preexec_fn)
+    else:
+        proc = subprocess.Popen(cmd, shell=shell, cwd=cwd, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, bufsize=1,
+                                text=True, errors="replace",
+                                preexec_fn=preexec_fn)
+        for line in proc.stdout:
+            now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            sys.stdout.write(f"{now_str} {line}")
+            sys.stdout.flush()
+    ret, usage = _wait(proc)
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+    if usage is None:
+        return None
+    cpu_time = usage.ru_utime + usage.ru_stime
+    # ru_maxrss is in bytes on macOS and in KB on the other systems
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {"cores_used": round(cpu_time / max(time.monotonic() - start,
+                                               1e-3), 2),
+            "peak_rss": round(usage.ru_maxrss * scale / 2 ** 20)}
+
+
+def _wait(proc: subprocess.Popen) -> Tuple[int, Optional[object]]:
+    """Wait for the process, return its exit code and resource usage.
+
+    The usage covers the process and its descendants it has waited for,
+    the peak memory is the one of the largest of them.
+    """
+    if not hasattr(os, "wait4"):  # Windows
+        return proc.wait(), None
+    _, status, usage = os.wait4(proc.pid, 0)
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    return proc.returncode, usage
+
+
+def run(conf: dict, prg_name: str, purp: str, queue: bool = True,
+        cpus: Optional[List[int]] = None) -> int:
+    """Execute a registered run and record its outcome.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration, populated by ``set_conf`` or loaded
+        from the snapshot.
+    prg_name : str
+        The program of the run.
+    purp : str
+        The purpose of the run.
+    queue : bool
+        Wait for resources before the start, False if dispatched by the
+        scheduler of the service.
+    cpus : Optional[List[int]]
+        The cores assigned by the scheduler, chosen by the run itself if
+        it waits in the queue.
+
+    Returns
+    -------
+    int
+        0 on success, 1 if the program failed, 2 if it could not be
+        started, 3 if it was interrupted.
+    """
+    from gep_host.utils.registry import get_registry
+    from gep_host.utils.launch import (launch_command, launch_env,
+                                       load_launch)
+    from gep_host.utils.isolation import (create_cgroup, join_cgroup,
+                                          remove_cgroup, thread_env)
+    reg = get_registry(conf)
+    run_id = {"program_name": prg_name, "purpose": purp}
+    masterconf_path = conf["masterconf_path"]
+
+    code = 0
+    now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    body = (f"The program {prg_name} with purpose {purp} "
+            f"using master conf at {masterconf_path} "
+            f"was successfully started at {now_str}. ")
+    print(body, flush=True)
+    subject = f"{conf['service_name']} run completed"
+
+    try:
+        # Update status in run_details.csv
+        if queue:  # not dispatched by the scheduler of the service
+            wait_in_queue(prg_name, purp, conf)
+            if cpus is None:
+                cpus = _choose_cpus(conf, reg, prg_name, purp)
+
+        # Recreate the environment if it has been removed while idle
+        reg.update("programs", {"program_name": prg_name},
+                   last_used=datetime.datetime.now().strftime(
+                       '%Y-%m-%d %H:%M:%S'))
+        prg = reg.find("programs", program_name=prg_name)
+        if prg is not None and prg.get("env_state") == "evicted":
+            from gep_host.utils.env_lock import rebuild_env
+            reg.set_status("runs", run_id, "rebuilding the environment")
+            print("The environment of the program is recreated.", flush=True)
+            rebuild_env(conf, prg_name)
+            reg.set_status("runs", run_id, "running")
+
+        # Run the program with the interpreter of its environment,
+        # activate the environment if it is not resolved
+        run = reg.find("runs", **run_id)
+        args = run['python_args']
+        setup_folder = os.path.join(conf["RUNR"], prg_name, purp)
+        env = None
+        if run['run_setup'] == "minimal":  # the program is not copied
+            from gep_host.utils.run_setup import minimal_call
+            masterfolder = os.path.join(conf["PRGR"], prg_name)
+            args, env = minimal_call(args, masterfolder, setup_folder)
+        launch = load_launch(prg)
+        if launch is not None:
+            import shlex
+            i_cmd = launch_command(launch, args)
+            env = launch_env(launch, env)
+            print(f"Start new subprocess: {shlex.join(i_cmd)}", flush=True)
+        else:
+            i_cmd = f'{conf["activate"]}{prg_name} && python {args}'
+            print(f"Start new subprocess: {i_cmd}", flush=True)
+
+        # Keep the program on its cores and within its limits
+        cgroup = None
+        if cpus:
+            reg.update("runs", run_id, cpus=",".join(map(str, cpus)))
+            os.sched_setaffinity(0, cpus)  # inherited by the program
+            env = thread_env(env, len(cpus))
+            declared = json.loads(prg["resources"]) \
+                if prg is not None and prg.get("resources") else {}
+            cgroup = create_cgroup(conf, f"{prg_name}__{purp}", len(cpus),
+                                   declared.get("memory"))
+            msg = f"The run is pinned to the cores {cpus}"
+            if cgroup:
+                msg += f" in the cgroup {cgroup}"
+            print(f"{msg}.", flush=True)
+        try:
+            usage = stream_output(
+                i_cmd, setup_folder, conf["log_timestamps"], env,
+                (lambda: join_cgroup(cgroup)) if cgroup else None)
+        finally:
+            if cgroup:
+                remove_cgroup(cgroup)
+        if usage is not None:  # the needs of the next runs are inferred
+            reg.update("runs", run_id, **usage)
+
+        # Update status in run_details.csv to completed
+        status = 'Completed'
+        subject += " successfully"
+        body = (f"The program {prg_name} with purpose {purp} "
+                f"using master conf at {masterconf_path} "
+                f"is completed successfully at {now_str}. ")
+
+    except subprocess.CalledProcessError as err:
+        code = 1
+        print(f"Error calling subprocess: {err}", flush=True)
+        print(traceback.format_exc(), flush=True)
+        status = 'Completed with error 1'
+        body += "The run had an error upon calling the program."
+        subject += " with error"
+    except KeyboardInterrupt as err:
+        code = 3
+        print(f"User pressed Ctrl+C: {err}", flush=True)
+        status = 'Completed with error 3'
+        body += "The run has been stopped by Ctrl+C."
+        subject += " (stopped)"
+    except Exception as err:
+        code = 2
+        print(f"Error in python script: {err}", flush=True)
+        print(traceback.format_exc(), flush=True)
+        status = 'Completed with error 2'
+        body += "The run had an error upon trying to call the program."
+        subject += " with error"
+    finally:
+        reg.set_status("runs", run_id, status, PID='')
+        receiver_emails = json.loads(
+            reg.find("runs", **run_id)['notifications'])
+        if receiver_emails:
+            from gep_host.utils.helpers import get_run_link
+            body += (f" Visit {get_run_link(prg_name, purp, conf)}"
+                     " for the run page for further details.")
+            send_email(subject, body,
+                       receiver_emails, conf["service_name"])
+        return code
+
+
+def _choose_cpus(conf: dict, reg, prg_name: str, purp: str) -> List[int]:
+    """Choose the cores of a run admitted without the scheduler."""
+    from gep_host.utils.admission import run_needs
+    from gep_host.utils.isolation import assign_cpus, parse_cpus
+    taken = [cpu for other in reg.rows("runs", status="running")
+             if (other["program_name"], other["purpose"]) != (prg_name, purp)
+             for cpu in parse_cpus(other.get("cpus", ""))]
+    return assign_cpus(conf, run_needs(conf, reg, prg_name)["cores"], taken)
+
+
+def run_command(conf: dict, prg_name: str, purp: str, queue: bool = True,
+                cpus: Optional[List[int]] = None) -> str:
+    """Return the command starting the runner for a run."""
+    cmd = f"python {__file__} {conf['SNAP']} {prg_name} {purp}"
+    if cpus:
+        cmd += f" --cpus {','.join(map(str, cpus))}"
+    return cmd if queue else f"{cmd} --no-queue"
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Execute a registered run of a program.')
+    parser.add_argument('conf_snapshot',
+                        metavar='path/to/conf_snapshot.json',
+                        help='The configuration written by the service.')
+    parser.add_argument('program_name',
+                        help='Name unique of the program.')
+    parser.add_argument('purpose',
+                        help='The unique purpose within the program name.')
+    parser.add_argument('--no-queue', action='store_true',
+                        help=('The run is dispatched by the scheduler of the '
+                              'service, start it without waiting for CPU.'))
+    parser.add_argument('--cpus', default=None,
+                        help='The cores of the run, separated by commas.')
+
+    args = parser.parse_args()
+    try:
+        with open(args.conf_snapshot, 'r', encoding="utf-8") as ifile:
+            conf = json.load(ifile)
+        cpus = None
+        if args.cpus is not None:
+            cpus = [int(cpu) for cpu in args.cpus.split(",")]
+        run(conf, args.program_name, args.purpose, not args.no_queue, cpus)
+    except Exception as excep:
+        print(f"There was an error calling run {excep}", flush=True)
+        sys.exit(1)
+    sys.exit(0)
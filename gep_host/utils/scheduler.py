@@ -0,0 +1,400 @@
+"""Dispatch queued runs and installs to a fixed number of execution slots.
+
+The schedulers live in the web service process. Runs triggered and
+programs uploaded from the web are submitted to them instead of being
+started right away. A scheduler keeps them in an in-memory priority
+queue and starts the next one as soon as a slot is freed, so no job has
+to poll the CPU usage while waiting and a burst of uploads does not
+start a burst of concurrent conda and pip processes. The position in the
+queue is written to the registry as the status ``queue N``, which is
+only the persisted view of the in-memory queue.
+
+A free slot is not enough for a run to start, the host must also have
+the cores and the memory it needs, see ``admission``. The queue is
+strictly ordered, the runs behind a run waiting for resources wait too.
+"""
+import datetime
+import heapq
+import itertools
+import logging
+import os
+import subprocess
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import psutil
+
+from .admission import refusal, run_needs
+from .isolation import assign_cpus, parse_cpus
+from .notifier import FINAL_STATUS
+from .registry import get_registry
+from .replacer import LowerPriorityPopen
+from .runner import run_command
+
+
+class SlotScheduler(ABC):
+    """Start queued jobs when one of the execution slots is free.
+
+    A job is a row of the registry table, identified by the values of
+    the key columns. Subclasses tell how to start it and how to mark it
+    failed.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    slots : int
+        The number of jobs allowed to execute at the same time.
+    """
+
+    table = ""
+    keys: Tuple[str, ...] = ()
+    running_status = "running"  # the status of a started job
+    script = ""  # the file executed by the process of a job
+    date_column = ""  # the time the job was registered
+    cancelled_status = "cancelled"  # the status of a job left the queue
+    admit_interval = 5  # seconds between two checks of a refused job
+
+    def __init__(self, conf: dict, slots: int):
+        self.conf = conf
+        self.slots = slots
+        self.queue: List[Tuple[int, int, Tuple[str, ...]]] = []
+        self.running: Dict[Tuple[str, ...], int] = {}
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        self.thread = threading.Thread(target=self._loop, daemon=True,
+                                       name=f"{self.table}-scheduler")
+
+    def start(self) -> None:
+        """Recover the persisted queue and start dispatching."""
+        self._recover()
+        self.thread.start()
+
+    def submit(self, *key: str, priority: int = 0) -> None:
+        """Queue a job that has been registered; lower priority runs first.
+
+        A job already queued or running is not queued again.
+        """
+        with self.cond:
+            if key in self.running or any(key == queued
+                                          for _, _, queued in self.queue):
+                return
+            heapq.heappush(self.queue, (priority, next(self.counter), key))
+            self._persist_queue()
+            self.cond.notify()
+
+    def cancel(self, *key: str) -> bool:
+        """Remove a queued job from the queue and mark it cancelled.
+
+        Returns
+        -------
+        bool
+            False if the job is not in the queue, e.g. already started.
+        """
+        with self.cond:
+            remaining = [item for item in self.queue if item[2] != key]
+            if len(remaining) == len(self.queue):
+                return False
+            self.queue = remaining
+            heapq.heapify(self.queue)
+            get_registry(self.conf).set_status(
+                self.table, self._where(key), self.cancelled_status)
+            self._persist_queue()
+            self.cond.notify()
+        return True
+
+    def _where(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.keys, key))
+
+    def _recover(self) -> None:
+        """Take over the jobs queued or running before a restart.
+
+        Running jobs are watched again, jobs registered but not started
+        yet (no PID) are queued behind the persisted queue, and jobs whose
+        process has exited without a final status are marked failed, also
+        if their PID has been reused by another process since.
+        """
+        reg = get_registry(self.conf)
+        rows = reg.frame(self.table)
+        started = rows[~rows.status.str.startswith(FINAL_STATUS[self.table])
+                       & ~rows.status.str.startswith("queue ")]
+        unqueued = []
+        for row in started.itertuples():
+            key = tuple(getattr(row, col) for col in self.keys)
+            try:
+                pid = int(float(row.PID))
+            except (TypeError, ValueError):  # never dispatched
+                unqueued.append(key)
+                continue
+            try:
+                proc = psutil.Process(pid)
+            except psutil.NoSuchProcess:
+                proc = None
+            if proc is None or not self._is_job(proc, key,
+                                                getattr(row, self.date_column)):
+                self._failed(key)
+                continue
+            self.running[key] = proc.pid
+            threading.Thread(target=self._watch, args=(proc, key),
+                             daemon=True).start()
+
+        queued = reg.frame(self.table, status_prefix="queue ")
+        queued = queued.sort_values(
+            by="status", key=lambda col: col.str[6:].astype(int))
+        for row in queued.itertuples():
+            key = tuple(getattr(row, col) for col in self.keys)
+            heapq.heappush(self.queue, (0, next(self.counter), key))
+        for key in unqueued:
+            heapq.heappush(self.queue, (0, next(self.counter), key))
+        if unqueued:
+            self._persist_queue()
+
+    def _is_job(self, proc: psutil.Process, key: Tuple[str, ...],
+                registered: str) -> bool:
+        """Tell if a process is the one started for the job.
+
+        A process started before the job was registered, or executing
+        something else than the script of the job with its key, got the
+        PID of the exited job.
+        """
+        try:
+            created = proc.create_time()
+            args = " ".join(proc.cmdline()).split()
+        except psutil.Error:
+            return False
+        try:
+            since = datetime.datetime.strptime(
+                registered, '%Y-%m-%d %H:%M:%S').timestamp()
+        except ValueError:
+            since = 0
+        # the registration time is rounded down to seconds
+        return (created >= since - 1
+                and any(arg.endswith(self.script) for arg in args)
+                and all(val in args for val in key))
+
+    def _persist_queue(self) -> None:
+        """Write the queue positions that have changed to the registry.
+
+        The queued rows are read at once, only the jobs that have just
+        been queued are looked up one by one.
+        """
+        reg = get_registry(self.conf)
+        persisted = {tuple(row[col] for col in self.keys): row["status"]
+                     for row in reg.rows(self.table, status_prefix="queue ")}
+        for pos, (_, _, key) in enumerate(sorted(self.queue), 1):
+            status = persisted.get(key)
+            if status is None:
+                row = reg.find(self.table, **self._where(key))
+                if row is None:  # deleted meanwhile
+                    continue
+                status = row["status"]
+            if status != f"queue {pos}":
+                reg.set_status(self.table, self._where(key), f"queue {pos}")
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self._step()
+            except Exception:  # the dispatcher must keep running
+                logging.exception("The %s scheduler failed to dispatch.",
+                                  self.table)
+                with self.cond:
+                    self.cond.wait(self.admit_interval)
+
+    def _step(self) -> None:
+        """Wait for a free slot and dispatch the head of the queue."""
+        with self.cond:
+            while not self.queue or len(self.running) >= self.slots:
+                self.cond.wait()
+            key = self.queue[0][2]
+            running = dict(self.running)
+        # measuring the resources takes time, submits are not blocked
+        try:
+            admitted = self._admit(key, running)
+        except Exception as err:
+            print(f"The resources could not be checked: {err}", flush=True)
+            admitted = True
+        with self.cond:
+            if not admitted:
+                # freed resources are not notified, check them later
+                self.cond.wait(self.admit_interval)
+                return
+            if (not self.queue or self.queue[0][2] != key
+                    or len(self.running) >= self.slots):
+                return  # the queue has changed meanwhile
+            _, _, key = heapq.heappop(self.queue)
+            try:
+                if get_registry(self.conf).find(
+                        self.table, **self._where(key)) is not None:
+                    self._dispatch(key)
+            except Exception as err:
+                self._failed(key)
+                print(f"{self.table} {' '.join(key)} could not be "
+                      f"started: {err}", flush=True)
+            self._persist_queue()
+
+    def _dispatch(self, key: Tuple[str, ...]) -> None:
+        """Start the job in a detached process and watch it."""
+        proc = self._start(key)
+        self.running[key] = proc.pid
+        get_registry(self.conf).set_status(
+            self.table, self._where(key), self.running_status, PID=proc.pid)
+        threading.Thread(target=self._watch, args=(proc, key),
+                         daemon=True).start()
+
+    def _admit(self, key: Tuple[str, ...],
+               running: Dict[Tuple[str, ...], int]) -> bool:
+        """Tell if the job at the head of the queue can start now."""
+        return True
+
+    @abstractmethod
+    def _start(self, key: Tuple[str, ...]) -> subprocess.Popen:
+        """Start the process of the job."""
+
+    @abstractmethod
+    def _failed(self, key: Tuple[str, ...]) -> None:
+        """Give the job a final error status."""
+
+    def _watch(self, proc, key: Tuple[str, ...]) -> None:
+        """Free the slot of the job once its process exits.
+
+        A job whose process was killed or crashed before writing a final
+        status is marked failed.
+        """
+        try:
+            proc.wait()
+            row = get_registry(self.conf).find(self.table, **self._where(key))
+            if (row is not None and not row["status"].startswith(
+                    FINAL_STATUS[self.table])):
+                self._failed(key)
+        finally:
+            with self.cond:
+                self.running.pop(key, None)
+                self.cond.notify()
+
+
+class RunScheduler(SlotScheduler):
+    """Dispatch the runs, see ``run_slots`` in host.cfg."""
+
+    table = "runs"
+    keys = ("program_name", "purpose")
+    script = "runner.py"
+    date_column = "setup_date"
+    cancelled_status = "Completed (cancelled)"
+
+    def __init__(self, conf: dict, slots: int):
+        super().__init__(conf, slots)
+        self.needs: Dict[Tuple[str, ...], Dict[str, float]] = {}
+        self.refused: Dict[Tuple[str, ...], str] = {}
+
+    def _admit(self, key, running):
+        reg = get_registry(self.conf)
+        self.needs = {run: self.needs.get(run) or run_needs(self.conf, reg,
+                                                            run[0])
+                      for run in list(running) + [key]}
+        reason = refusal(self.conf, self.needs[key],
+                         [(pid, self.needs[run])
+                          for run, pid in running.items()], interval=0.5)
+        if reason is None:
+            self.refused.pop(key, None)
+            return True
+        if key not in self.refused:  # log only the first refusal
+            prg_name, purp = key
+            log_path = os.path.join(self.conf["RUNR"], prg_name, purp,
+                                    "run_output_and_error.log")
+            with open(log_path, 'a') as logf:
+                nowstr = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                print(f"{nowstr} Waiting for resources: {reason}.",
+                      file=logf, flush=True)
+        self.refused[key] = reason
+        return False
+
+    def _start(self, key):
+        prg_name, purp = key
+        setup_folder = os.path.join(self.conf["RUNR"], prg_name, purp)
+        # the cores of the run, the ones of the running runs are avoided
+        reg = get_registry(self.conf)
+        taken = []
+        for run in self.running:
+            row = reg.find("runs", **self._where(run))
+            if row is not None:
+                taken += parse_cpus(row.get("cpus", ""))
+        cores = self.needs.get(key, {}).get("cores", 1)
+        cpus = assign_cpus(self.conf, cores, taken)
+        if cpus:
+            reg.update("runs", self._where(key),
+                       cpus=",".join(map(str, cpus)))
+        cmd = run_command(self.conf, prg_name, purp, queue=False, cpus=cpus)
+        with open(os.path.join(setup_folder, "run_output_and_error.log"),
+                  'a') as logf:
+            nowstr = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            print(f"{nowstr} An execution slot is free, "
+                  "the run leaves the queue.", file=logf, flush=True)
+            return LowerPriorityPopen(cmd, shell=True,
+                                      cwd=os.path.dirname(__file__),
+                                      stdout=logf, stderr=logf)
+
+    def _failed(self, key):
+        get_registry(self.conf).set_status("runs", self._where(key),
+                                           "Completed with error 2")
+
+
+class InstallScheduler(SlotScheduler):
+    """Dispatch the installs, see ``install_slots`` in host.cfg."""
+
+    table = "programs"
+    keys = ("program_name",)
+    script = "install_program.py"
+    date_column = "upload_date"
+    running_status = "installing"
+    cancelled_status = "Installed with error (cancelled)"
+
+    def _start(self, key):
+        from .install_program import install_command
+        program_name, = key
+        reg = get_registry(self.conf)
+        cmd = install_command(self.conf, reg.find("programs",
+                                                  program_name=program_name))
+        masterfolder = os.path.join(self.conf["PRGR"], program_name)
+        with open(os.path.join(masterfolder, "install_output_and_error.log"),
+                  'a') as logf:
+            nowstr = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            print(f"{nowstr} An install slot is free, "
+                  "the install leaves the queue.", file=logf, flush=True)
+            return subprocess.Popen(cmd, shell=True,
+                                    stdout=logf, stderr=logf)
+
+    def _failed(self, key):
+        get_registry(self.conf).set_status("programs", self._where(key),
+                                           "Installed with error (2)")
+
+
+_scheduler: Optional[RunScheduler] = None
+_install_scheduler: Optional[InstallScheduler] = None
+
+
+def start_scheduler(conf: dict) -> RunScheduler:
+    """Create and start the run and install schedulers of this process.
+
+    The numbers of slots are set with ``run_slots`` and ``install_slots``
+    in host.cfg.
+    """
+    global _scheduler, _install_scheduler
+    if _scheduler is None:
+        _scheduler = RunScheduler(conf, conf["run_slots"])
+        _scheduler.start()
+    if _install_scheduler is None:
+        _install_scheduler = InstallScheduler(conf, conf["install_slots"])
+        _install_scheduler.start()
+    return _scheduler
+
+
+def get_scheduler() -> Optional[RunScheduler]:
+    """Return the run scheduler of this process, None if it is not started."""
+    return _scheduler
+
+
+def get_install_scheduler() -> Optional[InstallScheduler]:
+    """Return the install scheduler of this process, None if not started."""
+    return _install_scheduler
@@ -1,15 +1,17 @@
 import argparse
 from configparser import ConfigParser, ExtendedInterpolation
+import json
 import logging
 import os
 from pathlib import Path
 from typing import List
 
-import pandas as pd
+from .env_pool import parse_pool_sizes
 
 
 def create_csv_if_not_exists(colnames: List[str], fname: str) -> None:
     if not os.path.isfile(fname):
+        import pandas as pd
         df = pd.DataFrame(columns=colnames)
         df.to_csv(fname, index=False)
 
@@ -21,8 +23,14 @@ def set_folders(host_root, config):
     config["RUNR"] = os.path.join(host_root, 'runs')
     config["LIBR"] = os.path.join(host_root, 'libs')
     config["FLSR"] = os.path.join(host_root, 'files')
-
-    for folder in ["PRGR", "RUNR", "LIBR", "FLSR"]:
+    config["GITM"] = os.path.join(host_root, 'git_mirrors')
+    config["WHLR"] = os.path.join(host_root, 'wheelhouse')
+    config["LCKR"] = os.path.join(host_root, 'env_locks')
+    config["BLBR"] = os.path.join(host_root, 'blobs')
+    config["UPLR"] = os.path.join(host_root, 'uploads')
+
+    for folder in ["PRGR", "RUNR", "LIBR", "FLSR", "WHLR", "LCKR", "BLBR",
+                   "UPLR"]:
         if not os.path.isdir(config[folder]):
             os.makedirs(config[folder])
 
@@ -32,15 +40,24 @@ def set_csv_files(host_root, config):
     config["RUN"] = os.path.join(host_root, 'runs/run_details.csv')
     config["LIB"] = os.path.join(host_root, 'libs/lib_details.csv')
     config["FLE"] = os.path.join(host_root, 'file_data.csv')
+    config["DB"] = os.path.join(host_root, 'registry.sqlite3')
+    config["EVT"] = os.path.join(host_root, 'events.csv')
+    config["ENVC"] = os.path.join(host_root, 'env_cache.json')
+    config["ENVP"] = os.path.join(host_root, 'env_pool.json')
+    config["SNAP"] = os.path.join(host_root, 'conf_snapshot.json')
     create_csv_if_not_exists(["program_name", "upload_date", "python_version",
                               "status", "PID", "zip_fname", "selected_libs",
                               "def_args", "source", "inputs", "outputs",
-                              "version", "readme"], config["PRG"])
+                              "version", "readme", "stages", "env_prefix",
+                              "last_used", "env_state", "launch",
+                              "resources"], config["PRG"])
     create_csv_if_not_exists(["program_name", "purpose", "python_args",
                               "setup_date", "status", "uploaded_files",
                               "inherited_files", "registered_files",
                               "undefineds", "outputs", "comment",
-                              "notifications", "PID"], config["RUN"])
+                              "notifications", "PID", "run_setup",
+                              "cores_used", "peak_rss", "cpus", "blobs"],
+                             config["RUN"])
     create_csv_if_not_exists(["library_name", "upload_date", "python_version",
                               "status", "PID", "zip_fname", "selected_libs",
                               "def_args", "source", "inputs", "outputs",
@@ -80,6 +97,42 @@ def set_other_settings(host_settings, config):
                                              fallback="master ")
     config["stripe_color"] = host_settings.get("settings", "stripe_color",
                                                fallback="#eceef0")
+    config["registry"] = host_settings.get("settings", "registry",
+                                           fallback="csv")
+    config["run_slots"] = int(host_settings.get(
+        "settings", "run_slots", fallback=str(max(1, os.cpu_count() // 2))))
+    config["install_slots"] = host_settings.getint(
+        "settings", "install_slots", fallback=2)
+    config["log_timestamps"] = host_settings.getboolean(
+        "settings", "log_timestamps", fallback=False)
+    config["run_setup"] = host_settings.get("settings", "run_setup",
+                                            fallback="copy")
+    config["env_cache_size"] = host_settings.getint(
+        "settings", "env_cache_size", fallback=5)
+    config["wheelhouse_size"] = host_settings.getint(
+        "settings", "wheelhouse_size", fallback=5000)
+    config["env_idle_days"] = host_settings.getfloat(
+        "settings", "env_idle_days", fallback=0)
+    config["env_disk_budget"] = host_settings.getfloat(
+        "settings", "env_disk_budget", fallback=0)
+    config["run_max_cpu"] = host_settings.getfloat(
+        "settings", "run_max_cpu", fallback=50)
+    config["run_reserved_cores"] = host_settings.getint(
+        "settings", "run_reserved_cores", fallback=0)
+    config["run_reserved_memory"] = host_settings.getfloat(
+        "settings", "run_reserved_memory", fallback=1)
+    config["run_default_cores"] = host_settings.getint(
+        "settings", "run_default_cores", fallback=1)
+    config["run_affinity"] = host_settings.getboolean(
+        "settings", "run_affinity", fallback=True)
+    config["run_cgroup"] = host_settings.get("settings", "run_cgroup",
+                                             fallback="")
+    config["upload_chunk_size"] = host_settings.getint(
+        "settings", "upload_chunk_size", fallback=8)
+    config["upload_expiry_hours"] = host_settings.getfloat(
+        "settings", "upload_expiry_hours", fallback=24)
+    config["env_pool"] = parse_pool_sizes(
+        host_settings.get("settings", "env_pool", fallback=""))
 
 
 def set_conf(config: dict, masterconf_path: str) -> str:
@@ -139,6 +192,32 @@ def set_conf(config: dict, masterconf_path: str) -> str:
     return host_settings_path
 
 
+def save_conf_snapshot(config: dict) -> str:
+    """Write the configuration to a JSON file for the run processes.
+
+    Values that are not JSON serializable, e.g. the own settings of
+    flask, are left out. The file is replaced atomically, so a run
+    starting at the same time reads either the old or the new snapshot.
+
+    Returns
+    -------
+    str
+        The path of the snapshot.
+    """
+    snapshot = {}
+    for key, value in config.items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        snapshot[key] = value
+    tmp_path = f'{config["SNAP"]}.{os.getpid()}'
+    with open(tmp_path, 'w', encoding="utf-8") as ofile:
+        json.dump(snapshot, ofile, indent=1)
+    os.replace(tmp_path, config["SNAP"])
+    return config["SNAP"]
+
+
 def load_pages(config: dict, prg_conf_path: str) -> None:
     prg_config = ConfigParser(interpolation=ExtendedInterpolation())
     prg_config.read(prg_conf_path)
@@ -0,0 +1,214 @@
+"""Resumable uploads of large files, sent in chunks.
+
+A client creates an upload with the name and the size of the file
+(POST /uploads), then sends the file in chunks, each with its offset
+(PUT /uploads/<id>?offset=N). A chunk at a wrong offset is refused with
+the current offset, so after a broken connection the client asks for the
+offset (GET /uploads/<id>) and continues from there instead of starting
+over. A chunk can carry its SHA-256 in the ``X-Chunk-Sha256`` header, a
+corrupted chunk is dropped and can be sent again. At the end the client
+finalizes the upload (POST /uploads/<id>/finalize), with the md5 of the
+whole file if it knows it, and the service checks the size and the md5.
+
+The forms of the Files tab, the runs and the program installs take the
+id of a finalized upload in ``<field>_upload`` instead of the file, and
+handle the file as if it were posted with the form.
+
+Uploads are kept in HostRoot/uploads/<id>, next to the blob store. The
+ones not continued or taken over for ``upload_expiry_hours`` are removed.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+CHUNK = 1024 * 1024
+
+# the md5 of the uploads received in order so far, by id
+_hashers: Dict[str, Tuple[int, "hashlib._Hash"]] = {}
+# the uploads a chunk is being written to
+_busy = set()
+
+
+def _folder(conf: dict, upload_id: str) -> str:
+    if not upload_id.isalnum():
+        raise KeyError(upload_id)
+    return os.path.join(conf["UPLR"], upload_id)
+
+
+def _meta(conf: dict, upload_id: str) -> dict:
+    try:
+        with open(os.path.join(_folder(conf, upload_id), "meta.json"),
+                  encoding="utf-8") as ifile:
+            return json.load(ifile)
+    except FileNotFoundError:
+        raise KeyError(upload_id)
+
+
+def _save_meta(conf: dict, upload_id: str, meta: dict) -> None:
+    path = os.path.join(_folder(conf, upload_id), "meta.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as ofile:
+        json.dump(meta, ofile)
+    os.replace(path + ".tmp", path)
+
+
+def create(conf: dict, filename: str, size: int) -> str:
+    """Start an upload and return its id."""
+    expire(conf)
+    upload_id = uuid.uuid4().hex
+    os.makedirs(_folder(conf, upload_id))
+    open(os.path.join(_folder(conf, upload_id), "data"), "wb").close()
+    _save_meta(conf, upload_id, {"filename": filename, "size": size,
+                                 "created": time.time(), "md5": None})
+    _hashers[upload_id] = (0, hashlib.md5())
+    return upload_id
+
+
+def state(conf: dict, upload_id: str) -> dict:
+    """Return the file name, the size, the received bytes and the md5.
+
+    Raises
+    ------
+    KeyError
+        If there is no such upload.
+    """
+    meta = _meta(conf, upload_id)
+    offset = os.path.getsize(os.path.join(_folder(conf, upload_id), "data"))
+    return {"id": upload_id, "filename": meta["filename"],
+            "size": meta["size"], "offset": offset,
+            "chunk_size": conf["upload_chunk_size"] * CHUNK,
+            "md5": meta["md5"]}
+
+
+def append(conf: dict, upload_id: str, offset: int, stream,
+           sha256: Optional[str] = None) -> int:
+    """Write a chunk read from stream to the upload at offset.
+
+    Returns
+    -------
+    int
+        The number of bytes received so far.
+
+    Raises
+    ------
+    KeyError
+        If there is no such upload.
+    ValueError
+        If the offset is not the end of the received bytes, the chunk goes
+        beyond the size of the file or its SHA-256 does not match.
+    """
+    current = state(conf, upload_id)
+    if current["md5"] is not None:
+        raise ValueError("The upload is already finalized.")
+    if offset != current["offset"] or upload_id in _busy:
+        raise ValueError(f"The upload continues at {current['offset']}.")
+    # extend the md5 in the same pass if the upload is hashed up to offset
+    hashed, hasher = _hashers.pop(upload_id, (-1, None))
+    md5 = hasher.copy() if hashed == offset else None
+    _busy.add(upload_id)
+    path = os.path.join(_folder(conf, upload_id), "data")
+    try:
+        chunk_sha = hashlib.sha256()
+        size = offset
+        with open(path, "r+b") as ofile:
+            ofile.seek(offset)
+            for data in iter(lambda: stream.read(CHUNK), b""):
+                size += len(data)
+                if size > current["size"]:
+                    ofile.truncate(offset)
+                    raise ValueError("The chunk goes beyond the size of "
+                                     f"the file, {current['size']} bytes.")
+                chunk_sha.update(data)
+                if md5 is not None:
+                    md5.update(data)
+                ofile.write(data)
+            if sha256 is not None and chunk_sha.hexdigest() != sha256.lower():
+                ofile.truncate(offset)
+                raise ValueError("The SHA-256 of the chunk does not match.")
+    except BaseException:
+        if md5 is not None:  # the md5 up to offset is still valid
+            _hashers[upload_id] = (hashed, hasher)
+        raise
+    finally:
+        _busy.discard(upload_id)
+    if md5 is not None:
+        _hashers[upload_id] = (size, md5)
+    return size
+
+
+def finalize(conf: dict, upload_id: str, md5: Optional[str] = None) -> dict:
+    """Check that the upload is complete and its md5, and mark it done.
+
+    Raises
+    ------
+    KeyError
+        If there is no such upload.
+    ValueError
+        If bytes are missing or the md5 does not match.
+    """
+    from .blobs import file_md5
+    current = state(conf, upload_id)
+    if current["md5"] is not None:
+        return current
+    if current["offset"] != current["size"]:
+        raise ValueError(f"{current['offset']} of {current['size']} bytes "
+                         "are received.")
+    hashed, hasher = _hashers.pop(upload_id, (-1, None))
+    if hashed == current["size"]:
+        digest = hasher.hexdigest()
+    else:  # the service was restarted in the middle of the upload
+        digest = file_md5(os.path.join(_folder(conf, upload_id), "data"))
+    if md5 and md5.lower() != digest:
+        raise ValueError(f"The md5 of the received file is {digest}, "
+                         f"not {md5}.")
+    meta = _meta(conf, upload_id)
+    meta["md5"] = digest
+    _save_meta(conf, upload_id, meta)
+    current["md5"] = digest
+    return current
+
+
+def take(conf: dict, upload_id: str) -> Tuple[str, str, int, str]:
+    """Take a finalized upload over, the upload is removed.
+
+    Returns
+    -------
+    Tuple[str, str, int, str]
+        The path of the file, a temporary one next to the blob store, its
+        md5, its size and its original name. The caller passes the file to
+        ``blobs.store_file``, moves or removes it.
+
+    Raises
+    ------
+    KeyError
+        If there is no such upload.
+    ValueError
+        If the upload is not finalized.
+    """
+    current = state(conf, upload_id)
+    if current["md5"] is None:
+        raise ValueError(f"The upload {current['filename']} is not finalized.")
+    fdesc, tmp_path = tempfile.mkstemp(dir=conf["BLBR"], suffix=".part")
+    os.close(fdesc)
+    os.replace(os.path.join(_folder(conf, upload_id), "data"), tmp_path)
+    shutil.rmtree(_folder(conf, upload_id), ignore_errors=True)
+    return tmp_path, current["md5"], current["size"], current["filename"]
+
+
+def expire(conf: dict) -> None:
+    """Remove the uploads not continued for ``upload_expiry_hours``."""
+    limit = time.time() - conf["upload_expiry_hours"] * 3600
+    for entry in os.scandir(conf["UPLR"]):
+        if not entry.is_dir() or entry.name in _busy:
+            continue
+        try:
+            last = os.path.getmtime(os.path.join(entry.path, "data"))
+        except FileNotFoundError:  # being taken over
+            continue
+        if last < limit:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            _hashers.pop(entry.name, None)
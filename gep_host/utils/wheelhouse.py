@@ -0,0 +1,113 @@
+"""Keep the wheels of the installed packages for the next installs.
+
+The packages of a program are first installed from the wheelhouse only
+(``--no-index --find-links``), so an install with already seen
+dependencies neither downloads nor builds anything. If a package is
+missing, the install falls back to the package index with the
+wheelhouse as an extra source.
+
+After a successful install the wheels of all packages of the
+environment are put into the wheelhouse and the wheels used by the
+install are marked as used. Beyond ``wheelhouse_size`` MB (host.cfg) the
+least recently used wheels are removed.
+"""
+import os
+import re
+import subprocess
+import tempfile
+from datetime import datetime
+from typing import Dict, List
+
+
+def _norm(name: str) -> str:
+    return re.sub(r"[-_.]+", "_", name).lower()
+
+
+def pip_command(conf: dict, pip_args: str) -> str:
+    """Return the pip install command preferring the wheelhouse."""
+    if conf["wheelhouse_size"] <= 0:
+        return f'pip install {pip_args}'
+    links = f'--find-links "{conf["WHLR"]}"'
+    return (f'(pip install --no-index {links} {pip_args} || '
+            f'pip install {links} {pip_args})')
+
+
+def wheels(conf: dict) -> List[Dict[str, str]]:
+    """Return the name, size and last use of the wheels, most recent first."""
+    found = []
+    for entry in os.scandir(conf["WHLR"]):
+        if entry.name.endswith(".whl") and entry.is_file():
+            fstat = entry.stat()
+            found.append({"name": entry.name, "path": entry.path,
+                          "size": fstat.st_size, "mtime": fstat.st_mtime,
+                          "used": datetime.fromtimestamp(
+                              fstat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')})
+    return sorted(found, key=lambda whl: whl["mtime"], reverse=True)
+
+
+def fill(conf: dict, activate_cmd: str) -> None:
+    """Put the wheels of the packages of an environment into the wheelhouse.
+
+    Parameters
+    ----------
+    conf : dict
+        The service configuration populated by ``set_conf``.
+    activate_cmd : str
+        The command activating the environment.
+    """
+    if conf["wheelhouse_size"] <= 0:
+        return
+    proc = subprocess.run(f'{activate_cmd} && pip freeze --exclude-editable',
+                          shell=True, text=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, check=True)
+    # packages installed from a path or url, e.g. the program, are skipped
+    pins = [line.strip() for line in proc.stdout.splitlines()
+            if "==" in line and " @ " not in line
+            and not line.startswith("-")]
+    if not pins:
+        return
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False,
+                                     dir=conf["WHLR"]) as reqf:
+        reqf.write("\n".join(pins) + "\n")
+    try:
+        links = f'--find-links "{conf["WHLR"]}"'
+        cmd = (f'{activate_cmd} && pip wheel --no-deps {links} '
+               f'-w "{conf["WHLR"]}" -r "{reqf.name}"')
+        print(cmd, flush=True)
+        proc = subprocess.run(cmd, shell=True, text=True,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+        print(proc.stdout, flush=True)
+    finally:
+        os.remove(reqf.name)
+
+    # mark the wheels of the environment as used
+    used = {(_norm(pin.split("==")[0]), pin.split("==")[1]) for pin in pins}
+    for whl in wheels(conf):
+        name, version = whl["name"].split("-")[:2]
+        if (_norm(name), version) in used:
+            os.utime(whl["path"])
+    evict(conf)
+
+
+def evict(conf: dict) -> int:
+    """Remove the least recently used wheels beyond the size limit.
+
+    Returns
+    -------
+    int
+        The number of removed wheels.
+    """
+    limit = conf["wheelhouse_size"] * 1024 * 1024
+    found = wheels(conf)
+    total = sum(whl["size"] for whl in found)
+    removed = 0
+    while found and total > limit:
+        whl = found.pop()
+        try:
+            os.remove(whl["path"])
+        except FileNotFoundError:  # removed by another install
+            pass
+        total -= whl["size"]
+        removed += 1
+    return removed
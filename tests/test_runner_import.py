@@ -0,0 +1,47 @@
+"""Guard the startup of the run processes with -X importtime.
+
+The service starts ``gep_host.utils.runner`` for every run, so it must
+not load the modules of the web service, see
+benchmarks/bench_runner_import.py for the comparison with run_program.
+"""
+import subprocess
+import sys
+
+# the runner must start without these
+HEAVY = ["pandas", "flask", "werkzeug", "unidecode"]
+# the import time of the runner in ms, about 20 ms without the modules above
+MAX_IMPORT_MS = 100
+
+
+def import_times(code: str) -> dict:
+    """Return the cumulative import time in us of each imported module.
+
+    The values are pairs of the time and whether the module is imported
+    by another one, so that the top-level times can be summed.
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          stderr=subprocess.PIPE, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            nested = name[1:].startswith(" ")
+            times[name.strip()] = (int(cumulative), nested)
+    return times
+
+
+def test_runner_imports_no_heavy_module():
+    imported = import_times("import gep_host.utils.runner")
+    loaded = sorted(mod for mod in imported if mod.split(".")[0] in HEAVY)
+    assert not loaded, f"The runner imports {', '.join(loaded)}."
+
+
+def test_runner_import_time():
+    imported = import_times("import gep_host.utils.runner")
+    total = sum(cumulative for cumulative, nested in imported.values()
+                if not nested) / 1000
+    assert total < MAX_IMPORT_MS, (
+        f"The runner is imported in {total:.0f} ms, "
+        f"more than {MAX_IMPORT_MS} ms.")